@@ -0,0 +1,151 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+def artifact_key(info, format_id, quality, split_chapters):
+    """
+    Identity of a finished download: same media + same output options = same file.
+    Returns None when the extractor didn't give us a stable id (playlists, generic pages, ...).
+    """
+    if not info or info.get('_type', 'video') != 'video':
+        return None
+    extractor = info.get('extractor_key') or info.get('extractor')
+    video_id = info.get('id')
+    if not extractor or not video_id:
+        return None
+    return f"{extractor}:{video_id}:{format_id}:{quality}:{int(bool(split_chapters))}"
+
+
+# Artifacts `filename` is part of: its main file or any other one in `files`
+CONTAINS_FILE = ("filename = ? OR EXISTS (SELECT 1 FROM json_each(artifacts.files) "
+                 "WHERE json_extract(json_each.value, '$.filename') = ?)")
+
+
+class ArtifactIndex:
+    """
+    Completed downloads keyed by artifact_key, plus the jobs currently producing them.
+
+    Repeat requests are answered with the existing file, concurrent requests for
+    the same key ride along with the job already running, and every request that
+    resolved to a file holds a reference on it so DELETE only removes the file
+    once nobody else is using it.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS artifacts (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                file_size INTEGER,
+                refcount INTEGER NOT NULL DEFAULT 1,
+                created REAL,
+                files TEXT
+            )
+        """)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(artifacts)")]
+        if "files" not in columns:
+            self.db.execute("ALTER TABLE artifacts ADD COLUMN files TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS artifacts_filename ON artifacts (filename)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> {'owner': task_id, 'followers': [task_id, ...]}
+
+    def claim(self, key, task_id):
+        """
+        Decide what `task_id` should do about `key`:
+        ('done', files)                 - already downloaded ([{filename, file_size}, ...], the main
+                                          file first, then e.g. chapters), a reference was taken on it
+        ('follow', owner_task_id)       - another job is producing it right now
+        ('own', None)                   - nobody has it, `task_id` is now the producer
+        """
+        with self.lock:
+            row = self.db.execute("SELECT filename, file_size, files FROM artifacts WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                # Recorded before the whole file list was kept: just the main file
+                files = json.loads(row[2]) if row[2] else [{'filename': row[0], 'file_size': row[1]}]
+                if all(os.path.exists(os.path.join("downloads", f['filename'])) for f in files):
+                    self.db.execute("UPDATE artifacts SET refcount = refcount + 1 WHERE key = ?", (key,))
+                    self.db.commit()
+                    return 'done', files
+                # (Partly) removed behind our back
+                self.db.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                self.db.commit()
+
+            entry = self.in_flight.get(key)
+            if entry is not None and entry['owner'] == task_id:
+                # A deferred job coming back for the key it already owns
+                return 'own', None
+            if entry is not None:
+                entry['followers'].append(task_id)
+                return 'follow', entry['owner']
+            self.in_flight[key] = {'owner': task_id, 'followers': []}
+            return 'own', None
+
+    def complete(self, key, files):
+        """Record the finished files for `key` (main file first); returns the follower task ids to notify."""
+        with self.lock:
+            entry = self.in_flight.pop(key, {'followers': []})
+            references = 1 + len(entry['followers'])
+            self.db.execute(
+                "INSERT OR REPLACE INTO artifacts (key, filename, file_size, refcount, created, files) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, files[0]['filename'], files[0]['file_size'], references, time.time(), json.dumps(files))
+            )
+            self.db.commit()
+            return entry['followers']
+
+    def fail(self, task_id):
+        """Producer `task_id` failed for good; returns the follower task ids to notify."""
+        return self.abandon(task_id)
+
+    def abandon(self, task_id):
+        """`task_id` won't produce what it claimed (cancelled, failed); returns the follower task ids left waiting."""
+        with self.lock:
+            followers = []
+            for key, entry in list(self.in_flight.items()):
+                if entry['owner'] == task_id:
+                    followers += self.in_flight.pop(key)['followers']
+            return followers
+
+    def unfollow(self, task_id):
+        """Stop waiting on whichever producer `task_id` follows (the follower was cancelled)."""
+        with self.lock:
+            for entry in self.in_flight.values():
+                if task_id in entry['followers']:
+                    entry['followers'].remove(task_id)
+                    return True
+            return False
+
+    def release(self, filename):
+        """
+        Drop one reference on the artifact `filename` belongs to. Returns how many
+        references remain (0 means the file can be deleted; files we never indexed always return 0).
+        """
+        with self.lock:
+            row = self.db.execute(f"SELECT key, refcount FROM artifacts WHERE {CONTAINS_FILE}", (filename, filename)).fetchone()
+            if row is None:
+                return 0
+            key, refcount = row
+            if refcount <= 1:
+                self.db.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                remaining = 0
+            else:
+                self.db.execute("UPDATE artifacts SET refcount = refcount - 1 WHERE key = ?", (key,))
+                remaining = refcount - 1
+            self.db.commit()
+            return remaining
+
+    def forget(self, filename):
+        """`filename` is gone (evicted), drop what it was part of whatever its references."""
+        with self.lock:
+            self.db.execute(f"DELETE FROM artifacts WHERE {CONTAINS_FILE}", (filename, filename))
+            self.db.commit()
+
+
+artifact_index = ArtifactIndex(config.ARTIFACTS_DB_PATH)
@@ -0,0 +1,106 @@
+import threading
+import time
+
+from metadata import ExtractionError
+
+# Entry states after which an entry makes no more progress
+TERMINAL_STATES = ('finished', 'error', 'cancelled')
+
+
+def expand_playlist(url, limit=None):
+    """
+    Flat-extract `url` into the URLs of its entries without resolving each one
+    (usually a single request, however long the playlist). A URL that isn't a
+    playlist comes back as its only entry. Returns (info, entries), entries
+    being {'url', 'title'} dicts.
+    """
+    import yt_dlp
+
+    opts = {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist'}
+    if limit:
+        opts['playlistend'] = limit
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        raise ExtractionError(str(e)) from e
+
+    if info.get('_type') != 'playlist':
+        return info, [{'url': info.get('webpage_url') or url, 'title': info.get('title')}]
+    entries = []
+    for entry in info.get('entries') or []:
+        entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+        if entry_url:
+            entries.append({'url': entry_url, 'title': entry.get('title')})
+    return info, entries
+
+
+class BatchProgress:
+    """
+    Live aggregate of a batch's entries, behind its 'batch_progress' messages.
+
+    Updated from the download threads as entries progress and finish. Progress
+    ticks produce at most `max_hz` messages per batch however many entries run
+    at once; state changes always produce one.
+    """
+
+    def __init__(self, batch_id, entries, max_hz):
+        self.batch_id = batch_id
+        self.entries = {
+            task_id: {'state': state, 'percent': 100.0 if state == 'finished' else 0.0}
+            for task_id, state in entries
+        }
+        self.interval = 1.0 / max_hz if max_hz > 0 else 0
+        self.last_sent = 0.0
+        self.lock = threading.Lock()
+
+    def update(self, task_id, state=None, percent=None):
+        """Record a change of one entry. Returns the message to publish, or None while throttled."""
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is None:
+                return None
+            if state:
+                entry['state'] = state
+                if state == 'finished':
+                    entry['percent'] = 100.0
+            if percent is not None and entry['state'] not in TERMINAL_STATES:
+                entry['percent'] = float(percent)
+
+            now = time.monotonic()
+            if state is None and now - self.last_sent < self.interval:
+                return None
+            self.last_sent = now
+            return self._message()
+
+    def percent(self, task_id):
+        entry = self.entries.get(task_id)
+        return entry['percent'] if entry else None
+
+    def message(self):
+        with self.lock:
+            return self._message()
+
+    def _message(self):
+        counts = {'queued': 0, 'running': 0, 'finished': 0, 'error': 0, 'cancelled': 0}
+        done_percent = 0.0
+        for entry in self.entries.values():
+            # 'coalesced' entries wait on another job's download, for the user they are running
+            state = entry['state'] if entry['state'] in counts else 'running'
+            counts[state] += 1
+            # Failed and cancelled entries won't get any further, count them as complete
+            done_percent += 100.0 if state in TERMINAL_STATES else entry['percent']
+        total = len(self.entries)
+        return {
+            'type': 'batch_progress',
+            'id': self.batch_id,
+            'batch_id': self.batch_id,
+            'total': total,
+            'queued': counts['queued'],
+            'running': counts['running'],
+            'finished': counts['finished'],
+            'failed': counts['error'],
+            'cancelled': counts['cancelled'],
+            'percent': round(done_percent / total, 1) if total else 100.0,
+            'done': counts['finished'] + counts['error'] + counts['cancelled'] == total,
+        }
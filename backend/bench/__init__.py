@@ -0,0 +1,7 @@
+"""
+Offline benchmark suite for the download pipeline.
+
+Runs the real API (uvicorn, worker processes, yt-dlp's downloaders) against
+a local stand-in for video sites, so results only depend on our code and
+the machine. See bench/run.py.
+"""
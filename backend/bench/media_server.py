@@ -0,0 +1,158 @@
+import base64
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CHUNK_SIZE = 64 * 1024
+# MPEG-TS null packet, so HLS fragments at least look like what they claim to be
+TS_PACKET = b"\x47\x1f\xff\x10" + b"\xff" * 184
+# A real 16x9 JPEG, so thumbnail jobs and derived thumbnails have something ffmpeg can read
+THUMBNAIL_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAgAAAQABAAD//gAPTGF2YzYxLjMuMTAwAP/bAEMACAoKCwoLDQ0NDQ0NEA8QEBAQEBAQEBAQEBISEhUVFRISEhAQEhIUFBUVFxcXFRUV"
+    "FRcXGRkZHh4cHCMjJCsrM//EAEwAAQEAAAAAAAAAAAAAAAAAAAAGAQEBAAAAAAAAAAAAAAAAAAAFBhABAAAAAAAAAAAAAAAAAAAAABEBAAAAAAAAAAAAAAAA"
+    "AAAAAP/AABEIAAgAEAMBIgACEQADEQD/2gAMAwEAAhEDEQA/AJcBUAX/2Q=="
+)
+
+
+def synthetic_bytes(size, pattern=b"OurTube benchmark payload\n"):
+    """Deterministic filler of exactly `size` bytes, generated chunk by chunk."""
+    block = (pattern * (CHUNK_SIZE // len(pattern) + 1))[:CHUNK_SIZE]
+    while size > 0:
+        chunk = block[:min(size, CHUNK_SIZE)]
+        size -= len(chunk)
+        yield chunk
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """
+    /media/<id>.mp4?size=N                  progressive file, honours Range
+    /media/<id>/index.m3u8?segments=N&...   HLS media playlist
+    /media/<id>/seg<i>.ts?segment_size=N    HLS fragment
+    /media/<id>.jpg                         thumbnail
+    Every route takes `rate` (bytes/s, 0 = as fast as possible). HLS also
+    takes `fail_every=N`: every Nth fragment answers 429 the first time it is
+    requested, like a CDN rate limiting us.
+    """
+    protocol_version = "HTTP/1.1"
+    rejected = set()
+    rejected_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        parts = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        rate = int(query.get("rate", 0))
+
+        if re.fullmatch(r"/media/[\w-]+\.mp4", parts.path):
+            size = int(query.get("size", 1024 * 1024))
+            start, end = 0, size - 1
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match and int(match.group(1)) < size:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if send_body:
+                self._send(synthetic_bytes(end - start + 1), rate)
+            return
+
+        if re.fullmatch(r"/media/[\w-]+\.jpg", parts.path):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(THUMBNAIL_JPEG)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(THUMBNAIL_JPEG)
+            return
+
+        match = re.fullmatch(r"/media/([\w-]+)/index\.m3u8", parts.path)
+        if match:
+            segments = int(query.get("segments", 10))
+            segment_size = int(query.get("segment_size", 128 * 1024))
+            fail_every = int(query.get("fail_every", 0))
+            lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+            for i in range(segments):
+                lines += ["#EXTINF:2.0,", f"seg{i}.ts?segment_size={segment_size}&rate={rate}&fail_every={fail_every}"]
+            lines.append("#EXT-X-ENDLIST")
+            body = ("\n".join(lines) + "\n").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+
+        match = re.fullmatch(r"/media/[\w-]+/seg(\d+)\.ts", parts.path)
+        if match:
+            fail_every = int(query.get("fail_every", 0))
+            if fail_every and int(match.group(1)) % fail_every == fail_every - 1:
+                with self.rejected_lock:
+                    first_request = parts.path not in self.rejected
+                    self.rejected.add(parts.path)
+                if first_request:
+                    self.send_response(429)
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            segment_size = int(query.get("segment_size", 128 * 1024))
+            size = segment_size - segment_size % len(TS_PACKET)
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp2t")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            if send_body:
+                self._send(synthetic_bytes(size, TS_PACKET), rate)
+            return
+
+        self.send_error(404)
+
+    def _send(self, chunks, rate):
+        started = time.monotonic()
+        sent = 0
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if rate:
+                    ahead = sent / rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class MediaServer:
+    """The local stand-in for a video site, served from a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), MediaHandler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="bench-media", daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
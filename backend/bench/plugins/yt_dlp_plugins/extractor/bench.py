@@ -0,0 +1,64 @@
+import time
+
+from yt_dlp.extractor.common import InfoExtractor
+from yt_dlp.utils import parse_qs
+
+
+class BenchIE(InfoExtractor):
+    """
+    Stand-in extractor for the benchmark suite: resolves URLs of the local
+    media server (bench/media_server.py) without any network round trip, so
+    runs measure our pipeline rather than a site's extractor.
+
+        http://127.0.0.1:<port>/bench/progressive/<id>?size=<bytes>
+        http://127.0.0.1:<port>/bench/hls/<id>?segments=<n>&segment_size=<bytes>
+
+    Both take `rate` (bytes/s the server sends at, 0 = unthrottled) and
+    `delay` (seconds extraction takes, to stand in for a slow site). HLS also
+    takes `fail_every` (see MediaHandler).
+    """
+    IE_NAME = 'bench'
+    _VALID_URL = r'https?://(?P<host>(?:127\.0\.0\.1|localhost):\d+)/bench/(?P<kind>progressive|hls)/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        host, kind, video_id = self._match_valid_url(url).group('host', 'kind', 'id')
+        query = {key: values[-1] for key, values in parse_qs(url).items()}
+        rate = int(query.get('rate', 0))
+        if float(query.get('delay', 0)):
+            time.sleep(float(query['delay']))
+
+        if kind == 'progressive':
+            size = int(query.get('size', 1024 * 1024))
+            formats = [{
+                'format_id': 'progressive',
+                'url': f'http://{host}/media/{video_id}.mp4?size={size}&rate={rate}',
+                'ext': 'mp4',
+                'filesize': size,
+                'vcodec': 'avc1.64001f',
+                'acodec': 'mp4a.40.2',
+                'height': 720,
+            }]
+        else:
+            segments = int(query.get('segments', 10))
+            segment_size = int(query.get('segment_size', 128 * 1024))
+            fail_every = int(query.get('fail_every', 0))
+            formats = [{
+                'format_id': 'hls',
+                'url': (f'http://{host}/media/{video_id}/index.m3u8?segments={segments}'
+                        f'&segment_size={segment_size}&rate={rate}&fail_every={fail_every}'),
+                # Fragments are MPEG-TS, keeping the .ts extension spares them the ffmpeg fixup
+                'ext': 'ts',
+                'protocol': 'm3u8_native',
+                'filesize_approx': segments * segment_size,
+                'vcodec': 'avc1.64001f',
+                'acodec': 'mp4a.40.2',
+                'height': 720,
+            }]
+
+        return {
+            'id': video_id,
+            'title': f'Benchmark {kind} {video_id}',
+            'duration': 60,
+            'thumbnail': f'http://{host}/media/{video_id}.jpg',
+            'formats': formats,
+        }
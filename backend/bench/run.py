@@ -0,0 +1,538 @@
+"""
+Benchmark the download pipeline end to end, offline.
+
+Starts the API in a scratch directory, with a fake extractor (bench/plugins)
+resolving URLs of a local media server (bench/media_server.py), then measures:
+
+- jobs/sec and submit-to-finished latency percentiles, for progressive and HLS jobs
+- WebSocket message rate, and send lag from the API's own /metrics
+- memory: API process RSS, peak RSS of each job's worker process
+- /api/downloads latency with a library of --library-files files
+- mean time per job stage (extract, download, post-process, finalize)
+
+Results are written as JSON for comparing runs:
+
+    cd backend
+    python -m bench.run
+    python -m bench.run --jobs 100 --max-concurrent 4 --compare bench/results/<earlier run>.json
+
+With --broker the API shares its queue through a Redis server, and
+--worker-nodes starts download nodes (worker.py) next to it; use a Redis
+database nothing else uses, the keys the run leaves are deleted afterwards:
+
+    python -m bench.run --broker redis://127.0.0.1:6379/15 --worker-nodes 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+import websockets
+import yt_dlp.version
+
+from bench.media_server import MediaServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_DIR = os.path.join(BACKEND_DIR, "bench", "plugins")
+RESULTS_DIR = os.path.join(BACKEND_DIR, "bench", "results")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def summarize(values):
+    """Mean, max and nearest-rank percentiles of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    summary = {"count": len(ordered), "mean": sum(ordered) / len(ordered), "max": ordered[-1]}
+    for p in (50, 90, 95, 99):
+        summary[f"p{p}"] = ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))]
+    return {key: round(value, 4) for key, value in summary.items()}
+
+
+class BackendProcess:
+    """The API under test, in a scratch directory with its own downloads/, processing/ and data/."""
+
+    def __init__(self, workdir, port, env):
+        self.workdir = workdir
+        self.port = port
+        self.env = env
+        self.process = None
+        self.startup_seconds = None
+        self.ready_seconds = None
+        self.started = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def environment(self):
+        env = dict(os.environ, **self.env)
+        # The fake extractor is picked up as a yt-dlp plugin, by the API and its worker processes alike
+        env["PYTHONPATH"] = os.pathsep.join([BACKEND_DIR, PLUGIN_DIR, env.get("PYTHONPATH", "")])
+        env["DATA_DIR"] = os.path.join(self.workdir, "data")
+        return env
+
+    def start(self, timeout=120):
+        started = self.started = time.monotonic()
+        self.log = open(os.path.join(self.workdir, "server.log"), "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port)],
+            cwd=self.workdir, env=self.environment(), stdout=self.log, stderr=subprocess.STDOUT
+        )
+        while time.monotonic() - started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"API exited during startup, see {self.log.name}")
+            try:
+                if httpx.get(self.base_url + "/", timeout=1).status_code == 200:
+                    self.startup_seconds = round(time.monotonic() - started, 3)
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("API did not start in time")
+
+    def wait_ready(self, timeout=120):
+        """Wait for the warm-up to finish (/api/ready), returns the server's own startup timings."""
+        while time.monotonic() - self.started < timeout:
+            response = httpx.get(self.base_url + "/api/ready", timeout=5)
+            if response.status_code == 200:
+                self.ready_seconds = round(time.monotonic() - self.started, 3)
+                return response.json()["timings"]
+            if response.json()["state"] == "failed":
+                raise RuntimeError(f"API warm-up failed: {response.json()['error']}")
+            time.sleep(0.05)
+        raise RuntimeError("API did not get ready in time")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+
+class WorkerNode(BackendProcess):
+    """A download node without the API (worker.py), sharing the API's directories and broker."""
+
+    def __init__(self, workdir, env, name):
+        super().__init__(workdir, None, dict(env, NODE_ID=name))
+        self.name = name
+
+    def start(self):
+        self.started = time.monotonic()
+        self.log = open(os.path.join(self.workdir, f"{self.name}.log"), "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BACKEND_DIR, "worker.py")],
+            cwd=self.workdir, env=self.environment(), stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+
+def wait_for_nodes(api, names, timeout=120):
+    """Wait until every worker node sends heartbeats, as seen by the API."""
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        nodes = {node["id"] for node in httpx.get(api.base_url + "/api/nodes", timeout=5).json()["nodes"]}
+        if set(names) <= nodes:
+            return
+        time.sleep(0.1)
+    raise RuntimeError("Worker nodes did not come up in time, see their logs")
+
+
+def clear_broker(url, must_be_empty=False):
+    """Delete the keys a run leaves on the Redis server; `must_be_empty` refuses to start on a database in use."""
+    import redis
+    client = redis.Redis.from_url(url)
+    try:
+        keys = list(client.scan_iter(match="ourtube:*"))
+        if must_be_empty and keys:
+            raise SystemExit(f"{url} already holds ourtube:* keys, pick an unused Redis database for the benchmark")
+        if keys:
+            client.delete(*keys)
+    finally:
+        client.close()
+
+
+class MemorySampler:
+    """
+    Samples /proc while the benchmark runs (Linux only): RSS of the API process
+    and the peak RSS (VmHWM) of every worker process that runs a job, i.e. the
+    children of the multiprocessing forkserver.
+    """
+
+    def __init__(self, pid, interval=0.02):
+        self.pid = pid
+        self.interval = interval
+        self.api_rss = []
+        self.job_peaks = {}  # pid -> highest VmHWM seen
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _status(pid):
+        fields = {}
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    fields[key] = value.strip()
+        except OSError:
+            pass
+        return fields
+
+    @staticmethod
+    def _kb(value):
+        return int(value.split()[0]) if value else 0
+
+    def _children(self):
+        parents = {}
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    with open(f"/proc/{name}/stat") as f:
+                        # pid (comm) state ppid ...; comm may contain spaces
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                parents.setdefault(ppid, []).append(int(name))
+        return parents
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.api_rss.append(self._kb(self._status(self.pid).get("VmRSS")))
+            parents = self._children()
+            for child in parents.get(self.pid, []):
+                try:
+                    with open(f"/proc/{child}/cmdline", "rb") as f:
+                        is_forkserver = b"forkserver" in f.read()
+                except OSError:
+                    continue
+                if not is_forkserver:
+                    continue
+                for job_pid in parents.get(child, []):
+                    peak = self._kb(self._status(job_pid).get("VmHWM"))
+                    if peak:
+                        self.job_peaks[job_pid] = max(peak, self.job_peaks.get(job_pid, 0))
+
+    def start(self):
+        if os.path.isdir("/proc"):
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        return {
+            "api_rss_mb": summarize([kb / 1024 for kb in self.api_rss]),
+            "job_peak_rss_mb": summarize([kb / 1024 for kb in self.job_peaks.values()]),
+        }
+
+
+def parse_metrics(text):
+    """Prometheus text format -> {(name, labels): value}."""
+    samples = {}
+    for line in text.splitlines():
+        match = re.match(r'^(\w+)(?:\{(.*)\})? (\S+)$', line)
+        if match:
+            labels = tuple(sorted(re.findall(r'(\w+)="([^"]*)"', match.group(2) or "")))
+            samples[(match.group(1), labels)] = float(match.group(3))
+    return samples
+
+
+def histogram_quantile(samples, name, q, labels=()):
+    """Upper bound of the bucket holding the q-quantile, like PromQL's histogram_quantile without interpolation."""
+    buckets = sorted(
+        (float("inf") if dict(key[1])["le"] == "+Inf" else float(dict(key[1])["le"]), value)
+        for key, value in samples.items()
+        if key[0] == f"{name}_bucket" and set(labels) <= set(key[1])
+    )
+    if not buckets or not buckets[-1][1]:
+        return None
+    target = q * buckets[-1][1]
+    for bound, count in buckets:
+        if count >= target:
+            return bound
+    return None
+
+
+async def bench_library(client, rounds):
+    """Latency of the library listing endpoint in its common shapes."""
+    timings = {"first_page": [], "sort_size": [], "filter_format": [], "revalidate_304": [], "deep_page": []}
+    for _ in range(rounds):
+        for name, params in (("first_page", {"limit": 100}), ("sort_size", {"limit": 100, "sort": "size", "order": "asc"}),
+                             ("filter_format", {"limit": 100, "format": "mp4"})):
+            started = time.perf_counter()
+            response = await client.get("/api/downloads", params=params)
+            timings[name].append(time.perf_counter() - started)
+            response.raise_for_status()
+
+        etag = response.headers.get("etag")
+        started = time.perf_counter()
+        response = await client.get("/api/downloads", params={"limit": 100, "format": "mp4"}, headers={"If-None-Match": etag})
+        timings["revalidate_304"].append(time.perf_counter() - started)
+
+    # Walk the cursor chain; later pages must cost the same as the first
+    cursor = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        response = await client.get("/api/downloads", params={"cursor": cursor} if cursor else {"limit": 100})
+        timings["deep_page"].append(time.perf_counter() - started)
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    return {name: summarize([t * 1000 for t in values]) for name, values in timings.items()}
+
+
+async def bench_jobs(client, ws_url, urls, timeout):
+    """Submit every URL at once and follow them over the WebSocket until all are done."""
+    done = {}
+    messages = []
+    submitted = {}
+    all_done = asyncio.Event()
+
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        await ws.recv()  # "connected"
+
+        async def receive():
+            async for raw in ws:
+                message = json.loads(raw)
+                messages.append((time.perf_counter(), message.get("type")))
+                task_id = message.get("id")
+                if message.get("type") in ("finished", "error") and task_id in submitted and task_id not in done:
+                    done[task_id] = (time.perf_counter(), message["type"])
+                    if len(done) == len(urls):
+                        all_done.set()
+
+        receiver = asyncio.create_task(receive())
+        first_submit = time.perf_counter()
+        for kind, url in urls:
+            task_id = str(uuid.uuid4())
+            submitted[task_id] = (time.perf_counter(), kind)
+            response = await client.post("/api/downloads", json={"url": url, "format": "any", "task_id": task_id})
+            response.raise_for_status()
+        try:
+            await asyncio.wait_for(all_done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        receiver.cancel()
+
+    elapsed = max((at for at, _ in done.values()), default=time.perf_counter()) - first_submit
+    latencies = {"all": [], "progressive": [], "hls": []}
+    for task_id, (finished_at, outcome) in done.items():
+        submitted_at, kind = submitted[task_id]
+        if outcome == "finished":
+            latencies["all"].append(finished_at - submitted_at)
+            latencies[kind].append(finished_at - submitted_at)
+    in_run = [(at, kind) for at, kind in messages if at >= first_submit]
+    types = {}
+    for _, kind in in_run:
+        types[kind] = types.get(kind, 0) + 1
+
+    return {
+        "jobs": {
+            "submitted": len(urls),
+            "finished": sum(1 for _, outcome in done.values() if outcome == "finished"),
+            "failed": sum(1 for _, outcome in done.values() if outcome == "error"),
+            "timed_out": len(urls) - len(done),
+            "wall_seconds": round(elapsed, 3),
+            "jobs_per_second": round(len(done) / elapsed, 3) if elapsed > 0 else None,
+            "latency_seconds": {kind: summarize(values) for kind, values in latencies.items()},
+        },
+        "websocket": {
+            "messages": len(in_run),
+            "messages_per_second": round(len(in_run) / elapsed, 2) if elapsed > 0 else None,
+            "by_type": types,
+        },
+    }
+
+
+def job_urls(media_base, args):
+    run = uuid.uuid4().hex[:8]  # fresh ids each run, so no job is served from the dedup index
+    urls = []
+    hls_every = round(1 / args.hls_ratio) if args.hls_ratio else 0
+    for i in range(args.jobs):
+        if hls_every and i % hls_every == hls_every - 1:
+            urls.append(("hls", f"{media_base}/bench/hls/{run}-{i}?segments={args.segments}"
+                                f"&segment_size={args.segment_size}&rate={args.rate}&delay={args.extract_delay}"
+                                f"&fail_every={args.fail_every}"))
+        else:
+            urls.append(("progressive", f"{media_base}/bench/progressive/{run}-{i}?size={args.size}"
+                                        f"&rate={args.rate}&delay={args.extract_delay}"))
+    return urls
+
+
+def seed_library(downloads_dir, count):
+    """Fill downloads/ with `count` small files of varied sizes, dates and formats."""
+    os.makedirs(downloads_dir, exist_ok=True)
+    now = time.time()
+    extensions = ("mp4", "mp4", "mp4", "mp3", "webm", "m4a")
+    for i in range(count):
+        path = os.path.join(downloads_dir, f"library-{i:06d}.{extensions[i % len(extensions)]}")
+        with open(path, "wb") as f:
+            f.write(b"\0" * (i % 4096 + 1))
+        os.utime(path, (now - i * 60, now - i * 60))
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="ourtube-bench-")
+    media = MediaServer().start()
+    seed_library(os.path.join(workdir, "downloads"), args.library_files)
+    env = {
+        "MAX_CONCURRENT_DOWNLOADS": str(args.max_concurrent),
+        "EXECUTION_BACKEND": args.backend,
+        "BANDWIDTH_LIMIT": str(args.bandwidth_limit),
+        "BROKER_URL": args.broker,
+    }
+    api = BackendProcess(workdir, free_port(), env)
+    workers = [WorkerNode(workdir, env, f"bench-worker-{i + 1}") for i in range(args.worker_nodes)]
+    shared = args.broker != "memory://"
+    if shared:
+        clear_broker(args.broker, must_be_empty=True)
+    results = {}
+    try:
+        api.start()
+        results["startup_seconds"] = api.startup_seconds
+        # The library is reconciled during the warm-up, wait for it before measuring listings
+        results["startup_timings"] = api.wait_ready()
+        results["ready_seconds"] = api.ready_seconds
+        for worker in workers:
+            worker.start()
+        wait_for_nodes(api, [worker.name for worker in workers])
+        sampler = MemorySampler(api.process.pid).start()
+        async with httpx.AsyncClient(base_url=api.base_url, timeout=60) as client:
+            results["library"] = {"files": args.library_files, **await bench_library(client, args.library_rounds)}
+            ws_url = api.base_url.replace("http://", "ws://") + "/ws"
+            results.update(await bench_jobs(client, ws_url, job_urls(media.base_url, args), args.timeout))
+            samples = parse_metrics((await client.get("/metrics")).text)
+        results["memory"] = sampler.stop()
+
+        lag_count = samples.get(("ourtube_websocket_send_lag_seconds_count", ()), 0)
+        lag_sum = samples.get(("ourtube_websocket_send_lag_seconds_sum", ()), 0)
+        results["websocket"]["send_lag_seconds"] = {
+            "mean": round(lag_sum / lag_count, 5) if lag_count else None,
+            "p95_bucket": histogram_quantile(samples, "ourtube_websocket_send_lag_seconds", 0.95),
+        }
+        results["stages_mean_seconds"] = {}
+        for stage in ("extract", "download", "postprocess", "finalize"):
+            count = samples.get(("ourtube_stage_seconds_count", (("stage", stage),)), 0)
+            total = samples.get(("ourtube_stage_seconds_sum", (("stage", stage),)), 0)
+            results["stages_mean_seconds"][stage] = round(total / count, 4) if count else None
+    finally:
+        for worker in workers:
+            worker.stop()
+        api.stop()
+        media.stop()
+        if shared:
+            clear_broker(args.broker)
+        if args.keep:
+            print(f"Scratch directory kept: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "yt_dlp": yt_dlp.version.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep")},
+    }
+
+
+def flatten(data, prefix=""):
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(old, new):
+    """Print every numeric result next to its value in an earlier run."""
+    old_flat, new_flat = flatten(old["results"]), flatten(new["results"])
+    print(f"{'metric':<50} {'before':>12} {'after':>12} {'change':>9}")
+    for name in sorted(set(old_flat) | set(new_flat)):
+        before, after = old_flat.get(name), new_flat.get(name)
+        change = ""
+        if before and after is not None:
+            change = f"{(after - before) / before * 100:+.1f}%"
+        print(f"{name:<50} {before if before is not None else '-':>12} {after if after is not None else '-':>12} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=20, help="download jobs to run")
+    parser.add_argument("--hls-ratio", type=float, default=0.5, help="share of the jobs that are HLS (0-1)")
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024, help="bytes per progressive file")
+    parser.add_argument("--segments", type=int, default=16, help="fragments per HLS stream")
+    parser.add_argument("--segment-size", type=int, default=256 * 1024, help="bytes per HLS fragment")
+    parser.add_argument("--rate", type=int, default=0, help="media server bytes/s per response, 0 = unthrottled")
+    parser.add_argument("--fail-every", type=int, default=0, help="every Nth HLS fragment is first answered with 429")
+    parser.add_argument("--extract-delay", type=float, default=0, help="seconds the fake extractor takes")
+    parser.add_argument("--max-concurrent", type=int, default=2, help="MAX_CONCURRENT_DOWNLOADS for the API")
+    parser.add_argument("--bandwidth-limit", type=int, default=0, help="BANDWIDTH_LIMIT for the API (bytes/s)")
+    parser.add_argument("--backend", choices=("process", "thread"), default="process", help="EXECUTION_BACKEND")
+    parser.add_argument("--broker", default="memory://",
+                        help="BROKER_URL for every node, e.g. redis://127.0.0.1:6379/15 (an otherwise unused database)")
+    parser.add_argument("--worker-nodes", type=int, default=0,
+                        help="download nodes (worker.py) to start next to the API, needs --broker; "
+                             "stage timings only cover the API's own jobs")
+    parser.add_argument("--library-files", type=int, default=10000, help="files in downloads/ for the listing benchmark")
+    parser.add_argument("--library-rounds", type=int, default=20, help="requests per listing shape")
+    parser.add_argument("--timeout", type=float, default=600, help="give up on unfinished jobs after this many seconds")
+    parser.add_argument("--output", help="where to write the JSON results (default: bench/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory (server.log, downloads)")
+    args = parser.parse_args()
+    if args.hls_ratio and not 0 < args.hls_ratio <= 1:
+        parser.error("--hls-ratio must be between 0 and 1")
+    if args.worker_nodes and args.broker == "memory://":
+        parser.error("--worker-nodes needs a shared --broker (redis://...)")
+
+    report = {"meta": metadata(args), "results": asyncio.run(run(args))}
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+import config
+
+
+class LocalBroker:
+    """
+    A single node: the scheduler keeps its queue in memory and messages only
+    go to this process's WebSockets. The default (BROKER_URL=memory://).
+
+    Events are {'kind': ..., 'node': <sender>, ...} dicts; handlers registered
+    with `subscribe` get the events other nodes publish, on the event loop.
+    """
+    shared = False
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.started = time.time()
+        self.handlers = {}  # kind -> [handler(event)]
+        self.describe = dict  # extra fields of this node's heartbeat
+
+    def start(self, loop, describe=None):
+        if describe:
+            self.describe = describe
+
+    def subscribe(self, kind, handler):
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind, **fields):
+        """Send an event to the other nodes (event loop only). There are none here."""
+
+    async def nodes(self):
+        """Heartbeats of the nodes sharing the broker."""
+        return [self._info()]
+
+    async def alive_nodes(self):
+        return {node['id'] for node in await self.nodes()}
+
+    def _info(self):
+        return {'id': self.node_id, 'started': self.started, **self.describe()}
+
+    def _dispatch(self, event):
+        for handler in self.handlers.get(event.get('kind'), []):
+            try:
+                handler(event)
+            except Exception as e:
+                print(f"Broker handler error on {event.get('kind')} event: {e!r}")
+
+
+class RedisBroker(LocalBroker):
+    """
+    Nodes (API processes, download workers) sharing one Redis server, or
+    anything speaking its protocol (BROKER_URL=redis://host:6379/0).
+
+    - The job queue lives in Redis (scheduler.RedisQueue), every node with
+      download slots takes jobs from it.
+    - Events are fanned out over one pub/sub channel, so progress reaches the
+      node holding the client's WebSocket whichever node runs the job.
+    - Every node refreshes a heartbeat key; the jobs of a node whose key
+      expired are queued again by the others.
+    """
+    shared = True
+
+    def __init__(self, url, node_id, timeout, prefix="ourtube"):
+        super().__init__(node_id)
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("BROKER_URL is a Redis URL but the redis package is not installed")
+        self.url = url
+        self.redis = redis.asyncio.from_url(url, decode_responses=True)
+        self.timeout = timeout  # heartbeat TTL
+        self.prefix = prefix
+        self.channel = self.key("events")
+        self.outbox = None
+        self.tasks = []
+
+    def key(self, *parts):
+        return ":".join((self.prefix,) + parts)
+
+    def start(self, loop, describe=None):
+        super().start(loop, describe)
+        if not self.tasks:
+            self.outbox = asyncio.Queue()
+            self.tasks = [loop.create_task(coro) for coro in (self._publisher(), self._listener(), self._heartbeat())]
+
+    def publish(self, kind, **fields):
+        if self.outbox is not None:
+            self.outbox.put_nowait(json.dumps({'kind': kind, 'node': self.node_id, **fields}))
+
+    async def nodes(self):
+        keys = [key async for key in self.redis.scan_iter(match=self.key("node", "*"))]
+        values = await self.redis.mget(keys) if keys else []
+        return sorted((json.loads(value) for value in values if value), key=lambda node: node['id'])
+
+    async def _publisher(self):
+        # One task sends everything so events keep their order; whatever piled up goes in one round trip
+        while True:
+            events = [await self.outbox.get()]
+            while not self.outbox.empty() and len(events) < 500:
+                events.append(self.outbox.get_nowait())
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for event in events:
+                        pipe.publish(self.channel, event)
+                    await pipe.execute()
+            except Exception as e:
+                # Like a slow WebSocket, the events are dropped rather than piling up; job states are in the job store
+                print(f"Could not publish {len(events)} event(s) to the broker: {e!r}")
+                await asyncio.sleep(1)
+
+    async def _listener(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for item in pubsub.listen():
+                        if item['type'] != 'message':
+                            continue
+                        event = json.loads(item['data'])
+                        # Our own events were handled locally before being sent
+                        if event.get('node') != self.node_id:
+                            self._dispatch(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Broker subscription lost, reconnecting: {e!r}")
+                await asyncio.sleep(1)
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self.redis.set(self.key("node", self.node_id), json.dumps(self._info()), ex=self.timeout)
+            except Exception as e:
+                print(f"Broker heartbeat failed: {e!r}")
+            await asyncio.sleep(self.timeout / 3)
+
+
+def create_broker(url, node_id, timeout):
+    scheme = urlsplit(url).scheme
+    if scheme in ("", "memory"):
+        return LocalBroker(node_id)
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisBroker(url, node_id, timeout)
+    raise ValueError(f"Unsupported BROKER_URL: {url}")
+
+
+broker = create_broker(config.BROKER_URL, config.NODE_ID, config.NODE_TIMEOUT)
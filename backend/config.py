@@ -0,0 +1,83 @@
+import os
+import socket
+
+# Runtime settings, overridable through the container environment
+
+# Number of downloads allowed to run at the same time (0 = this node only serves the API)
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", "2"))
+
+# Queue and progress events shared between nodes (see broker.py): "memory://" keeps
+# everything in this process, "redis://host:6379/0" shares them with every node using that server
+BROKER_URL = os.environ.get("BROKER_URL", "memory://")
+# Name of this process among the nodes sharing the broker
+NODE_ID = os.environ.get("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Seconds without a heartbeat after which a node's running jobs are queued again
+NODE_TIMEOUT = int(os.environ.get("NODE_TIMEOUT", "30"))
+
+# Where the backend keeps its own state (queue, indexes, ...)
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+
+JOBS_DB_PATH = os.path.join(DATA_DIR, "jobs.db")
+ARTIFACTS_DB_PATH = os.path.join(DATA_DIR, "artifacts.db")
+LIBRARY_DB_PATH = os.path.join(DATA_DIR, "library.db")
+THUMBNAILS_DB_PATH = os.path.join(DATA_DIR, "thumbnails.db")
+# Thumbnails and preview sprites of library files (see thumbnails.py)
+THUMBNAIL_CACHE_DIR = os.path.join(DATA_DIR, "thumbnails")
+
+# Per-WebSocket outgoing queue; progress ticks for the same task are coalesced when it fills
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "100"))
+# A client that can't take a message within this many seconds is disconnected
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", "10"))
+
+# Upper bound on progress ticks per second per task (state changes are never throttled)
+PROGRESS_MAX_HZ = float(os.environ.get("PROGRESS_MAX_HZ", "2"))
+
+# Shared cache of extractor results (entries, seconds)
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", "256"))
+METADATA_CACHE_TTL = float(os.environ.get("METADATA_CACHE_TTL", "600"))
+
+# "process": every job runs in its own worker process (isolated from the API), "thread": in-process
+EXECUTION_BACKEND = os.environ.get("EXECUTION_BACKEND", "process")
+# Per-job limits for the process backend, 0 = unlimited
+JOB_MAX_MEMORY_MB = int(os.environ.get("JOB_MAX_MEMORY_MB", "0"))
+JOB_MAX_CPU_SECONDS = int(os.environ.get("JOB_MAX_CPU_SECONDS", "0"))
+# Jobs running longer than this many seconds are stopped, 0 = unlimited
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", "0"))
+# Jobs that receive no data for this many seconds (extraction and download) are stopped, 0 = never
+JOB_STALL_TIMEOUT = int(os.environ.get("JOB_STALL_TIMEOUT", "120"))
+# Jobs that failed for a transient reason (timeouts, stalls, dropped connections, 429/5xx)
+# are queued again this many times, the first after JOB_RETRY_BACKOFF seconds, doubling from there
+JOB_RETRIES = int(os.environ.get("JOB_RETRIES", "2"))
+JOB_RETRY_BACKOFF = int(os.environ.get("JOB_RETRY_BACKOFF", "30"))
+
+# Most entries a batch or playlist request may queue
+MAX_BATCH_ENTRIES = int(os.environ.get("MAX_BATCH_ENTRIES", "1000"))
+
+# Download capacity shared by all running jobs (see governor.py)
+# Total bandwidth in bytes/s, 0 = unlimited
+BANDWIDTH_LIMIT = int(os.environ.get("BANDWIDTH_LIMIT", "0"))
+# Fragment connections (HLS/DASH) all jobs together may open to one host
+HOST_MAX_CONNECTIONS = int(os.environ.get("HOST_MAX_CONNECTIONS", "8"))
+# Fragment connections per job to start from, adapted to throughput and 429/5xx responses
+FRAGMENT_CONCURRENCY = int(os.environ.get("FRAGMENT_CONCURRENCY", "5"))
+
+# Source streams of audio jobs are kept this many seconds, so converting the same
+# media to another audio format skips the download (0 = don't keep them)
+SOURCE_CACHE_DIR = os.path.join(DATA_DIR, "sources")
+SOURCE_CACHE_TTL = int(os.environ.get("SOURCE_CACHE_TTL", "3600"))
+
+# Disk space (see storage.py)
+# Most space downloads/, processing/ and cached sources may take together, in MB (0 = no quota)
+STORAGE_QUOTA_MB = int(os.environ.get("STORAGE_QUOTA_MB", "0"))
+# Space always left free on the volume, in MB. New jobs are refused below it; downloads are only
+# evicted to keep it when STORAGE_QUOTA_MB or RETENTION_DAYS is set
+MIN_FREE_SPACE_MB = int(os.environ.get("MIN_FREE_SPACE_MB", "500"))
+# Downloads nobody fetched for this many days are removed (0 = keep them forever)
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "0"))
+# Seconds between janitor passes (quota, retention, leftovers of failed jobs in processing/)
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", "600"))
+
+# An interrupted job is resumed at most this many times before it is given up
+MAX_JOB_ATTEMPTS = int(os.environ.get("MAX_JOB_ATTEMPTS", "3"))
+# Finished jobs stay queryable through /api/jobs/{id} for this many days
+JOB_HISTORY_DAYS = int(os.environ.get("JOB_HISTORY_DAYS", "30"))
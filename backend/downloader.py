@@ -1,204 +1,615 @@
-import yt_dlp
-import threading
 import asyncio
+import importlib
 import os
 import shutil
+import threading
 import time
-import re
+from progress import progress_stats, publish_threadsafe
+from artifacts import artifact_index
+from batches import BatchProgress
+from broker import broker
+from governor import governor
+from jobs import job_store, UNFINISHED_STATES
+from library import library
+from metadata import metadata_cache, load_extractors
+from storage import storage
+from scheduler import DownloadScheduler
+from thumbnails import thumbnails
 from socket_manager import manager
+from workers import JobAborted, ProcessJobRunner, error_type, is_transient
+import config
+import metrics
 
 import uuid
 
-def sanitize_filename(name):
-    # Remove potentially dangerous characters and ensure it's not too long
-    sanitized = re.sub(r'[\\/*?:"<>|]', '', name)
-    return sanitized[:200]
+# Finished/failed jobs kept in active_downloads so late /stream requests can be redirected
+FINISHED_JOBS_KEPT = 200
+# Jobs waiting for disk space try again after this many seconds
+DEFERRED_RETRY_SECONDS = 30
+# Longest wait between two attempts of a failing job, however many retries it gets
+MAX_RETRY_DELAY = 3600
+
+def run_in_thread(spec, ctx):
+    # pipeline (and yt-dlp with it) is loaded by the warm-up or the first job, not at startup
+    from pipeline import run_download
+    return run_download(spec, ctx)
+
 
 class Downloader:
     def __init__(self):
-        self.active_downloads = {}
+        self.active_downloads = {}  # task_id -> live job state (status, file being written, ...)
+        self.batches = {}  # batch_id -> BatchProgress, for batches with entries still to run
+        self.contexts = {}  # task_id -> JobContext of the jobs running on this node
+        self._cancel_requested = set()  # claimed by a worker, cancelled before they got a JobContext
+        self._waiters = {}  # task_id -> futures of wait() calls
+        self._handed_over = {}  # task_id -> live state created by a worker thread, until the loop adds it (see _job_state)
+        self._handover_lock = threading.Lock()
+        self.loop = None
+        self._starting = None
+        self.scheduler = DownloadScheduler(self._run_job, config.MAX_CONCURRENT_DOWNLOADS, job_store, broker, config.MAX_JOB_ATTEMPTS)
+        # Jobs run in a worker process each (default) or, with EXECUTION_BACKEND=thread, in the scheduler's threads
+        if config.EXECUTION_BACKEND == "process":
+            self.runner = ProcessJobRunner(config.JOB_MAX_MEMORY_MB, config.JOB_MAX_CPU_SECONDS)
+        else:
+            self.runner = run_in_thread
         # Ensure folders exist
         for folder in ["downloads", "processing"]:
             if not os.path.exists(folder):
                 os.makedirs(folder)
 
-    async def start_download(self, url: str, format_id: str = "mp4", quality: str = "best", task_id: str = None, strict_mode: bool = False, split_chapters: bool = False, loop=None):
-        if loop is None:
+    async def start(self):
+        """Bind to the running event loop and start the download workers (idempotent)."""
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._start())
+        await asyncio.shield(self._starting)
+
+    async def _start(self):
+        self.loop = asyncio.get_running_loop()
+        broker.subscribe('message', self._remote_message)
+        broker.subscribe('batch', self._remote_batch_update)
+        broker.subscribe('cancel', self._remote_cancel)
+        broker.start(self.loop, lambda: {'workers': self.scheduler.max_workers, 'running': len(self.scheduler.running)})
+        job_store.prune(config.JOB_HISTORY_DAYS)
+        # Re-queues interrupted jobs; they resume from the partial files left in processing/
+        await self.scheduler.start(self.loop)
+        # Restored jobs get their live state now, so /stream knows them while they wait
+        for job in await self.scheduler.queue.ordered():
+            self._job_state(job.task_id)['batch_id'] = job.batch_id
+        # Everything in processing/ that no resumable job will pick up again
+        storage.clean_processing(self._jobs_in_use(), grace=0)
+        self.loop.create_task(self._janitor())
+
+    def warmup_stages(self):
+        """What the first job would otherwise wait for, loaded in the background after startup (see warmup.py)."""
+        stages = [('extractors', load_extractors)]
+        if isinstance(self.runner, ProcessJobRunner):
+            stages.append(('workers', self.runner.warm_up))
+        else:
+            stages.append(('pipeline', lambda: importlib.import_module('pipeline')))
+        return stages
+
+    def _jobs_in_use(self):
+        # Job folders in processing/ are named after the task id; the store knows those of every node sharing it
+        return set(self.scheduler.running) | {job['id'] for job in job_store.unfinished()}
+
+    async def _janitor(self):
+        """Keeps disk usage in check: quota, retention, leftovers of failed jobs (see storage.py) and unused thumbnails."""
+        while True:
             try:
-                loop = asyncio.get_running_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-        
-        self.loop = loop
+                await self.loop.run_in_executor(None, storage.clean, self._jobs_in_use())
+                await self.loop.run_in_executor(None, thumbnails.prune)
+            except Exception as e:
+                print(f"Janitor error: {e}")
+            await asyncio.sleep(config.JANITOR_INTERVAL)
+
+    async def start_download(self, url: str, format_id: str = "mp4", quality: str = "best", task_id: str = None, strict_mode: bool = False, split_chapters: bool = False, client_id: str = None, priority: int = 0):
+        await self.start()
         # Use provided ID or generate a new one
         if not task_id:
             task_id = str(uuid.uuid4())
-        
-        # Use default executor (ThreadPoolExecutor) to run blocking download
-        loop.run_in_executor(None, self._download_task, task_id, url, format_id, quality, strict_mode, split_chapters)
+
+        # Queue the job; a bounded pool of workers picks it up when a slot frees
+        await self.scheduler.submit(task_id, {
+            'url': url,
+            'format_id': format_id,
+            'quality': quality,
+            'strict_mode': strict_mode,
+            'split_chapters': split_chapters,
+        }, client_id=client_id, priority=priority)
+        self._job_state(task_id)
         return task_id
 
-    def _download_task(self, task_id, url, format_id, quality, strict_mode, split_chapters):
-        # We use the ID as the temporary filename to avoid collisions and special char issues in paths
-        
-        # We need a progress hook that captures 'd' but also knows about 'task_id'
-        def progress_hook(d):
-             if d['status'] == 'downloading':
-                data = {
-                    'type': 'progress',
-                    'id': task_id,
-                    'filename': d.get('filename'), # This is the temp filename usually
-                    'percent': d.get('_percent_str', '0%'),
-                    'speed': d.get('_speed_str', '0'),
-                    'eta': d.get('_eta_str', '0'),
-                    'status': 'downloading'
+    async def start_batch(self, urls, format_id="mp4", quality="best", split_chapters=False, client_id=None, priority=0, title=None, source_url=None):
+        """
+        Queue one job per URL under a common batch id. The entries are scheduled
+        like any other job, so they run in parallel up to MAX_CONCURRENT_DOWNLOADS.
+        Returns (batch_id, task_ids).
+        """
+        await self.start()
+        batch_id = str(uuid.uuid4())
+        job_store.create_batch(batch_id, client_id, title, source_url)
+        # Entries are single videos, a playlist URL among them would otherwise be fetched whole
+        entries = [(str(uuid.uuid4()), {
+            'url': url,
+            'format_id': format_id,
+            'quality': quality,
+            'strict_mode': True,
+            'split_chapters': split_chapters,
+        }) for url in urls]
+        jobs = await self.scheduler.submit_many(entries, client_id=client_id, priority=priority, batch_id=batch_id)
+        for job in jobs:
+            self._job_state(job.task_id)['batch_id'] = batch_id
+        # The client's session gets the aggregate messages too
+        manager.register_task(batch_id, jobs[0].client_id)
+        batch = self.batches[batch_id] = BatchProgress(batch_id, [(job.task_id, 'queued') for job in jobs], config.PROGRESS_MAX_HZ)
+        manager.publish(batch.message())
+        return batch_id, [job.task_id for job in jobs]
+
+    async def cancel_batch(self, batch_id):
+        """Cancel every entry of a batch that isn't over yet, running ones included. Returns how many were cancelled."""
+        cancelled = 0
+        for job in job_store.batch_jobs(batch_id):
+            if job['state'] in UNFINISHED_STATES and await self.cancel_job(job['id']):
+                cancelled += 1
+        return cancelled
+
+    def get_batch(self, batch_id):
+        """Durable batch record with its aggregate progress and entries, or None."""
+        batch = job_store.get_batch(batch_id)
+        if batch is None:
+            return None
+        jobs = job_store.batch_jobs(batch_id)
+        progress = self._batch_progress(batch_id)
+        summary = progress.message()
+        if summary['done']:
+            self.batches.pop(batch_id, None)
+        return {
+            **batch,
+            **{key: value for key, value in summary.items() if key not in ('type', 'batch_id')},
+            'entries': [
+                {
+                    'id': job['id'],
+                    'url': job['params']['url'],
+                    'state': job['state'],
+                    'percent': progress.percent(job['id']),
+                    'files': job['files'],
+                    'error': job['error'],
                 }
-                asyncio.run_coroutine_threadsafe(manager.broadcast(data), self.loop)
-        
-        ydl_opts = {
-            'outtmpl': f'processing/{task_id}.%(ext)s', # Use task_id for tracking temp file
-            'progress_hooks': [progress_hook],
-            'quiet': False,
-            'no_warnings': False,
-            'continuedl': True,
-            'nocheckcertificate': True,
-            'retries': 10,
-            'fragment_retries': 10,
-            'concurrent_fragment_downloads': 5, # Speed up HLS
-            'noplaylist': strict_mode, # Strict Mode
-            'split_chapters': split_chapters, # Split Chapters
+                for job in jobs
+            ],
         }
 
-        if split_chapters:
-             ydl_opts['force_keyframes_at_cuts'] = True # Ensure clean cuts for chapters
-
-        if format_id == 'thumbnail':
-            ydl_opts['writethumbnail'] = True
-            ydl_opts['skip_download'] = True
-        elif format_id in ['mp3', 'm4a', 'opus', 'wav', 'flac']:
-            ydl_opts['format'] = 'bestaudio/best'
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': format_id,
-                'preferredquality': '192',
-            }]
-        else:
-             # Video Mode
-             # For Twitch/HLS, sometimes bestvideo+bestaudio causes chunk issues
-             # We will try to force a single format if possible or better merging
-             format_selector = 'bestvideo+bestaudio/best'
-             
-             if quality == 'best':
-                 format_selector = 'bestvideo+bestaudio/best'
-             elif quality == 'best_ios':
-                 format_selector = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-             elif quality == 'worst':
-                 format_selector = 'worstvideo+worstaudio/worst'
-             elif quality.endswith('p'):
-                 height = quality[:-1]
-                 format_selector = f'bestvideo[height<={height}]+bestaudio/best[height<={height}]'
-             
-             ydl_opts['format'] = format_selector
-             ydl_opts['merge_output_format'] = 'mp4' if format_id == 'mp4' or format_id == 'any' else None
-        
-        
-        # Instagram/Twitter specific headers or cookies might be needed here
-        # yt-dlp handles many automatically, but we can enhance it.
-        
+    def _batch_progress(self, batch_id):
+        progress = self.batches.get(batch_id)
+        if progress is None:
+            # Not seen since startup, rebuild it from the job store
+            batch = job_store.get_batch(batch_id)
+            if batch:
+                manager.register_task(batch_id, batch['client_id'])
+            entries = [(job['id'], job['state']) for job in job_store.batch_jobs(batch_id)]
+            progress = self.batches[batch_id] = BatchProgress(batch_id, entries, config.PROGRESS_MAX_HZ)
+        return progress
+
+    def _update_batch(self, batch_id, task_id, **changes):
+        message = self._batch_progress(batch_id).update(task_id, **changes)
+        if broker.shared:
+            # The other nodes keep their aggregate current for /api/batches/{id}, only we send it to clients
+            self.loop.call_soon_threadsafe(lambda: broker.publish('batch', batch_id=batch_id, task_id=task_id, **changes))
+        if message:
+            publish_threadsafe(self.loop, message)
+            if message['done']:
+                self.batches.pop(batch_id, None)
+
+    def _remote_batch_update(self, event):
+        message = self._batch_progress(event['batch_id']).update(event['task_id'], state=event.get('state'), percent=event.get('percent'))
+        if message and message['done']:
+            self.batches.pop(event['batch_id'], None)
+
+    def _remote_message(self, event):
+        """Follow the jobs this node queued but another node runs."""
+        message = event['message']
+        if message.get('type') in ('finished', 'error', 'cancelled'):
+            self._resolve_waiters(message.get('id'))
+        state = self.active_downloads.get(message.get('id'))
+        if state is None or state['done']:
+            return
+        if message.get('type') == 'finished':
+            state.update(done=True, status='finished', filename=message.get('filename'), node=event['node'])
+        elif message.get('type') in ('error', 'cancelled'):
+            state.update(done=True, status=message['type'])
+        elif message.get('type') == 'progress' and message.get('status') not in ('queued', 'retrying'):
+            state.update(status='running', node=event['node'])
+
+    def _remote_cancel(self, event):
+        job = job_store.get(event['task_id'])
+        if job is not None and job['node'] == broker.node_id:
+            self._cancel_here(event['task_id'])
+
+    async def cancel(self, task_id):
+        """Cancel a job that is still waiting to run, in the queue or for its next attempt."""
+        if not await self.scheduler.cancel(task_id):
+            # Deferred and retried jobs are out of the queue until their next attempt, which then finds them cancelled
+            if not job_store.cancel_queued(task_id):
+                return False
+            await manager.broadcast({'type': 'cancelled', 'id': task_id, 'status': 'cancelled'})
+        self._requeue_followers(task_id)
+        self._finish_job_state(task_id, status='cancelled')
+        return True
+
+    async def cancel_job(self, task_id):
+        """
+        Stop a job wherever it is: queued jobs leave the queue, running ones are
+        aborted (worker process and ffmpeg killed, partial files removed) on
+        this node or, with a shared broker, on the node running them.
+        Returns False if the job is already over (or unknown).
+        """
+        job = job_store.get(task_id)
+        if job is None or job['state'] not in UNFINISHED_STATES:
+            return False
+        if job['state'] == 'queued':
+            if await self.cancel(task_id):
+                return True
+            # Picked up by a worker meanwhile
+            job = job_store.get(task_id)
+            if job['state'] not in UNFINISHED_STATES:
+                return False
+        if broker.shared and job['node'] != broker.node_id:
+            broker.publish('cancel', task_id=task_id)
+            return True
+        return self._cancel_here(task_id)
+
+    def _cancel_here(self, task_id):
+        """Cancel a job running on this node, or waiting there on another job's download. False if it is over."""
+        ctx = self.contexts.get(task_id)
+        if ctx is not None:
+            # The runner stops it on its next check (ProcessJobRunner) or progress callback (thread backend)
+            ctx.cancel()
+            return True
+        job = job_store.get(task_id)
+        if job is None:
+            return False
+        if job['state'] == 'coalesced':
+            artifact_index.unfollow(task_id)
+            self._finish_job_state(task_id, status='cancelled')
+            publish_threadsafe(self.loop, {'type': 'cancelled', 'id': task_id, 'status': 'cancelled'})
+            return True
+        if job['state'] == 'running':
+            # Claimed by a worker that hasn't started it yet; _run_job checks this set once its context is registered
+            self._cancel_requested.add(task_id)
+            ctx = self.contexts.get(task_id)
+            if ctx is not None:
+                ctx.cancel()
+            return True
+        return False
+
+    def _requeue_followers(self, task_id):
+        """Jobs waiting on the file `task_id` was to produce run on their own again (one of them takes over)."""
+        followers = artifact_index.abandon(task_id)
+        if followers:
+            asyncio.run_coroutine_threadsafe(self.scheduler.resume(followers), self.loop)
+
+    async def wait(self, task_id, timeout):
+        """Wait up to `timeout` seconds for a job to be over, then return its record (see get_job)."""
+        job = job_store.get(task_id)
+        if job is not None and job['state'] in UNFINISHED_STATES:
+            future = self.loop.create_future()
+            self._waiters.setdefault(task_id, []).append(future)
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiters = self._waiters.get(task_id, [])
+                if future in waiters:
+                    waiters.remove(future)
+                if not waiters:
+                    self._waiters.pop(task_id, None)
+        return await self.get_job(task_id)
+
+    def _resolve_waiters(self, task_id):
+        for future in self._waiters.pop(task_id, []):
+            if not future.done():
+                future.set_result(None)
+
+    async def get_job(self, task_id):
+        """Durable job record merged with live progress, or None."""
+        job = job_store.get(task_id)
+        if job is None:
+            return None
+        live = self.active_downloads.get(task_id) or {}
+        position = await self.scheduler.position(task_id) if job['state'] == 'queued' else None
+        return {
+            'id': job['id'],
+            'state': job['state'],
+            'url': job['params']['url'],
+            'format': job['params']['format_id'],
+            'quality': job['params']['quality'],
+            'client_id': job['client_id'],
+            'priority': job['priority'],
+            'queue_position': position,
+            'node': job['node'],
+            'attempts': job['attempts'],
+            'retry_at': job['retry_at'],
+            'partial_files': job['partial_files'],
+            'files': job['files'],
+            'filename': live.get('filename') or (job['files'][0]['filename'] if job['files'] else None),
+            'error': job['error'],
+            'created': job['created'],
+            'updated': job['updated'],
+        }
+
+    def _job_state(self, task_id):
+        """
+        A job's live state, created if it has none yet. Only the event loop adds
+        to active_downloads (it is iterated there, see _trim_finished): from a
+        worker thread a new state is handed over to the loop.
+        """
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # 1. INITIALIZE & EXTRACT
-                # Broadcast immediately
-                asyncio.run_coroutine_threadsafe(manager.broadcast({
-                    'type': 'progress',
-                    'id': task_id,
-                    'status': 'initializing',
-                    'percent': '0%',
-                    'speed': 'Connecting...',
-                    'eta': 'Preparing...'
-                }), self.loop)
-
-                info = ydl.extract_info(url, download=False)
-                # We don't use the video_id for the task ID anymore, but we can keep it for reference if needed
-                title = info.get('title', 'video')
-                
-                # Update with title
-                asyncio.run_coroutine_threadsafe(manager.broadcast({
-                    'type': 'progress',
-                    'id': task_id,
-                    'filename': title,
-                    'status': 'starting',
-                    'percent': '0%',
-                }), self.loop)
-
-                # 2. DOWNLOAD (to processing folder)
-                ydl.download([url])
-                
-                # 3. VERIFY & MOVE (Atomic)
-                # Broadcast merging status
-                asyncio.run_coroutine_threadsafe(manager.broadcast({
-                    'type': 'progress',
-                    'id': task_id,
-                    'status': 'merging',
-                    'percent': '99%',
-                    'speed': 'Processing',
-                    'eta': 'Finalizing...'
-                }), self.loop)
-
-                # Small sleep to let ffmpeg close descriptors
-                time.sleep(2)
-
-                # Find the actual resulting file
-                # yt-dlp might have changed the ext during merge
-                candidate_exts = [format_id if format_id != 'any' else 'mp4', 'mp4', 'mkv', 'webm', 'm4a', 'mp3', 'wav', 'jpg', 'webp']
-                actual_file = None
-                
-                # Try the direct name first using task_id
-                possible_paths = [
-                    os.path.join("processing", f"{task_id}.{ext}") for ext in candidate_exts
-                ]
-                
-                for path in possible_paths:
-                    if os.path.exists(path):
-                        actual_file = path
-                        break
-                
-                if not actual_file:
-                    raise Exception("Could not find downloaded file in processing directory")
-
-                # Move to final location with sanitized title
-                ext = actual_file.rsplit('.', 1)[-1]
-                safe_title = sanitize_filename(title)
-                final_path = os.path.join("downloads", f"{safe_title}.{ext}")
-                
-                # If file already exists, add timestamp to avoid collision
-                if os.path.exists(final_path):
-                    final_path = os.path.join("downloads", f"{safe_title}_{int(time.time())}.{ext}")
-
-                shutil.move(actual_file, final_path)
-                
-                # Double check size for logging
-                file_size = os.path.getsize(final_path)
-                print(f"Success: {final_path} ({file_size} bytes)")
-                
-                # 4. FINISH
-                final_filename = os.path.basename(final_path)
-                asyncio.run_coroutine_threadsafe(manager.broadcast({
-                    'type': 'finished',
-                    'id': task_id,
-                    'filename': final_filename,
-                    'file_size': file_size,
-                    'status': 'finished'
-                }), self.loop)
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        with self._handover_lock:
+            state = self.active_downloads.get(task_id) or self._handed_over.get(task_id)
+            if state is None:
+                state = {
+                    'status': 'queued',
+                    'tmpfilename': None,  # file yt-dlp is currently writing
+                    'filepath': None,  # what it gets renamed to once complete
+                    'streamable': False,  # single-format download that can be tailed while it grows
+                    'complete': False,  # all bytes are on disk
+                    'done': False,  # job is over, successfully or not
+                    'filename': None,  # final name in downloads/
+                    'batch_id': None,  # batch this job is an entry of
+                    'extractor': None,  # known once the URL has been extracted
+                    'node': None,  # set when another node runs the job
+                }
+                if on_loop:
+                    self.active_downloads[task_id] = state
+                else:
+                    self._handed_over[task_id] = state
+                    self.loop.call_soon_threadsafe(self._adopt_state, task_id)
+        return state
 
+    def _adopt_state(self, task_id):
+        with self._handover_lock:
+            if task_id in self._handed_over:
+                self.active_downloads.setdefault(task_id, self._handed_over.pop(task_id))
+
+    def _finish_job_state(self, task_id, status, filename=None, error=None, files=None):
+        state = self._job_state(task_id)
+        state.update(done=True, status=status, filename=filename)
+        job_store.set_state(task_id, status, error=error, files=files)
+        metrics.jobs_total.labels(status).inc()
+        self.loop.call_soon_threadsafe(self._resolve_waiters, task_id)
+        # Followers of another job's download finish here without a worker of their own to release their claim
+        self.scheduler.release_threadsafe(task_id)
+        if state['batch_id']:
+            self._update_batch(state['batch_id'], task_id, state=status)
+        # Called from the worker threads, while the loop keeps adding jobs to active_downloads
+        self.loop.call_soon_threadsafe(self._trim_finished)
+
+    def _trim_finished(self):
+        finished = [key for key, state in self.active_downloads.items() if state['done']]
+        for key in finished[:-FINISHED_JOBS_KEPT]:
+            self.active_downloads.pop(key, None)
+
+    def _run_job(self, job):
+        task_id = job.task_id
+        params = job.params
+        self._job_state(task_id).update(status='running', batch_id=job.batch_id)
+        if job.batch_id:
+            self._update_batch(job.batch_id, task_id, state='running')
+        ctx = JobContext(self, task_id, job.batch_id, config.JOB_TIMEOUT, config.JOB_STALL_TIMEOUT)
+        self.contexts[task_id] = ctx
+        if task_id in self._cancel_requested:
+            ctx.cancel()
+        spec = dict(params, task_id=task_id, cached_info=metadata_cache.get(params['url'], params['strict_mode']))
+
+        governor.join(task_id, params['url'])
+        try:
+            result = self.runner(spec, ctx)
         except Exception as e:
-            print(f"Error downloading {url}: {e}")
+            if ctx.cancelled:
+                self._cancelled_while_running(task_id)
+                return
+            kind = error_type(e)
+            metrics.job_errors.labels(self._job_state(task_id)['extractor'] or 'unknown', kind).inc()
+            delay = self._retry_delay(task_id, str(e), kind)
+            if delay is not None:
+                # Partial files and the claim on the artifact are kept: the next attempt resumes, followers keep waiting
+                print(f"Retrying {task_id} in {delay}s: {e}")
+                metrics.job_retries.labels(kind).inc()
+                self._job_state(task_id)['status'] = 'queued'
+                if job.batch_id:
+                    self._update_batch(job.batch_id, task_id, state='queued')
+                ctx.publish({'type': 'progress', 'id': task_id, 'status': 'retrying', 'error': str(e), 'retry_in': delay, 'percent': 0})
+                self.scheduler.defer(job, delay, retry=True, error=str(e))
+                return
+            print(f"Error downloading {params['url']}: {e}")
             # Broadcast error
-            asyncio.run_coroutine_threadsafe(manager.broadcast({
+            error = {
                 'type': 'error',
-                'url': url,
-                'id': task_id,
+                'url': params['url'],
                 'error': str(e)
-            }), self.loop)
-    
+            }
+            self._finish_job_state(task_id, status='error', error=str(e))
+            ctx.publish({**error, 'id': task_id})
+            # By task id: the claim may date from an earlier attempt, this one failing before it got as far
+            for follower in artifact_index.fail(task_id):
+                self._finish_job_state(follower, status='error', error=str(e))
+                ctx.publish({**error, 'id': follower})
+            return
+        finally:
+            governor.leave(task_id)
+            storage.release(task_id)
+            self.contexts.pop(task_id, None)
+            self._cancel_requested.discard(task_id)
+
+        if ctx.cancelled and result['status'] in ('deferred', 'coalesced'):
+            # Cancelled as it was about to wait (for disk space, or on another job's download)
+            artifact_index.unfollow(task_id)
+            self._cancelled_while_running(task_id)
+            return
+
+        if result['status'] == 'deferred':
+            # Not enough disk space until the running jobs are done
+            print(f"Deferring {task_id}: {result['reason']}")
+            self._job_state(task_id)['status'] = 'queued'
+            ctx.publish({'type': 'progress', 'id': task_id, 'status': 'queued', 'reason': result['reason'], 'percent': 0})
+            self.scheduler.defer(job, DEFERRED_RETRY_SECONDS)
+            return
+
+        if result['status'] == 'coalesced':
+            self._job_state(task_id)['status'] = 'coalesced'
+            job_store.set_state(task_id, 'coalesced')
+            if job.batch_id:
+                self._update_batch(job.batch_id, task_id, state='coalesced')
+            return
+
+        # 4. FINISH
+        finished = {
+            'type': 'finished',
+            'filename': result['filename'],
+            'file_size': result['file_size'],
+            'status': 'finished'
+        }
+        if result['status'] == 'deduplicated':
+            finished['deduplicated'] = True
+            finished['files'] = result['files']
+        else:
+            metrics.downloaded_bytes.labels(result['extractor']).inc(result['downloaded_bytes'])
+            metrics.download_seconds.labels(result['extractor']).inc(result['download_seconds'])
+            for output in result['files']:
+                library.add(
+                    output['filename'], output['file_size'],
+                    title=output['title'],
+                    source_url=output['source_url'],
+                    duration=output['duration'],
+                    extractor=output['extractor'],
+                    video_id=output['video_id'],
+                    thumbnail=output['thumbnail']
+                )
+            finished['files'] = [{'filename': f['filename'], 'file_size': f['file_size']} for f in result['files']]
+            # Make room for what was just added, at the expense of older downloads
+            storage.enforce(protected={f['filename'] for f in result['files']})
+            finished['finalize_seconds'] = result['finalize_seconds']
+            finished['postprocess_seconds'] = result['postprocess_seconds']
+            if result['audio']:
+                audio = result['audio']
+                metrics.audio_convert_seconds.labels(audio['codec'], audio['mode']).observe(audio['encode_seconds'])
+                metrics.audio_sources.labels(audio['source']).inc()
+                finished['encode_seconds'] = audio['encode_seconds']
+                finished['stream_copy'] = audio['mode'] == 'copy'
+                finished['audio_source'] = audio['source']
+        files = finished.get('files') or [{'filename': result['filename'], 'file_size': result['file_size']}]
+        self._finish_job_state(task_id, status='finished', filename=result['filename'], files=files)
+        ctx.publish({**finished, 'id': task_id})
+        if ctx.owned_key:
+            for follower in artifact_index.complete(ctx.owned_key, files):
+                self._finish_job_state(follower, status='finished', filename=result['filename'], files=files)
+                ctx.publish({**finished, 'id': follower, 'deduplicated': True})
+        else:
+            # An earlier attempt's claim this one didn't need (the file turned up meanwhile): followers look again
+            self._requeue_followers(task_id)
+
+    def _retry_delay(self, task_id, message, kind):
+        """Seconds until a failed job's next attempt, or None if it doesn't get one."""
+        attempts = job_store.get(task_id)['attempts']
+        if attempts > config.JOB_RETRIES or not is_transient(message, kind):
+            return None
+        return min(config.JOB_RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+    def _cancelled_while_running(self, task_id):
+        print(f"Cancelled {task_id}")
+        # No attempt will resume from the partial files
+        shutil.rmtree(os.path.join('processing', task_id), ignore_errors=True)
+        self._finish_job_state(task_id, status='cancelled')
+        publish_threadsafe(self.loop, {'type': 'cancelled', 'id': task_id, 'status': 'cancelled'})
+        self._requeue_followers(task_id)
+
+
+class JobContext:
+    """
+    What a running job (pipeline.run_download) may touch in the API process.
+    Called from the job's thread, or by the ProcessJobRunner relaying calls
+    from a worker process.
+    """
+
+    def __init__(self, downloader, task_id, batch_id=None, timeout=0, stall_timeout=0):
+        self.downloader = downloader
+        self.task_id = task_id
+        self.batch_id = batch_id
+        self.counters = progress_stats.track(task_id)
+        self.owned_key = None  # set while this job is the producer of an artifact other jobs may be waiting on
+        # Watchdog state, see abort_reason
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.cancelled = False
+        self.started = self.last_activity = time.monotonic()
+        self.status = None  # of the last progress message
+        self.downloaded_bytes = None
+
+    def publish(self, message):
+        if message.get('type') == 'progress':
+            # Any change of stage or byte count shows the job is moving
+            if message.get('status') != self.status or message.get('downloaded_bytes') != self.downloaded_bytes:
+                self.last_activity = time.monotonic()
+            self.status = message.get('status')
+            self.downloaded_bytes = message.get('downloaded_bytes')
+        publish_threadsafe(self.downloader.loop, message)
+        if message.get('speed'):
+            governor.report_speed(self.task_id, message['speed'])
+        if self.batch_id and message.get('type') == 'progress' and message.get('percent') is not None:
+            self.downloader._update_batch(self.batch_id, self.task_id, percent=message['percent'])
+
+    def cancel(self):
+        self.cancelled = True
+
+    def abort_reason(self):
+        """(reason, message) once the job must be stopped: cancelled, over JOB_TIMEOUT, or stalled. None otherwise."""
+        if self.cancelled:
+            return 'cancelled', "Cancelled"
+        now = time.monotonic()
+        if self.timeout and now - self.started > self.timeout:
+            return 'timeout', f"Job exceeded the {self.timeout}s time limit"
+        # ffmpeg's post-processing reports no progress, and a job waiting for a connection receives nothing,
+        # they are only bounded by JOB_TIMEOUT
+        if self.stall_timeout and self.status not in ('processing', 'finalizing', 'waiting') and now - self.last_activity > self.stall_timeout:
+            return 'stalled', f"No data received for {self.stall_timeout}s"
+        return None
+
+    def check_aborted(self):
+        # Thread backend: called from yt-dlp's callbacks, the exception unwinds the download
+        aborted = self.abort_reason()
+        if aborted:
+            raise JobAborted(*aborted)
+
+    def update_state(self, **fields):
+        self.downloader._job_state(self.task_id).update(fields)
+        if fields.get('tmpfilename'):
+            # Recorded so a restart knows which partial files belong to which job
+            job_store.add_partial_file(self.task_id, fields['tmpfilename'])
+
+    def cache_metadata(self, url, noplaylist, info):
+        metadata_cache.put(url, info, noplaylist)
+
+    def record_stage(self, stage, seconds):
+        metrics.stage_seconds.labels(stage).observe(seconds)
+
+    def limits(self):
+        return governor.allocation(self.task_id)
+
+    def report_http_error(self, status):
+        governor.report_error(self.task_id, status)
+
+    def reserve(self, size):
+        return storage.reserve(self.task_id, size)
+
+    def claim(self, key):
+        outcome, detail = artifact_index.claim(key, self.task_id)
+        if outcome == 'own':
+            self.owned_key = key
+        return outcome, detail
+
+
 downloader_service = Downloader()
@@ -0,0 +1,165 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import config
+
+def host_of(url):
+    host = (urlsplit(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+class HostState:
+    def __init__(self, fragments):
+        self.jobs = set()
+        self.fragments = fragments  # adaptive fragment connections per job
+        self.errors = []  # timestamps of recent 429/5xx responses
+        self.last_change = 0.0
+        self.last_decrease = 0.0
+        self.throughput_at_change = None  # host throughput when `fragments` was last raised
+
+
+class Governor:
+    """
+    Shares download capacity between running jobs.
+
+    - Bandwidth: the total budget (BANDWIDTH_LIMIT, bytes/s) is split max-min
+      fairly, jobs that can't use their share leave the rest to the others.
+    - Connections: jobs on the same host share HOST_MAX_CONNECTIONS fragment
+      connections, the total never goes over it. With more jobs on a host
+      than that, the latest ones get 0 and wait before downloading (see
+      pipeline.wait_for_connection) until earlier ones are done. Each
+      host's fragments-per-job target adapts AIMD style:
+      halved when the host answers 429 or 5xx, raised by one every
+      `interval` seconds without errors for as long as that keeps improving
+      the host's throughput.
+
+    Jobs read their allocation with `allocation()`, see pipeline.apply_limits.
+    Hosts are those of the requested page URLs, which for a given site stand
+    in for its media CDN.
+    """
+
+    def __init__(self, bandwidth_limit, host_max_connections, fragments, interval=5.0):
+        self.bandwidth_limit = bandwidth_limit
+        self.host_max_connections = max(1, host_max_connections)
+        self.initial_fragments = max(1, min(fragments, self.host_max_connections))
+        self.interval = interval
+        self.hosts = {}
+        self.jobs = {}  # task_id -> {'host', 'speed', 'fragments', 'ratelimit'}
+        self.lock = threading.Lock()
+
+    def join(self, task_id, url):
+        host = host_of(url)
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = HostState(self.initial_fragments)
+            state.jobs.add(task_id)
+            state.throughput_at_change = None  # a different mix of jobs, start measuring again
+            self.jobs[task_id] = {'host': host, 'speed': None, 'fragments': state.fragments, 'ratelimit': None}
+            self._rebalance()
+
+    def leave(self, task_id):
+        with self.lock:
+            job = self.jobs.pop(task_id, None)
+            if job is None:
+                return
+            state = self.hosts[job['host']]
+            state.jobs.discard(task_id)
+            state.throughput_at_change = None
+            if not state.jobs and not state.errors:
+                del self.hosts[job['host']]
+            self._rebalance()
+
+    def allocation(self, task_id):
+        """{'fragments': n, 'ratelimit': bytes/s or None} for a running job."""
+        with self.lock:
+            job = self.jobs.get(task_id)
+            if job is None:
+                return {'fragments': self.initial_fragments, 'ratelimit': None}
+            return {'fragments': job['fragments'], 'ratelimit': job['ratelimit']}
+
+    def report_speed(self, task_id, speed):
+        """Observed download speed of a job (bytes/s), from its progress messages."""
+        now = time.monotonic()
+        with self.lock:
+            job = self.jobs.get(task_id)
+            if job is None:
+                return
+            job['speed'] = speed
+            state = self.hosts[job['host']]
+            state.errors = [at for at in state.errors if now - at < self.interval]
+            if not state.errors and now - state.last_change >= self.interval and state.fragments < self.host_max_connections:
+                throughput = sum(self.jobs[other]['speed'] or 0 for other in state.jobs)
+                # Stop raising once more connections no longer pay off
+                if state.throughput_at_change is None or throughput >= state.throughput_at_change * 1.05:
+                    state.fragments += 1
+                    state.last_change = now
+                    state.throughput_at_change = throughput
+            # Bandwidth shares follow the observed speeds
+            self._rebalance()
+
+    def report_error(self, task_id, status):
+        """A job got a 429 (rate limited) or 5xx response."""
+        now = time.monotonic()
+        with self.lock:
+            job = self.jobs.get(task_id)
+            if job is None:
+                return
+            state = self.hosts[job['host']]
+            state.errors.append(now)
+            # One decrease per interval: a burst of failing fragments is one signal
+            if now - state.last_decrease < self.interval:
+                return
+            state.fragments = max(1, state.fragments // 2)
+            state.last_change = state.last_decrease = now
+            state.throughput_at_change = None
+            print(f"Governor: {job['host']} answered {status}, down to {state.fragments} connection(s) per job")
+            self._rebalance()
+
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic()
+            return {
+                'bandwidth_limit': self.bandwidth_limit or None,
+                'host_max_connections': self.host_max_connections,
+                'hosts': {
+                    host: {
+                        'jobs': len(state.jobs),
+                        'fragments_target': state.fragments,
+                        'throughput': sum(self.jobs[task_id]['speed'] or 0 for task_id in state.jobs),
+                        'recent_errors': sum(1 for at in state.errors if now - at < self.interval),
+                    }
+                    for host, state in self.hosts.items()
+                },
+                'jobs': {task_id: dict(job) for task_id, job in self.jobs.items()},
+            }
+
+    def _rebalance(self):
+        for state in self.hosts.values():
+            # In the order they joined, so the first ones keep their connections
+            jobs = [task_id for task_id in self.jobs if task_id in state.jobs]
+            per_job, extra = divmod(self.host_max_connections, len(jobs) or 1)
+            for i, task_id in enumerate(jobs):
+                # The remainder of the split goes one each to the first jobs
+                self.jobs[task_id]['fragments'] = min(state.fragments, per_job + (i < extra))
+
+        if not self.bandwidth_limit:
+            for job in self.jobs.values():
+                job['ratelimit'] = None
+            return
+        # Max-min fair share: jobs running well below their limit only need a bit more than they use
+        def demand(job):
+            if job['speed'] and job['ratelimit'] and job['speed'] < job['ratelimit'] * 0.8:
+                return job['speed'] * 1.25
+            return float('inf')
+
+        remaining = self.bandwidth_limit
+        pending = sorted(self.jobs.values(), key=demand)
+        for i, job in enumerate(pending):
+            share = remaining / (len(pending) - i)
+            job['ratelimit'] = int(min(demand(job), share))
+            remaining -= job['ratelimit']
+
+
+governor = Governor(config.BANDWIDTH_LIMIT, config.HOST_MAX_CONNECTIONS, config.FRAGMENT_CONCURRENCY)
@@ -0,0 +1,208 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+# Jobs that are not over yet and must survive a restart
+# ('coalesced' jobs wait on another job's download and are re-run if it never reported back)
+UNFINISHED_STATES = ('queued', 'running', 'coalesced')
+
+
+class JobStore:
+    """
+    Durable record of every job: what was asked for, where it is in its
+    lifecycle and which partial files it has on disk. The scheduler restores
+    its queue from here at startup, and interrupted jobs resume from their
+    partial files (yt-dlp's continuedl) instead of starting over. Nodes
+    sharing DATA_DIR share it, `node` being who runs a job.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                client_id TEXT,
+                priority INTEGER NOT NULL DEFAULT 0,
+                seq INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                partial_files TEXT NOT NULL DEFAULT '[]',
+                files TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                batch_id TEXT,
+                node TEXT,
+                retry_at REAL
+            )
+        """)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        if "batch_id" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
+        if "node" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN node TEXT")
+        if "retry_at" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN retry_at REAL")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id, seq)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                client_id TEXT,
+                title TEXT,
+                source_url TEXT,
+                created REAL NOT NULL
+            )
+        """)
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def _execute(self, query, params=()):
+        with self.lock:
+            self.db.execute(query, params)
+            self.db.commit()
+
+    def create(self, task_id, params, client_id, priority, seq, batch_id=None):
+        self.create_many([(task_id, params, client_id, priority, seq, batch_id)])
+
+    def create_many(self, jobs):
+        """Record several new jobs in one transaction: (task_id, params, client_id, priority, seq, batch_id) tuples."""
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                """INSERT OR REPLACE INTO jobs (id, params, client_id, priority, seq, state, created, updated, batch_id)
+                   VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)""",
+                [(task_id, json.dumps(params), client_id, priority, seq, now, now, batch_id)
+                 for task_id, params, client_id, priority, seq, batch_id in jobs]
+            )
+            self.db.commit()
+
+    def create_batch(self, batch_id, client_id, title=None, source_url=None):
+        self._execute(
+            "INSERT INTO batches (id, client_id, title, source_url, created) VALUES (?, ?, ?, ?, ?)",
+            (batch_id, client_id, title, source_url, time.time())
+        )
+
+    def get_batch(self, batch_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return dict(row) if row else None
+
+    def batch_jobs(self, batch_id):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs WHERE batch_id = ? ORDER BY seq", (batch_id,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def set_state(self, task_id, state, error=None, files=None):
+        self._execute(
+            "UPDATE jobs SET state = ?, error = ?, files = COALESCE(?, files), updated = ? WHERE id = ?",
+            (state, error, json.dumps(files) if files is not None else None, time.time(), task_id)
+        )
+
+    def requeue(self, task_id, seq):
+        self._execute("UPDATE jobs SET state = 'queued', seq = ?, retry_at = NULL, updated = ? WHERE id = ?", (seq, time.time(), task_id))
+
+    def recover(self, task_id, seq, node):
+        """Queue a job `node` was running again, unless another node got to it first. Returns whether it was."""
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET state = 'queued', seq = ?, updated = ? WHERE id = ? AND state IN ('running', 'coalesced') AND node IS ?",
+                (seq, time.time(), task_id, node)
+            )
+            self.db.commit()
+            return cursor.rowcount > 0
+
+    def defer(self, task_id, seq, retry_at, refund=True, error=None):
+        """
+        Back to the queue once `retry_at` has passed. A deferred job's attempt
+        doesn't count (`refund`, it never got to download), a retried one's does.
+        """
+        self._execute(
+            "UPDATE jobs SET state = 'queued', seq = ?, retry_at = ?, attempts = MAX(attempts - ?, 0), error = ?, updated = ? WHERE id = ?",
+            (seq, retry_at, int(refund), error, time.time(), task_id)
+        )
+
+    def cancel_queued(self, task_id):
+        """Cancel a job that is queued but not in the queue (waiting to be retried). False if it started or ended meanwhile."""
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET state = 'cancelled', retry_at = NULL, updated = ? WHERE id = ? AND state = 'queued'",
+                (time.time(), task_id)
+            )
+            self.db.commit()
+            return cursor.rowcount > 0
+
+    def set_priority(self, task_id, priority):
+        self._execute("UPDATE jobs SET priority = ?, updated = ? WHERE id = ?", (priority, time.time(), task_id))
+
+    def mark_running(self, task_id, node=None):
+        """Claim a queued job for `node`. False if it is no longer queued (cancelled, or taken by another node)."""
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET state = 'running', node = ?, attempts = attempts + 1, updated = ? WHERE id = ? AND state = 'queued'",
+                (node, time.time(), task_id)
+            )
+            self.db.commit()
+            return cursor.rowcount > 0
+
+    def add_partial_file(self, task_id, path):
+        with self.lock:
+            row = self.db.execute("SELECT partial_files FROM jobs WHERE id = ?", (task_id,)).fetchone()
+            if row is None:
+                return
+            partial_files = json.loads(row["partial_files"])
+            if path in partial_files:
+                return
+            partial_files.append(path)
+            self.db.execute(
+                "UPDATE jobs SET partial_files = ?, updated = ? WHERE id = ?",
+                (json.dumps(partial_files), time.time(), task_id)
+            )
+            self.db.commit()
+
+    def get(self, task_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (task_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def unfinished(self):
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT * FROM jobs WHERE state IN ({','.join('?' * len(UNFINISHED_STATES))}) ORDER BY seq",
+                UNFINISHED_STATES
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def running(self):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs WHERE state = 'running' ORDER BY updated").fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def prune(self, older_than_days):
+        """Forget finished jobs older than the retention period."""
+        cutoff = time.time() - older_than_days * 86400
+        with self.lock:
+            self.db.execute(
+                f"DELETE FROM jobs WHERE state NOT IN ({','.join('?' * len(UNFINISHED_STATES))}) AND updated < ?",
+                UNFINISHED_STATES + (cutoff,)
+            )
+            self.db.execute("DELETE FROM batches WHERE created < ? AND id NOT IN (SELECT batch_id FROM jobs WHERE batch_id IS NOT NULL)", (cutoff,))
+            self.db.commit()
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["partial_files"] = json.loads(job["partial_files"])
+        job["files"] = json.loads(job["files"]) if job["files"] else None
+        return job
+
+
+job_store = JobStore(config.JOBS_DB_PATH)
@@ -0,0 +1,217 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+# API sort name -> column
+SORT_COLUMNS = {
+    "date": "added",
+    "size": "size",
+    "title": "title",
+}
+
+# Last access is written at most this often per file, players fetch ranges many times a minute
+ACCESS_RESOLUTION = 60
+
+
+def encode_cursor(value, filename):
+    raw = json.dumps([value, filename]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    value, filename = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    return value, filename
+
+
+class Library:
+    """
+    Persistent index of the files in downloads/.
+
+    Kept up to date by the downloader and the delete endpoint, and reconciled
+    with the directory at startup, so listing never has to stat every file.
+    Nodes sharing downloads/ and DATA_DIR share it too.
+    """
+
+    def __init__(self, path, downloads_dir="downloads"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.downloads_dir = downloads_dir
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS library (
+                filename TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL,
+                added REAL NOT NULL,
+                ext TEXT,
+                title TEXT NOT NULL,
+                source_url TEXT,
+                duration REAL,
+                extractor TEXT,
+                video_id TEXT,
+                last_access REAL,
+                thumbnail TEXT
+            )
+        """)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(library)")]
+        if "last_access" not in columns:
+            self.db.execute("ALTER TABLE library ADD COLUMN last_access REAL")
+        if "thumbnail" not in columns:
+            # URL of the thumbnail the extractor reported, what thumbnails.py derives previews from
+            self.db.execute("ALTER TABLE library ADD COLUMN thumbnail TEXT")
+        # Eviction order: least recently fetched first, never fetched files by when they were added
+        self.db.execute("CREATE INDEX IF NOT EXISTS library_last_used ON library (COALESCE(last_access, added))")
+        for column in SORT_COLUMNS.values():
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS library_{column} ON library ({column}, filename)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS library_ext ON library (ext)")
+        # Bumped on every change, used for ETags; in the database so every process sharing it agrees
+        self.db.execute("CREATE TABLE IF NOT EXISTS library_generation (generation INTEGER NOT NULL)")
+        if self.db.execute("SELECT COUNT(*) FROM library_generation").fetchone()[0] == 0:
+            self.db.execute("INSERT INTO library_generation (generation) VALUES (?)", (int(time.time()),))
+        self.db.commit()
+        self.lock = threading.Lock()
+        self._accessed = {}  # filename -> last access written
+
+    @property
+    def generation(self):
+        with self.lock:
+            return self.db.execute("SELECT generation FROM library_generation").fetchone()[0]
+
+    def _touch(self):
+        # Part of the caller's transaction
+        self.db.execute("UPDATE library_generation SET generation = generation + 1")
+
+    def add(self, filename, size, title=None, source_url=None, duration=None, extractor=None, video_id=None, thumbnail=None):
+        path = os.path.join(self.downloads_dir, filename)
+        stem, _, ext = filename.rpartition(".")
+        with self.lock:
+            self.db.execute(
+                """INSERT OR REPLACE INTO library
+                   (filename, size, mtime, added, ext, title, source_url, duration, extractor, video_id, thumbnail)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (filename, size, os.path.getmtime(path) if os.path.exists(path) else None, time.time(),
+                 ext.lower() if stem else None, title or stem or filename, source_url, duration, extractor, video_id,
+                 thumbnail)
+            )
+            self._touch()
+            self.db.commit()
+
+    def remove(self, filename):
+        with self.lock:
+            self._accessed.pop(filename, None)
+            self.db.execute("DELETE FROM library WHERE filename = ?", (filename,))
+            self._touch()
+            self.db.commit()
+
+    def touch(self, filename):
+        """Record that `filename` was fetched."""
+        now = time.time()
+        if now - self._accessed.get(filename, 0) < ACCESS_RESOLUTION:
+            return
+        with self.lock:
+            self._accessed[filename] = now
+            self.db.execute("UPDATE library SET last_access = ? WHERE filename = ?", (now, filename))
+            self.db.commit()
+
+    def get(self, filename):
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM library WHERE filename = ?", (filename,))
+            row = cursor.fetchone()
+            return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def filenames(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT filename FROM library")}
+
+    def total_size(self):
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM library").fetchone()[0]
+
+    def least_recently_used(self, before=None):
+        """(filename, size, last used) from least to most recently fetched, optionally only those unused since `before`."""
+        query = "SELECT filename, size, COALESCE(last_access, added) FROM library"
+        params = []
+        if before is not None:
+            query += " WHERE COALESCE(last_access, added) < ?"
+            params.append(before)
+        with self.lock:
+            return self.db.execute(query + " ORDER BY COALESCE(last_access, added)", params).fetchall()
+
+    def reconcile(self):
+        """Bring the index in line with what is actually on disk (files added/removed while we were down)."""
+        on_disk = {}
+        with os.scandir(self.downloads_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+
+        with self.lock:
+            indexed = {row[0]: (row[1], row[2]) for row in self.db.execute("SELECT filename, size, mtime FROM library")}
+            removed = [name for name in indexed if name not in on_disk]
+            added = 0
+            for name, (size, mtime) in on_disk.items():
+                if indexed.get(name) == (size, mtime):
+                    continue
+                stem, _, ext = name.rpartition(".")
+                if name in indexed:
+                    self.db.execute("UPDATE library SET size = ?, mtime = ? WHERE filename = ?", (size, mtime, name))
+                else:
+                    self.db.execute(
+                        "INSERT INTO library (filename, size, mtime, added, ext, title) VALUES (?, ?, ?, ?, ?, ?)",
+                        (name, size, mtime, mtime, ext.lower() if stem else None, stem or name)
+                    )
+                    added += 1
+            self.db.executemany("DELETE FROM library WHERE filename = ?", [(name,) for name in removed])
+            self._touch()
+            self.db.commit()
+        print(f"Library reconciled: {len(on_disk)} files ({added} new, {len(removed)} gone)")
+
+    def page(self, limit=100, cursor=None, sort="date", order="desc", ext=None):
+        """Return (items, next_cursor) using keyset pagination on (sort column, filename); limit=None for everything."""
+        column = SORT_COLUMNS[sort]
+        descending = order == "desc"
+        clauses, params = [], []
+        if ext:
+            clauses.append("ext = ?")
+            params.append(ext.lower())
+        if cursor:
+            value, filename = decode_cursor(cursor)
+            clauses.append(f"({column}, filename) {'<' if descending else '>'} (?, ?)")
+            params.extend([value, filename])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        direction = "DESC" if descending else "ASC"
+        query = f"""SELECT filename, size, added, ext, title, source_url, duration, {column}
+                    FROM library {where}
+                    ORDER BY {column} {direction}, filename {direction}
+                    LIMIT ?"""
+        with self.lock:
+            rows = self.db.execute(query, params + [-1 if limit is None else limit + 1]).fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][7], rows[-1][0])
+        items = [
+            {
+                "filename": row[0],
+                "url": f"/api/download/{row[0]}",
+                "thumbnail": f"/api/thumbnails/{row[0]}",
+                "size": row[1],
+                "added": row[2],
+                "format": row[3],
+                "title": row[4],
+                "source_url": row[5],
+                "duration": row[6],
+            }
+            for row in rows
+        ]
+        return items, next_cursor
+
+
+library = Library(config.LIBRARY_DB_PATH)
@@ -1,15 +1,34 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import FileResponse
+# First, so the startup timings include every import below
+from warmup import warmup, PROCESS_STARTED
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import asyncio
 import os
 import shutil
+import hashlib
+import time
 from typing import List
 
 from socket_manager import manager
 from downloader import downloader_service
+from progress import progress_stats
+from metadata import metadata_cache, summarize, ExtractionError
+from artifacts import artifact_index
+from batches import expand_playlist
+from governor import governor
+from broker import broker
+from storage import storage
+from thumbnails import thumbnails, THUMBNAIL_WIDTHS, PREVIEW_FRAMES, PREVIEW_TILE
+import metrics
+from library import library, SORT_COLUMNS
+from streaming import RangeFileResponse, tail_file, media_type_for, zip_stream, content_disposition
+import config
+from urllib.parse import quote
+
+warmup.record("imports", time.perf_counter() - PROCESS_STARTED)
 
 app = FastAPI()
 
@@ -19,14 +38,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Link", "X-Next-Cursor", "X-Preview-Frames", "X-Preview-Tile"],
 )
 
 # Ensure downloads directory exists
 if not os.path.exists("downloads"):
     os.makedirs("downloads")
 
-# Mount downloads to serve files
-app.mount("/files", StaticFiles(directory="downloads"), name="files")
 
 class DownloadRequest(BaseModel):
     url: str
@@ -35,24 +53,71 @@ class DownloadRequest(BaseModel):
     task_id: str = None  # Optional client-provided ID
     strict_mode: bool = False
     split_chapters: bool = False
-    
+    client_id: str = None  # Used for fair scheduling between clients, defaults to the caller's IP
+    priority: int = 0  # Higher runs sooner
+
+class PriorityUpdate(BaseModel):
+    priority: int
+
+class BatchRequest(BaseModel):
+    urls: List[str] = []  # Downloaded as given, one job each
+    playlist_url: str = None  # Expanded into one job per entry
+    max_entries: int = None  # Only the first N entries of the playlist
+    format: str = "mp4"
+    quality: str = "best"
+    split_chapters: bool = False
+    client_id: str = None
+    priority: int = 0
+
+@app.on_event("startup")
+async def startup():
+    started = time.perf_counter()
+    # Start the download workers and resume any queue persisted before the last shutdown
+    await downloader_service.start()
+    metrics.track_service(downloader_service.scheduler, manager)
+    warmup.record("startup", time.perf_counter() - started)
+    warmup.record("serving", time.perf_counter() - PROCESS_STARTED)
+    # Everything else happens while requests are already served: picking up files added or
+    # removed while we were down (listings are stale until then), loading yt-dlp, the worker processes
+    warmup.start([("library", library.reconcile)] + downloader_service.warmup_stages())
+
 @app.get("/")
 def read_root():
     return {"status": "OurTube Backend Running"}
 
+@app.get("/api/ready")
+def get_ready():
+    """Readiness: 200 once the warm-up is done (library reconciled, yt-dlp loaded, worker processes up), 503 until then."""
+    status = warmup.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus metrics."""
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, client_id: str = None):
+    # ?client_id=... subscribes to every task started with that client_id;
+    # clients can also send {"action": "subscribe", "task_id": "..."}
+    await manager.connect(websocket, client_id)
     try:
         while True:
-            # Keep connection alive
-            await websocket.receive_text()
+            text = await websocket.receive_text()
+            await manager.handle_message(websocket, text)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
+async def require_storage():
+    # Jobs reserve what they need once their formats are known, this only turns requests away when the disk is full
+    if not await run_in_threadpool(storage.admit):
+        raise HTTPException(status_code=507, detail="Not enough disk space for new downloads")
+
 @app.post("/api/downloads")
-async def start_download(request: DownloadRequest):
+async def start_download(request: DownloadRequest, http_request: Request):
     print(f"Received download request: {request.url} with ID: {request.task_id} (Strict: {request.strict_mode}, Split: {request.split_chapters})")
+    await require_storage()
     # Start download in background executor
     task_id = await downloader_service.start_download(
         request.url, 
@@ -60,23 +125,244 @@ async def start_download(request: DownloadRequest):
         request.quality, 
         task_id=request.task_id,
         strict_mode=request.strict_mode,
-        split_chapters=request.split_chapters
+        split_chapters=request.split_chapters,
+        client_id=request.client_id or (http_request.client.host if http_request.client else None),
+        priority=request.priority
     )
     print(f"Download scheduled with ID {task_id}, returning response.")
     return {"status": "started", "url": request.url, "id": task_id}
 
-@app.get("/api/downloads")
-def list_downloads():
+@app.post("/api/batches")
+async def start_batch(request: BatchRequest, http_request: Request):
+    await require_storage()
+    urls = list(request.urls)
+    title = None
+    if request.playlist_url:
+        limit = min(request.max_entries or config.MAX_BATCH_ENTRIES, config.MAX_BATCH_ENTRIES)
+        try:
+            info, entries = await run_in_threadpool(expand_playlist, request.playlist_url, limit)
+        except ExtractionError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        urls += [entry['url'] for entry in entries]
+        title = info.get('title')
+    if not urls:
+        raise HTTPException(status_code=400, detail="No URLs to download")
+    if len(urls) > config.MAX_BATCH_ENTRIES:
+        raise HTTPException(status_code=400, detail=f"At most {config.MAX_BATCH_ENTRIES} entries per batch")
+
+    batch_id, task_ids = await downloader_service.start_batch(
+        urls,
+        request.format,
+        request.quality,
+        split_chapters=request.split_chapters,
+        client_id=request.client_id or (http_request.client.host if http_request.client else None),
+        priority=request.priority,
+        title=title,
+        source_url=request.playlist_url
+    )
+    print(f"Batch {batch_id} scheduled with {len(task_ids)} entries")
+    return {
+        "status": "started",
+        "id": batch_id,
+        "title": title,
+        "jobs": [{"id": task_id, "url": url} for task_id, url in zip(task_ids, urls)]
+    }
+
+@app.get("/api/batches/{batch_id}")
+def get_batch(batch_id: str):
+    batch = downloader_service.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    return batch
+
+@app.delete("/api/batches/{batch_id}")
+async def cancel_batch(batch_id: str):
+    if downloader_service.get_batch(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    cancelled = await downloader_service.cancel_batch(batch_id)
+    return {"status": "cancelled", "id": batch_id, "cancelled": cancelled}
+
+@app.get("/api/batches/{batch_id}/zip")
+def download_batch_zip(batch_id: str, partial: bool = False):
+    """The batch's finished files as one ZIP, streamed as it is built."""
+    batch = downloader_service.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    if not batch['done'] and not partial:
+        raise HTTPException(status_code=409, detail="Batch is still running (add ?partial=1 for what is finished so far)")
+
     files = []
-    downloads_dir = "downloads"
-    for filename in os.listdir(downloads_dir):
-        path = os.path.join(downloads_dir, filename)
-        if os.path.isfile(path):
-            files.append({
-                "filename": filename,
-                "url": f"/api/download/{filename}",
-                "size": os.path.getsize(path)
-            })
+    seen = set()
+    for entry in batch['entries']:
+        for output in entry['files'] or []:
+            # Deduplicated entries share the same file
+            if output['filename'] in seen:
+                continue
+            seen.add(output['filename'])
+            path = os.path.join("downloads", output['filename'])
+            if os.path.isfile(path):
+                files.append((path, output['filename']))
+    if not files:
+        raise HTTPException(status_code=404, detail="No finished files in this batch")
+
+    name = f"{sanitize_filename(batch['title'] or '') or 'batch-' + batch_id[:8]}.zip"
+    return StreamingResponse(
+        zip_stream(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": content_disposition(name)}
+    )
+
+@app.get("/api/queue")
+async def get_queue():
+    return await downloader_service.scheduler.snapshot()
+
+@app.delete("/api/queue/{task_id}")
+async def cancel_queued(task_id: str):
+    if await downloader_service.cancel(task_id):
+        return {"status": "cancelled", "id": task_id}
+    raise HTTPException(status_code=404, detail="Task is not queued")
+
+@app.patch("/api/queue/{task_id}")
+async def reprioritize_queued(task_id: str, update: PriorityUpdate):
+    if await downloader_service.scheduler.reprioritize(task_id, update.priority):
+        return {"status": "updated", "id": task_id, "priority": update.priority}
+    raise HTTPException(status_code=404, detail="Task is not queued")
+
+@app.get("/api/jobs/{task_id}")
+async def get_job(task_id: str, wait: float = 0):
+    """The job's record; with ?wait=N, once it is over or after N seconds (at most 300), whichever comes first."""
+    if wait > 0:
+        job = await downloader_service.wait(task_id, min(wait, 300))
+    else:
+        job = await downloader_service.get_job(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+@app.delete("/api/jobs/{task_id}")
+async def cancel_job(task_id: str):
+    """Cancel a job, queued or running (its worker process and ffmpeg are killed and its partial files removed)."""
+    job = await downloader_service.get_job(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    if not await downloader_service.cancel_job(task_id):
+        raise HTTPException(status_code=409, detail=f"Job already {job['state']}")
+    # A running job takes a moment to stop, longer when another node runs it
+    job = await downloader_service.wait(task_id, 5)
+    if job['state'] == 'cancelled':
+        return {"status": "cancelled", "id": task_id}
+    if job['state'] in ('finished', 'error'):
+        raise HTTPException(status_code=409, detail=f"Job {job['state']} before it could be cancelled")
+    return JSONResponse({"status": "cancelling", "id": task_id}, status_code=202)
+
+@app.get("/api/jobs/{task_id}/stream")
+async def stream_job(task_id: str, request: Request, timeout: float = 60):
+    """
+    Stream a job's output while it is still downloading. Waits for the download
+    to start (for at most `timeout` seconds, up to 300, then 202 with Retry-After),
+    then follows the growing file until yt-dlp is done with it. Once the job has
+    finished this redirects to the regular download URL.
+    """
+    state = downloader_service.active_downloads.get(task_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Unknown task")
+
+    deadline = time.monotonic() + min(max(timeout, 0), 300)
+    while True:
+        if state['status'] == 'finished':
+            return RedirectResponse(f"/api/download/{quote(state['filename'])}", status_code=307)
+        if state['done']:
+            raise HTTPException(status_code=409, detail=f"Job {state['status']}")
+        if state['node']:
+            # The partial file is on the node running the job
+            raise HTTPException(status_code=409, detail=f"Job is running on node {state['node']}, wait for it to finish")
+        if state['tmpfilename']:
+            if not state['streamable']:
+                raise HTTPException(status_code=409, detail="This job's output is merged or converted, wait for it to finish")
+            f = None
+            # The .part file is renamed once complete; the open handle survives any later rename/move
+            for path in (state['tmpfilename'], state['filepath']):
+                try:
+                    f = open(path, "rb")
+                    break
+                except (OSError, TypeError):
+                    continue
+            if f is not None:
+                break
+        if time.monotonic() >= deadline:
+            # Still queued (or waiting for a retry): come back later
+            return JSONResponse({"status": state['status'], "id": task_id}, status_code=202, headers={"Retry-After": "10"})
+        if await request.is_disconnected():
+            return Response(status_code=499)
+        await asyncio.sleep(0.25)
+
+    return StreamingResponse(
+        tail_file(f, lambda: state['complete'], lambda: state['done'] and state['status'] != 'finished'),
+        media_type=media_type_for(state['filepath'] or state['tmpfilename'])
+    )
+
+@app.get("/api/storage")
+def get_storage():
+    """Disk usage, quota, reservations of running jobs and what the janitor removed."""
+    return storage.stats()
+
+@app.get("/api/nodes")
+async def get_nodes():
+    """Nodes sharing the job queue (just this one without a shared broker) and what they are running."""
+    return {"node": broker.node_id, "broker": "redis" if broker.shared else "memory", "nodes": await broker.nodes()}
+
+@app.get("/api/governor")
+def get_governor():
+    """Current bandwidth and connection allocations of the running jobs."""
+    return governor.snapshot()
+
+@app.get("/api/info")
+def get_info(url: str, strict_mode: bool = False):
+    """Metadata preview for a URL, served from the shared extraction cache when possible."""
+    try:
+        info = metadata_cache.extract(url, noplaylist=strict_mode)
+    except ExtractionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return summarize(info)
+
+@app.get("/api/progress/stats")
+def get_progress_stats():
+    """Per-task progress hook calls vs. messages actually sent."""
+    return progress_stats.snapshot()
+
+@app.get("/api/progress/stats/{task_id}")
+def get_task_progress_stats(task_id: str):
+    stats = progress_stats.snapshot(task_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Unknown task")
+    return stats
+
+@app.get("/api/downloads")
+def list_downloads(request: Request, response: Response, limit: int = None, cursor: str = None,
+                   sort: str = "date", order: str = "desc", format: str = None):
+    """
+    One page of the library; the cursor for the next page is in the
+    X-Next-Cursor (and Link) header. Without `limit` or `cursor` the whole
+    library is returned, as before pagination, so older clients see every file.
+    """
+    if limit is None and cursor:
+        limit = 100
+    if sort not in SORT_COLUMNS or order not in ("asc", "desc") or (limit is not None and not 1 <= limit <= 1000):
+        raise HTTPException(status_code=400, detail="Invalid sort, order or limit")
+
+    etag = 'W/"%s"' % hashlib.sha1(f"{library.generation}|{request.url.query}".encode()).hexdigest()[:20]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    try:
+        files, next_cursor = library.page(limit, cursor, sort, order, format)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    response.headers["ETag"] = etag
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
     return files
 
 
@@ -91,8 +377,7 @@ def sanitize_filename(name: str) -> str:
     sanitized = sanitized.replace('..', '')
     return sanitized
 
-@app.get("/api/download/{filename}")
-def download_file(filename: str):
+def resolve_download(filename: str) -> str:
     # Sanitize the input filename
     safe_filename = sanitize_filename(filename)
     
@@ -104,15 +389,51 @@ def download_file(filename: str):
         print(f"Security Alert: Attempted path traversal with {filename}")
         raise HTTPException(status_code=400, detail="Invalid filename")
 
-    if os.path.exists(target_path):
-        # FileResponse with filename parameter automatically sets Content-Disposition: attachment
-        return FileResponse(
-            path=target_path,
-            filename=safe_filename,
-            media_type='application/octet-stream'
-        )
-        
-    raise HTTPException(status_code=404, detail="File not found")
+    if not os.path.isfile(target_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return target_path
+
+@app.api_route("/api/download/{filename}", methods=["GET", "HEAD"])
+def download_file(filename: str, request: Request, inline: bool = False):
+    # Range/conditional aware, so interrupted downloads resume and players can seek.
+    # Sent as an attachment unless ?inline=1 (in-browser playback).
+    target_path = resolve_download(filename)
+    library.touch(os.path.basename(target_path))
+    return RangeFileResponse(request, target_path, inline=inline)
+
+@app.api_route("/files/{filename}", methods=["GET", "HEAD"])
+def serve_file(filename: str, request: Request):
+    """Inline file access, e.g. for <video src>."""
+    target_path = resolve_download(filename)
+    library.touch(os.path.basename(target_path))
+    return RangeFileResponse(request, target_path, inline=True)
+
+@app.get("/api/thumbnails/{filename}")
+def get_thumbnail(filename: str, request: Request, width: int = 320, preview: bool = False):
+    """
+    A library file's thumbnail as WebP, `width` pixels wide (160, 320 or 640). With ?preview=1,
+    a sprite of PREVIEW_FRAMES frames side by side, each PREVIEW_TILE pixels (see the X-Preview-* headers).
+    Made on first request, then served from the cache.
+    """
+    if width not in THUMBNAIL_WIDTHS:
+        raise HTTPException(status_code=400, detail=f"width must be one of {', '.join(map(str, THUMBNAIL_WIDTHS))}")
+    target_path = resolve_download(filename)
+    try:
+        found = thumbnails.get(os.path.basename(target_path), "preview" if preview else "thumbnail", width)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if found is None:
+        raise HTTPException(status_code=404, detail="No thumbnail for this file")
+
+    path, digest = found
+    # The digest is the image's content hash, a new file or source gets a new ETag
+    headers = {"ETag": f'"{digest}"', "Cache-Control": "public, max-age=86400"}
+    if preview:
+        headers["X-Preview-Frames"] = str(PREVIEW_FRAMES)
+        headers["X-Preview-Tile"] = "%dx%d" % PREVIEW_TILE
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/webp", headers=headers)
 
 @app.delete("/api/downloads/{filename}")
 def delete_download(filename: str):
@@ -134,22 +455,28 @@ def delete_download(filename: str):
         raise HTTPException(status_code=400, detail="Invalid filename")
 
     if os.path.exists(target_path):
+        # Other requests may have been served this same file, only delete it once the last one lets go
+        remaining = artifact_index.release(safe_filename)
+        if remaining > 0:
+            return {"status": "released", "filename": safe_filename, "references": remaining}
         os.remove(target_path)
+        library.remove(safe_filename)
         return {"status": "deleted", "filename": safe_filename}
         
     raise HTTPException(status_code=404, detail="File not found")
 
 # --- Legacy v3 Support ---
-@app.get("/api/v3/download")
-def download_file_v3(filename: str):
+@app.api_route("/api/v3/download", methods=["GET", "HEAD"])
+def download_file_v3(filename: str, request: Request):
     """Support legacy query-string based downloads used by the frontend."""
-    return download_file(filename)
+    return download_file(filename, request)
 
 @app.get("/api/v3/downloads")
-def list_downloads_v3():
-    return list_downloads()
+def list_downloads_v3(request: Request, response: Response, limit: int = None, cursor: str = None,
+                      sort: str = "date", order: str = "desc", format: str = None):
+    return list_downloads(request, response, limit, cursor, sort, order, format)
 
 @app.post("/api/v3/downloads")
-async def start_download_v3(request: DownloadRequest):
-    return await start_download(request)
+async def start_download_v3(request: DownloadRequest, http_request: Request):
+    return await start_download(request, http_request)
 # -------------------------
@@ -0,0 +1,134 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import config
+
+# Query parameters that never change what gets extracted
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'ref', 'ref_src'}
+
+
+class ExtractionError(Exception):
+    """yt-dlp couldn't extract a URL: its DownloadError, raised again so the API needn't import yt-dlp to catch it."""
+
+
+def load_extractors():
+    """
+    Import yt-dlp and its extractor registry. yt-dlp is imported where it is
+    used rather than at startup (it is by far the slowest import of the
+    backend); the warm-up calls this so the first extraction doesn't wait.
+    Returns how many extractors there are.
+    """
+    import yt_dlp
+    return sum(1 for _ in yt_dlp.extractor.gen_extractor_classes())
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a URL for cache keys: lowercase host, sorted query, no tracking params or fragment."""
+    parts = urlsplit(url.strip())
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_PARAMS and not key.startswith('utm_')
+    )
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', urlencode(query), ''))
+
+
+def is_cacheable(info) -> bool:
+    # Playlists come back with lazy entries and url results still need resolving,
+    # only fully extracted single videos are worth keeping
+    return bool(info) and info.get('_type', 'video') == 'video'
+
+
+class MetadataCache:
+    """
+    LRU + TTL cache of unprocessed extractor results, shared by every job.
+
+    Entries are the raw `extract_info(..., process=False)` result, so each
+    job can still apply its own format selection to a copy of it.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str, noplaylist: bool = False):
+        key = (normalize_url(url), noplaylist)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, url: str, info, noplaylist: bool = False):
+        if self.max_entries <= 0 or not is_cacheable(info):
+            return
+        key = (normalize_url(url), noplaylist)
+        with self.lock:
+            self.entries[key] = (time.monotonic(), copy.deepcopy(info))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def extract(self, url: str, noplaylist: bool = False, ydl=None):
+        """
+        Return the unprocessed info dict for `url`, from cache when possible.
+        `ydl` lets a job extract with its own YoutubeDL instance on a miss.
+        """
+        info = self.get(url, noplaylist)
+        if info is not None:
+            return info
+        import yt_dlp
+        try:
+            if ydl is None:
+                with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'noplaylist': noplaylist}) as own_ydl:
+                    info = own_ydl.extract_info(url, download=False, process=False)
+            else:
+                info = ydl.extract_info(url, download=False, process=False)
+        except yt_dlp.utils.DownloadError as e:
+            raise ExtractionError(str(e)) from e
+        self.put(url, info, noplaylist)
+        return info
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def summarize(info) -> dict:
+    """The subset of an info dict the frontend needs for a preview."""
+    formats = [
+        {
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'height': f.get('height'),
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'filesize': f.get('filesize') or f.get('filesize_approx'),
+        }
+        for f in info.get('formats') or []
+    ]
+    return {
+        'type': info.get('_type', 'video'),
+        'id': info.get('id'),
+        'extractor': info.get('extractor_key') or info.get('ie_key'),
+        'title': info.get('title'),
+        'uploader': info.get('uploader'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail') or ((info.get('thumbnails') or [{}])[-1]).get('url'),
+        'webpage_url': info.get('webpage_url') or info.get('url'),
+        'playlist_count': info.get('playlist_count'),
+        'formats': formats,
+    }
+
+
+metadata_cache = MetadataCache(config.METADATA_CACHE_SIZE, config.METADATA_CACHE_TTL)
@@ -0,0 +1,51 @@
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Job stages take anywhere from milliseconds (finalize) to an hour (long downloads on a Pi)
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+queue_depth = Gauge("ourtube_queue_depth", "Jobs waiting for a download slot")
+active_jobs = Gauge("ourtube_active_jobs", "Jobs currently running")
+
+stage_seconds = Histogram(
+    "ourtube_stage_seconds", "Time spent in each stage of a job",
+    ["stage"], buckets=STAGE_BUCKETS
+)
+jobs_total = Counter("ourtube_jobs_total", "Jobs that ended, by outcome", ["outcome"])
+job_errors = Counter("ourtube_job_errors_total", "Failed jobs", ["extractor", "error"])
+job_retries = Counter("ourtube_job_retries_total", "Failed jobs queued again for another attempt", ["error"])
+
+# Throughput per extractor: rate(bytes) / rate(seconds)
+downloaded_bytes = Counter("ourtube_downloaded_bytes_total", "Bytes fetched by yt-dlp", ["extractor"])
+download_seconds = Counter("ourtube_download_seconds_total", "Time spent fetching those bytes", ["extractor"])
+
+# Audio jobs: how the output was produced (copy = remuxed, encode = re-encoded) and where its source came from
+audio_convert_seconds = Histogram(
+    "ourtube_audio_convert_seconds", "Time spent producing audio outputs from their source stream",
+    ["codec", "mode"], buckets=STAGE_BUCKETS
+)
+audio_sources = Counter("ourtube_audio_sources_total", "Audio jobs by where their source stream came from", ["source"])
+
+# imports, startup, serving (first request possible), warmup_<stage>, warmup, ready; see warmup.py
+startup_seconds = Gauge("ourtube_startup_seconds", "Seconds taken by each startup phase", ["phase"])
+
+served_bytes = Counter("ourtube_served_bytes_total", "Bytes sent to HTTP clients", ["kind"])
+
+websocket_connections = Gauge("ourtube_websocket_connections", "Open WebSocket connections")
+websocket_queued = Gauge("ourtube_websocket_queued_messages", "Messages waiting in WebSocket send queues")
+websocket_send_lag = Histogram(
+    "ourtube_websocket_send_lag_seconds", "Time from queueing a WebSocket message to having sent it",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+
+def track_service(scheduler, connections):
+    """Read the gauges that mirror live state straight from the scheduler and WebSocket manager at scrape time."""
+    queue_depth.set_function(lambda: len(scheduler.queue))
+    active_jobs.set_function(lambda: len(scheduler.running))
+    websocket_connections.set_function(lambda: len(connections.active_connections))
+    websocket_queued.set_function(lambda: sum(len(c.pending) for c in list(connections.active_connections.values())))
+
+
+def render():
+    """(body, content type) of the /metrics response."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,512 @@
+import os
+import re
+import shutil
+import sys
+import time
+import uuid
+
+import yt_dlp
+from yt_dlp.postprocessor.common import PostProcessor
+
+import config
+from artifacts import artifact_key
+from metadata import is_cacheable
+from progress import ProgressReporter
+from sources import source_cache, stream_copyable
+
+AUDIO_FORMATS = ['mp3', 'm4a', 'opus', 'wav', 'flac']
+
+HTTP_ERROR_RE = re.compile(r'HTTP Error (\d{3})')
+PROGRESS_LINE_RE = re.compile(r'\[download\]\s+[\d.]+%')
+
+
+def sanitize_filename(name):
+    # Remove potentially dangerous characters and ensure it's not too long
+    sanitized = re.sub(r'[\\/*?:"<>|]', '', name)
+    return sanitized[:200]
+
+
+def publish_file(src, name, downloads_dir="downloads"):
+    """
+    Move `src` into downloads/ as `name` (or a timestamped variant if taken) and
+    return the final path. The file appears under its final name in one atomic
+    step: a hard link on the same filesystem, after copying to a hidden temp
+    file first when processing/ lives on another volume. Never overwrites.
+    """
+    if os.stat(src).st_dev != os.stat(downloads_dir).st_dev:
+        staged = os.path.join(downloads_dir, f".{uuid.uuid4().hex}.partial")
+        shutil.copyfile(src, staged)
+        os.remove(src)
+        src = staged
+
+    stem, ext = os.path.splitext(name)
+    candidates = [name, f"{stem}_{int(time.time())}{ext}"]
+    candidates += [f"{stem}_{int(time.time())}_{n}{ext}" for n in range(1, 100)]
+    for candidate in candidates:
+        final_path = os.path.join(downloads_dir, candidate)
+        try:
+            os.link(src, final_path)
+        except FileExistsError:
+            continue
+        except OSError:
+            # No hard links on this filesystem, fall back to a plain rename
+            if os.path.exists(final_path):
+                continue
+            os.rename(src, final_path)
+            return final_path
+        os.remove(src)
+        return final_path
+    raise Exception(f"Could not find a free filename for {name}")
+
+
+def collect_outputs(info, chapters_dir):
+    """
+    Files yt-dlp produced, from what it reports rather than by probing paths:
+    `requested_downloads[].filepath` (already renamed by post-processors),
+    written thumbnails (`info['thumbnails'][].filepath`; with skip_download,
+    thumbnail-only jobs, there are no requested_downloads at all), and
+    chapter splits. Yields (path, name_hint, entry_info). Playlists are
+    walked entry by entry.
+    """
+    if info.get('_type') == 'playlist':
+        for entry in info.get('entries') or []:
+            if entry:
+                yield from collect_outputs(entry, chapters_dir)
+        return
+
+    seen = set()
+    downloads = info.get('requested_downloads') or []
+    reported = [download.get('filepath') for download in downloads]
+    for thumbnails in [info.get('thumbnails')] + [download.get('thumbnails') for download in downloads]:
+        reported += [thumbnail.get('filepath') for thumbnail in thumbnails or []]
+    for path in reported:
+        if path and path not in seen and os.path.exists(path):
+            seen.add(path)
+            yield path, None, info
+
+    # FFmpegSplitChapters doesn't report its outputs, they all land in this video's chapter folder
+    video_chapters = os.path.join(chapters_dir, str(info.get('id')))
+    if os.path.isdir(video_chapters):
+        for name in sorted(os.listdir(video_chapters)):
+            yield os.path.join(video_chapters, name), name, info
+
+
+class JobLogger:
+    """
+    yt-dlp logger for a job: prints what yt-dlp would (except progress lines,
+    those go out over the WebSocket) and reports rate limiting (429) and
+    server errors (5xx) to the governor through `ctx`.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def debug(self, msg):
+        # Extraction only talks through here, the thread backend's chance to stop a cancelled job before the download
+        self.ctx.check_aborted()
+        self._inspect(msg)
+        if not PROGRESS_LINE_RE.match(msg):
+            print(msg)
+
+    def info(self, msg):
+        self.debug(msg)
+
+    def warning(self, msg):
+        self._inspect(msg)
+        print(f"WARNING: {msg}", file=sys.stderr)
+
+    def error(self, msg):
+        self._inspect(msg)
+        print(msg, file=sys.stderr)
+
+    def _inspect(self, msg):
+        match = HTTP_ERROR_RE.search(msg)
+        if match:
+            status = int(match.group(1))
+            if status == 429 or status >= 500:
+                self.ctx.report_http_error(status)
+
+
+class InsufficientStorage(Exception):
+    def __init__(self, message, wait=False):
+        super().__init__(message)
+        self.wait = wait  # there will be room once the other running jobs are done
+
+
+def estimated_size(info):
+    """Expected bytes of a video's selected format(s), 0 when the extractor gives no hint."""
+    total = 0
+    for f in info.get('requested_formats') or [info]:
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and info.get('duration'):
+            size = f['tbr'] * 1000 / 8 * info['duration']
+        total += size or 0
+    return int(total)
+
+
+class ReserveSpacePP(PostProcessor):
+    """
+    Runs before each video is downloaded, once its formats are selected, and
+    reserves disk space for them through `ctx` (storage.StorageManager.reserve).
+    Merges and `postprocessed` jobs (audio conversion, chapter splits) keep
+    the source next to their output for a while, so they reserve twice the size.
+    """
+
+    def __init__(self, ctx, postprocessed=False):
+        super().__init__()
+        self.ctx = ctx
+        self.postprocessed = postprocessed
+
+    def run(self, info):
+        size = estimated_size(info)
+        if self.postprocessed or info.get('requested_formats'):
+            size *= 2
+        if size:
+            outcome, message = self.ctx.reserve(size)
+            if outcome != 'ok':
+                raise InsufficientStorage(message, wait=outcome == 'wait')
+        return [], info
+
+
+def retry_backoff(n):
+    """Seconds to wait before retry n+1 of a request or fragment."""
+    return min(2 ** n, 30)
+
+
+def apply_limits(params, limits, protocol=None):
+    """
+    Apply a governor allocation to a YoutubeDL's params. yt-dlp's downloaders
+    read the rate limit as they go (fragments when they start) and the
+    fragment concurrency when a format's download starts.
+    """
+    fragments = max(1, int(limits['fragments']))
+    ratelimit = limits['ratelimit']
+    if ratelimit and protocol and protocol.startswith(('m3u8', 'http_dash_segments')):
+        # Every fragment connection is throttled on its own
+        ratelimit = ratelimit / fragments
+    params['concurrent_fragment_downloads'] = fragments
+    params['ratelimit'] = int(ratelimit) if ratelimit else None
+
+
+def wait_for_connection(ctx, reporter):
+    """
+    Wait until the governor allots the job at least one connection: it gets
+    none while its host already has HOST_MAX_CONNECTIONS taken by other jobs.
+    Returns the allocation.
+    """
+    limits = ctx.limits()
+    if not limits['fragments']:
+        reporter.state('waiting', reason="Waiting for a connection to the site", percent=0)
+        while not limits['fragments']:
+            ctx.check_aborted()
+            time.sleep(0.5)
+            limits = ctx.limits()
+    return limits
+
+
+def run_download(spec, ctx):
+    """
+    The body of one download job: extract, download, post-process and move the
+    result into downloads/.
+
+    Runs either in a worker thread or in a worker process, so everything owned
+    by the API process (WebSocket clients, job state, caches, indexes) is
+    reached through `ctx` (see downloader.JobContext / workers.ChildContext).
+    Returns a result dict describing the outcome; raises on failure.
+    """
+    task_id = spec['task_id']
+    url = spec['url']
+    format_id = spec['format_id']
+    quality = spec['quality']
+    strict_mode = spec['strict_mode']
+    split_chapters = spec['split_chapters']
+
+    # We use the ID as the temporary filename to avoid collisions and special char issues in paths
+
+    # Progress goes through a per-task reporter that throttles yt-dlp's very chatty hook
+    reporter = ProgressReporter(task_id, ctx.publish, config.PROGRESS_MAX_HZ, ctx.counters)
+
+    # Track the file being written so /api/jobs/{id}/stream can tail it.
+    # Only plain single-format downloads are served progressively: merged
+    # formats, audio extraction and chapter splits rewrite the output afterwards.
+    progressive = format_id != 'thumbnail' and format_id not in AUDIO_FORMATS and not split_chapters
+    tracked = {'tmpfilename': None}
+
+    def track_file(d):
+        if d['status'] == 'downloading' and tracked['tmpfilename'] != d.get('tmpfilename'):
+            tracked['tmpfilename'] = d.get('tmpfilename')
+            ctx.update_state(
+                tmpfilename=d.get('tmpfilename') or d.get('filename'),
+                filepath=d.get('filename'),
+                streamable=progressive and 'requested_formats' not in (d.get('info_dict') or {})
+            )
+        elif d['status'] == 'finished':
+            ctx.update_state(complete=True)
+
+    # Every output of the job lands in its own folder under processing/
+    work_dir = os.path.join('processing', task_id)
+    chapters_dir = os.path.join(work_dir, 'chapters')
+
+    postprocess_started = {}
+    postprocess_seconds = {'total': 0.0}
+    encode_seconds = {'total': 0.0}
+    downloaded_bytes = {'total': 0}
+    limits_applied = {'at': time.monotonic()}
+
+    def follow_governor(d):
+        # Pick up the governor's latest allocation about once a second
+        now = time.monotonic()
+        if d['status'] == 'downloading' and now - limits_applied['at'] >= 1:
+            limits_applied['at'] = now
+            apply_limits(ydl.params, ctx.limits(), (d.get('info_dict') or {}).get('protocol'))
+
+    def count_bytes(d):
+        if d['status'] == 'finished' and d.get('filename') not in audio['linked']:
+            downloaded_bytes['total'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+
+    def track_postprocessor(d):
+        name = d.get('postprocessor')
+        if name == ReserveSpacePP.pp_key():
+            return  # Runs before the download, not part of post-processing
+        if d['status'] == 'started':
+            postprocess_started[name] = time.monotonic()
+            reporter.state('processing', postprocessor=name, percent=99)
+        elif d['status'] == 'finished' and name in postprocess_started:
+            elapsed = time.monotonic() - postprocess_started.pop(name)
+            postprocess_seconds['total'] += elapsed
+            if name == 'ExtractAudio':
+                encode_seconds['total'] += elapsed
+
+    # Audio jobs: which source stream each output is made from, see select_audio_source
+    audio = {'info': None, 'cached': {}, 'picks': [], 'linked': set()}
+
+    def select_audio_source(ctx_formats):
+        """
+        Format selector for audio jobs, cheapest source first:
+        1. a cached source that can be stream-copied to the requested format
+        2. an audio-only format that can be stream-copied (remux instead of encode)
+        3. any cached source, converted locally
+        4. bestaudio/best
+        A cached source is put where yt-dlp would download it, so it finds the
+        file already downloaded and goes straight to post-processing.
+        """
+        formats = ctx_formats['formats']
+        copyable = lambda f: stream_copyable(format_id, f.get('acodec'))
+        cached = [f for f in formats if f.get('format_id') in audio['cached']]
+        for candidates, from_cache in (
+            ([f for f in cached if copyable(f)], True),
+            ([f for f in formats if f.get('vcodec') == 'none' and copyable(f)], False),
+            (cached, True),
+        ):
+            if candidates:
+                chosen = candidates[-1]  # formats come sorted worst to best
+                if from_cache and not link_cached_source(chosen):
+                    from_cache = False
+                audio['picks'].append((chosen, from_cache))
+                yield chosen
+                return
+        for chosen in ydl.build_format_selector('bestaudio/best')(ctx_formats):
+            audio['picks'].append((chosen, False))
+            yield chosen
+
+    def link_cached_source(chosen):
+        target = ydl.prepare_filename(dict(audio['info'], **chosen))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            try:
+                os.link(audio['cached'][chosen['format_id']], target)
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copyfile(audio['cached'][chosen['format_id']], target)
+        except OSError as e:
+            # Expired and pruned in the meantime, it gets downloaded after all
+            print(f"Cached source for {url} unavailable: {e}")
+            return False
+        # yt-dlp still reports it as a finished download
+        audio['linked'].add(target)
+        return True
+
+    def keep_source(d):
+        info_dict = d.get('info_dict') or {}
+        if (d['status'] == 'finished' and d.get('filename') and d['filename'] not in audio['linked']
+                and 'requested_formats' not in info_dict):
+            source_cache.store(info_dict, info_dict.get('format_id'), d['filename'])
+
+    ydl_opts = {
+        'outtmpl': {
+            'default': os.path.join(work_dir, '%(id)s.%(ext)s'),
+            'chapter': os.path.join(chapters_dir, '%(id)s', '%(section_number)03d %(section_title)s.%(ext)s'),
+        },
+        # check_aborted first: the thread backend stops cancelled and overdue jobs from these hooks
+        'progress_hooks': [lambda d: ctx.check_aborted(), reporter.hook, track_file, count_bytes, follow_governor],
+        'postprocessor_hooks': [lambda d: ctx.check_aborted(), track_postprocessor],
+        'logger': JobLogger(ctx),
+        'quiet': False,
+        'no_warnings': False,
+        'continuedl': True,
+        'nocheckcertificate': True,
+        'retries': 10,
+        'fragment_retries': 10,
+        # Back off between retries instead of hammering a host that is already struggling
+        'retry_sleep_functions': {'http': retry_backoff, 'fragment': retry_backoff},
+        'noplaylist': strict_mode, # Strict Mode
+        'postprocessors': [],
+    }
+
+    if format_id == 'thumbnail':
+        ydl_opts['writethumbnail'] = True
+        ydl_opts['skip_download'] = True
+    elif format_id in AUDIO_FORMATS:
+        ydl_opts['format'] = select_audio_source
+        # Keep the source stream, converting the same media to another format won't download it again
+        ydl_opts['progress_hooks'].append(keep_source)
+        ydl_opts['postprocessors'].append({
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': format_id,
+            'preferredquality': '192',
+        })
+    else:
+         # Video Mode
+         # For Twitch/HLS, sometimes bestvideo+bestaudio causes chunk issues
+         # We will try to force a single format if possible or better merging
+         format_selector = 'bestvideo+bestaudio/best'
+
+         if quality == 'best':
+             format_selector = 'bestvideo+bestaudio/best'
+         elif quality == 'best_ios':
+             format_selector = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+         elif quality == 'worst':
+             format_selector = 'worstvideo+worstaudio/worst'
+         elif quality.endswith('p'):
+             height = quality[:-1]
+             format_selector = f'bestvideo[height<={height}]+bestaudio/best[height<={height}]'
+
+         ydl_opts['format'] = format_selector
+         ydl_opts['merge_output_format'] = 'mp4' if format_id == 'mp4' or format_id == 'any' else None
+
+    if split_chapters and format_id != 'thumbnail':
+        # Split Chapters (keeps the full file too)
+        ydl_opts['postprocessors'].append({
+            'key': 'FFmpegSplitChapters',
+            'force_keyframes': True, # Ensure clean cuts for chapters
+        })
+
+
+    # Instagram/Twitter specific headers or cookies might be needed here
+    # yt-dlp handles many automatically, but we can enhance it.
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl, reporter:
+        if format_id != 'thumbnail':
+            ydl.add_post_processor(
+                ReserveSpacePP(ctx, postprocessed=format_id in AUDIO_FORMATS or split_chapters), when='before_dl'
+            )
+
+        # 1. INITIALIZE & EXTRACT
+        # Broadcast immediately
+        reporter.state('initializing', percent=0)
+
+        # Extract once (or reuse a recent extraction) and hand the same info dict to the download
+        info = spec.get('cached_info')
+        if info is None:
+            extract_started = time.monotonic()
+            info = ydl.extract_info(url, download=False, process=False)
+            ctx.record_stage('extract', time.monotonic() - extract_started)
+            if is_cacheable(info):
+                ctx.cache_metadata(url, strict_mode, info)
+        if format_id in AUDIO_FORMATS:
+            audio['info'] = info
+            audio['cached'] = source_cache.lookup(info)
+        extractor = info.get('extractor_key') or info.get('ie_key') or 'unknown'
+        ctx.update_state(extractor=extractor)
+        # We don't use the video_id for the task ID anymore, but we can keep it for reference if needed
+        title = info.get('title') or 'video'
+
+        # Same media with the same options already downloaded (or downloading)? Reuse it.
+        key = artifact_key(info, format_id, quality, split_chapters)
+        if key:
+            outcome, detail = ctx.claim(key)
+            if outcome == 'done':
+                print(f"Reusing existing download for {url}: {', '.join(f['filename'] for f in detail)}")
+                return {'status': 'deduplicated', 'filename': detail[0]['filename'], 'file_size': detail[0]['file_size'],
+                        'files': detail}
+            if outcome == 'follow':
+                # The owner's job will report 'finished' for us as well
+                reporter.state('coalesced', filename=title, owner_id=detail, percent=0)
+                return {'status': 'coalesced', 'owner_id': detail}
+
+        # Update with title
+        reporter.state('starting', filename=title, percent=0)
+        # Fragment concurrency (HLS/DASH) and bandwidth as allotted by the governor
+        apply_limits(ydl.params, wait_for_connection(ctx, reporter))
+
+        # 2. DOWNLOAD (to processing folder)
+        process_started = time.monotonic()
+        try:
+            info = ydl.process_ie_result(info, download=True)
+        except InsufficientStorage as e:
+            if not e.wait:
+                raise
+            # Comes back later; the artifact key stays claimed by this job meanwhile
+            return {'status': 'deferred', 'reason': str(e)}
+        title = info.get('title') or title
+        # Post-processors run inside process_ie_result too
+        download_seconds = time.monotonic() - process_started - postprocess_seconds['total']
+        ctx.record_stage('download', download_seconds)
+        if postprocess_seconds['total']:
+            ctx.record_stage('postprocess', postprocess_seconds['total'])
+
+        # 3. COLLECT & MOVE (Atomic)
+        # yt-dlp runs ffmpeg synchronously, so by now every output is closed and reported in `info`
+        finalize_started = time.monotonic()
+        reporter.state('finalizing', percent=99)
+
+        files = []
+        for path, name_hint, entry in collect_outputs(info, chapters_dir):
+            ext = path.rsplit('.', 1)[-1]
+            safe_title = sanitize_filename(entry.get('title') or title)
+            name = f"{safe_title} - {name_hint}" if name_hint else f"{safe_title}.{ext}"
+            final_path = publish_file(path, name)
+            files.append({
+                'filename': os.path.basename(final_path),
+                'file_size': os.path.getsize(final_path),
+                'title': entry.get('title') or title,
+                'source_url': entry.get('webpage_url') or url,
+                'duration': entry.get('duration'),
+                'extractor': entry.get('extractor_key'),
+                'video_id': entry.get('id'),
+                'thumbnail': entry.get('thumbnail'),
+            })
+            # Double check size for logging
+            print(f"Success: {final_path} ({files[-1]['file_size']} bytes)")
+
+        if not files:
+            raise Exception("yt-dlp did not report any output file")
+
+        # Whatever is left (.ytdl state, intermediate formats) is no longer needed
+        shutil.rmtree(work_dir, ignore_errors=True)
+        finalize_seconds = round(time.monotonic() - finalize_started, 3)
+        ctx.record_stage('finalize', finalize_seconds)
+        print(f"Finalized {task_id} in {finalize_seconds}s ({len(files)} file(s))")
+
+        audio_result = None
+        if audio['picks']:
+            audio_result = {
+                'codec': format_id,
+                'mode': 'copy' if all(stream_copyable(format_id, f.get('acodec')) for f, _ in audio['picks']) else 'encode',
+                'source': 'cache' if any(from_cache for _, from_cache in audio['picks']) else 'download',
+                'encode_seconds': round(encode_seconds['total'], 3),
+            }
+
+        return {
+            'status': 'finished',
+            'filename': files[0]['filename'],
+            'file_size': files[0]['file_size'],
+            'files': files,
+            'finalize_seconds': finalize_seconds,
+            'postprocess_seconds': round(postprocess_seconds['total'], 3),
+            'extractor': extractor,
+            'downloaded_bytes': downloaded_bytes['total'],
+            'download_seconds': round(download_seconds, 3),
+            'audio': audio_result,
+        }
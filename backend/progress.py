@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+
+from socket_manager import manager
+
+# How many finished tasks keep their counters around for /api/progress/stats
+STATS_HISTORY = 200
+
+
+class ProgressStats:
+    """Per-task counters so the effect of throttling can be checked."""
+
+    def __init__(self):
+        self.tasks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def track(self, task_id):
+        counters = {'hook_calls': 0, 'sent': 0, 'coalesced': 0}
+        with self.lock:
+            self.tasks[task_id] = counters
+            self.tasks.move_to_end(task_id)
+            while len(self.tasks) > STATS_HISTORY:
+                self.tasks.popitem(last=False)
+        return counters
+
+    def snapshot(self, task_id=None):
+        with self.lock:
+            if task_id is not None:
+                counters = self.tasks.get(task_id)
+                return dict(counters) if counters else None
+            return {key: dict(value) for key, value in self.tasks.items()}
+
+
+progress_stats = ProgressStats()
+
+
+def publish_threadsafe(loop, message):
+    """Hand a message to the WebSocket manager from a worker thread."""
+    loop.call_soon_threadsafe(manager.publish, message)
+
+
+class ProgressReporter:
+    """
+    Progress pipeline for one task, called from the download thread (or worker process).
+
+    yt-dlp calls the progress hook many times per second per fragment; ticks
+    are coalesced so at most `max_hz` reach the event loop. A tick held back
+    goes out when its interval is up even if no other event follows (a slow
+    fragment, a stall), and every tick replaced by a newer one is counted as
+    coalesced. State changes (initializing, merging, finished, ...) always go
+    out immediately, after flushing any tick still held back.
+    """
+
+    def __init__(self, task_id, publish, max_hz, counters=None):
+        self.task_id = task_id
+        self.publish = publish  # delivers one message to the WebSocket manager, thread-safe
+        self.interval = 1.0 / max_hz if max_hz > 0 else 0
+        self.counters = counters if counters is not None else progress_stats.track(task_id)
+        self.last_sent = 0.0
+        self.held = None
+        self.flush_timer = None  # sends the held tick once its interval is up
+        self.lock = threading.Lock()
+
+    def hook(self, d):
+        """yt-dlp progress hook."""
+        self.counters['hook_calls'] += 1
+        if d['status'] == 'downloading':
+            self.tick(self._numeric(d))
+        elif d['status'] == 'finished':
+            # One requested format is fully on disk (there may be more to come before merging)
+            self.state('downloaded', **self._numeric(d))
+
+    def tick(self, fields):
+        message = {'type': 'progress', 'id': self.task_id, 'status': 'downloading', **fields}
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_sent < self.interval:
+                if self.held is not None:
+                    self.counters['coalesced'] += 1
+                self.held = message
+                if self.flush_timer is None:
+                    self.flush_timer = threading.Timer(self.last_sent + self.interval - now, self.flush)
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+                return
+            if self.held is not None:
+                # Superseded by this one
+                self.counters['coalesced'] += 1
+            self._take_held()
+            self.last_sent = now
+        self._send(message)
+
+    def flush(self):
+        """Send the tick held back, if any (its interval is up)."""
+        with self.lock:
+            held = self._take_held()
+            if held is not None:
+                self.last_sent = time.monotonic()
+        if held is not None:
+            self._send(held)
+
+    def state(self, status, **fields):
+        self.event({'type': 'progress', 'status': status, **fields})
+
+    def event(self, message):
+        message = {'id': self.task_id, **message}
+        with self.lock:
+            held = self._take_held()
+            self.last_sent = time.monotonic()
+        if held is not None:
+            self._send(held)
+        self._send(message)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # The job is over: a tick still held back is out of date, and must not follow the final message
+        with self.lock:
+            if self._take_held() is not None:
+                self.counters['coalesced'] += 1
+
+    def _take_held(self):
+        # With self.lock held
+        held, self.held = self.held, None
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        return held
+
+    def _send(self, message):
+        self.counters['sent'] += 1
+        self.publish(message)
+
+    @staticmethod
+    def _numeric(d):
+        downloaded = d.get('downloaded_bytes')
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        percent = None
+        if downloaded is not None and total:
+            percent = round(min(downloaded / total, 1.0) * 100, 1)
+        elif d['status'] == 'finished':
+            percent = 100.0
+        return {
+            'filename': d.get('filename'),  # This is the temp filename usually
+            'downloaded_bytes': downloaded,
+            'total_bytes': total,
+            'percent': percent,
+            'speed': d.get('speed'),  # bytes/s
+            'eta': d.get('eta'),  # seconds
+            'fragment_index': d.get('fragment_index'),
+            'fragment_count': d.get('fragment_count'),
+        }
@@ -0,0 +1,502 @@
+import asyncio
+import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from socket_manager import manager
+
+# Priorities are stored offset and zero-padded in the Redis queue so members sort as strings
+PRIORITY_OFFSET = 10 ** 9
+# Seconds a worker blocks on the shared queue per call, kept under redis-py's default socket timeout
+TAKE_TIMEOUT = 2
+
+
+class Job:
+    def __init__(self, task_id, params, client_id="anonymous", priority=0, seq=0, batch_id=None):
+        self.task_id = task_id
+        self.params = params  # job spec for pipeline.run_download
+        self.client_id = client_id or "anonymous"
+        self.priority = priority
+        self.seq = seq
+        self.batch_id = batch_id  # set for the entries of a batch/playlist request
+
+    def to_dict(self):
+        return {'task_id': self.task_id, 'params': self.params, 'client_id': self.client_id,
+                'priority': self.priority, 'seq': self.seq, 'batch_id': self.batch_id}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class LocalQueue:
+    """Jobs waiting for a slot of this process (BROKER_URL=memory://)."""
+
+    def __init__(self):
+        self.pending = []
+        self._seq = itertools.count(1)
+        self._dispatch_counter = itertools.count(1)
+        self._last_served = {}  # client_id -> dispatch counter of its last job
+        self._wakeup = asyncio.Condition()
+
+    async def sequence(self, count):
+        """`count` new sequence numbers, increasing in submission order."""
+        return [next(self._seq) for _ in range(count)]
+
+    async def put(self, jobs):
+        self.pending.extend(jobs)
+        async with self._wakeup:
+            self._wakeup.notify(len(jobs))
+
+    async def take(self):
+        """Wait for the next job in dispatch order and remove it from the queue."""
+        async with self._wakeup:
+            while not self.pending:
+                await self._wakeup.wait()
+            job = self._ordered()[0]
+            self.pending.remove(job)
+            self._last_served[job.client_id] = next(self._dispatch_counter)
+            return job
+
+    async def remove(self, task_id):
+        """Take a job out of the queue; the job, or None if it isn't queued."""
+        job = self._find(task_id)
+        if job is not None:
+            self.pending.remove(job)
+        return job
+
+    async def update_priority(self, task_id, priority):
+        job = self._find(task_id)
+        if job is None:
+            return False
+        job.priority = priority
+        return True
+
+    async def ordered(self):
+        return self._ordered()
+
+    # Only one process takes jobs from this queue, the job store's claim is all there is to it
+    async def claim(self, task_id, node):
+        return True
+
+    async def release(self, task_id, node):
+        return True
+
+    async def recover(self, task_id, node):
+        return True
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _find(self, task_id):
+        for job in self.pending:
+            if job.task_id == task_id:
+                return job
+        return None
+
+    def _ordered(self):
+        # Round number = how many jobs of the same client and priority are ahead of this one.
+        # Within a round, clients that were served least recently go first.
+        rounds = {}
+        keyed = []
+        for job in sorted(self.pending, key=lambda j: j.seq):
+            bucket = (job.client_id, job.priority)
+            round_no = rounds.get(bucket, 0)
+            rounds[bucket] = round_no + 1
+            keyed.append(((-job.priority, round_no, self._last_served.get(job.client_id, 0), job.seq), job))
+        keyed.sort(key=lambda item: item[0])
+        return [job for _, job in keyed]
+
+
+class RedisQueue:
+    """
+    The queue shared by every node of a RedisBroker.
+
+    A sorted set whose members ("<priority>|<round>|<seq>|<task id>", all
+    scores 0) sort in dispatch order, so BZPOPMIN hands each job to exactly
+    one node. The round is fixed when the job is queued (how many jobs of
+    the same client and priority were waiting), which keeps the round-robin
+    between clients; unlike LocalQueue, ties within a round go by seq.
+
+    Which node runs a job is decided here too, not by the job store (SQLite
+    on the shared DATA_DIR, whose locking can't be trusted on network
+    filesystems): a node claims a job it popped before running it, and of
+    the nodes requeueing a dead node's job only the one that takes over its
+    claim does. The owners hash maps task ids to the claiming node, or to ""
+    for a job recovered and not claimed again yet.
+    """
+
+    def __init__(self, broker):
+        import redis
+        self.redis = broker.redis
+        # For the metrics gauge, read from a scrape thread outside the event loop
+        self.sync_redis = redis.Redis.from_url(broker.url, decode_responses=True)
+        self.key = broker.key("queue")
+        self.members = broker.key("queue", "members")  # task_id -> sorted set member
+        self.jobs = broker.key("queue", "jobs")  # task_id -> Job.to_dict()
+        self.rounds = broker.key("queue", "rounds")  # "<priority>|<client>" -> jobs waiting
+        self.seq = broker.key("queue", "seq")
+        self.owners = broker.key("queue", "owners")  # task_id -> node running it
+
+    async def sequence(self, count):
+        last = await self.redis.incrby(self.seq, count)
+        return list(range(last - count + 1, last + 1))
+
+    async def put(self, jobs):
+        for job in jobs:
+            # A job already queued (e.g. restored by two nodes starting together) is left where it is
+            if not await self.redis.hsetnx(self.members, job.task_id, ""):
+                continue
+            round_no = await self.redis.hincrby(self.rounds, self._bucket(job), 1) - 1
+            priority = max(-PRIORITY_OFFSET + 1, min(PRIORITY_OFFSET - 1, job.priority))
+            member = f"{PRIORITY_OFFSET - priority:010d}|{round_no:08d}|{job.seq:016d}|{job.task_id}"
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(self.jobs, job.task_id, json.dumps(job.to_dict()))
+                pipe.hset(self.members, job.task_id, member)
+                pipe.zadd(self.key, {member: 0})
+                await pipe.execute()
+
+    async def take(self):
+        while True:
+            try:
+                popped = await self.redis.bzpopmin(self.key, timeout=TAKE_TIMEOUT)
+                if popped:
+                    job = await self._forget(popped[1].rsplit("|", 1)[1])
+                    if job is not None:
+                        return job
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Could not take a job from the shared queue: {e!r}")
+                await asyncio.sleep(1)
+
+    async def remove(self, task_id):
+        member = await self.redis.hget(self.members, task_id)
+        # Whoever removes the member from the sorted set owns the job (another node may be taking it)
+        if not member or not await self.redis.zrem(self.key, member):
+            return None
+        # Cancelled after being recovered from a dead node, nobody is going to claim it
+        await self.release(task_id, "")
+        return await self._forget(task_id)
+
+    async def update_priority(self, task_id, priority):
+        job = await self.remove(task_id)
+        if job is None:
+            return False
+        job.priority = priority
+        await self.put([job])
+        return True
+
+    async def reclaim(self, task_ids):
+        """
+        Those of `task_ids` that are not in the queue, with what is left of
+        them cleared so they can be put back: a node may have died between
+        popping a job and claiming it, or lost the reply to its pop.
+        """
+        if not task_ids:
+            return []
+        members = await self.redis.hmget(self.members, task_ids)
+        missing = []
+        for task_id, member in zip(task_ids, members):
+            if member and await self.redis.zscore(self.key, member) is not None:
+                continue
+            if member is not None:
+                await self._forget(task_id)
+            missing.append(task_id)
+        return missing
+
+    async def claim(self, task_id, node):
+        """Make `node` the one running a job it took. False if another node holds it."""
+        return await self._swap_owner(task_id, lambda owner: not owner, node)
+
+    async def release(self, task_id, node):
+        """Drop `node`'s claim on a job that stopped running there (finished, failed, deferred)."""
+        return await self._swap_owner(task_id, lambda owner: owner == node, None)
+
+    async def recover(self, task_id, node):
+        """
+        Take over the claim of `node` (which stopped) to queue its job again.
+        True for exactly one of the nodes trying at once. A running job without
+        a claim (the server lost it) goes to whichever node asks first.
+        """
+        return await self._swap_owner(task_id, lambda owner: owner is None or owner == node, "")
+
+    async def _swap_owner(self, task_id, expected, owner):
+        """Set (None: delete) the owner of `task_id` if `expected(current owner)`, atomically. Returns whether it did."""
+        import redis
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(self.owners)
+                    if not expected(await pipe.hget(self.owners, task_id)):
+                        await pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    if owner is None:
+                        pipe.hdel(self.owners, task_id)
+                    else:
+                        pipe.hset(self.owners, task_id, owner)
+                    await pipe.execute()
+                    return True
+                except redis.WatchError:
+                    # Another claim changed in the meantime, look again
+                    continue
+
+    async def ordered(self):
+        members = await self.redis.zrange(self.key, 0, -1)
+        if not members:
+            return []
+        values = await self.redis.hmget(self.jobs, [member.rsplit("|", 1)[1] for member in members])
+        return [Job.from_dict(json.loads(value)) for value in values if value]
+
+    def __len__(self):
+        return self.sync_redis.zcard(self.key)
+
+    async def _forget(self, task_id):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hget(self.jobs, task_id)
+            pipe.hdel(self.jobs, task_id)
+            pipe.hdel(self.members, task_id)
+            value = (await pipe.execute())[0]
+        if value is None:
+            return None
+        job = Job.from_dict(json.loads(value))
+        await self.redis.hincrby(self.rounds, self._bucket(job), -1)
+        return job
+
+    @staticmethod
+    def _bucket(job):
+        return f"{job.priority}|{job.client_id}"
+
+
+class DownloadScheduler:
+    """
+    Bounded job queue in front of the download workers.
+
+    Jobs are ordered by priority (higher first), then round-robin across
+    clients so a single client queueing fifty URLs can't starve everyone
+    else, then FIFO. Every change is recorded in the job store so a
+    restart picks the queue back up.
+
+    With a shared broker the queue lives in Redis and this node's workers
+    take jobs from it alongside the other nodes'. Redis also decides which
+    node runs (or requeues) a job, see RedisQueue; the job store on the
+    shared DATA_DIR records the outcome.
+    """
+
+    def __init__(self, runner, max_workers, store, broker, max_attempts):
+        self.runner = runner
+        self.max_workers = max_workers
+        self.store = store
+        self.broker = broker
+        self.max_attempts = max_attempts
+        self.queue = RedisQueue(broker) if broker.shared else LocalQueue()
+        # An API-only node (no download slots) never runs anything itself
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download") if max_workers else None
+        self.running = {}
+        self.loop = None
+        self._announced = {}  # task_id -> last queue position sent to clients
+        self._workers = []
+
+    async def start(self, loop):
+        if self.loop is not None:
+            return
+        self.loop = loop
+        await self._restore()
+        for _ in range(self.max_workers):
+            self._workers.append(loop.create_task(self._worker()))
+        if self.broker.shared:
+            loop.create_task(self._watch_nodes())
+
+    # --- Queue operations (event loop only) ---
+
+    async def submit(self, task_id, params, client_id=None, priority=0):
+        jobs = await self.submit_many([(task_id, params)], client_id, priority)
+        return jobs[0]
+
+    async def submit_many(self, entries, client_id=None, priority=0, batch_id=None):
+        """Queue several jobs at once, announcing queue positions only once. `entries` are (task_id, params) pairs."""
+        seqs = await self.queue.sequence(len(entries))
+        jobs = [Job(task_id, params, client_id, priority, seq, batch_id) for (task_id, params), seq in zip(entries, seqs)]
+        for job in jobs:
+            manager.register_task(job.task_id, job.client_id, batch_id)
+        self.store.create_many([
+            (job.task_id, job.params, job.client_id, job.priority, job.seq, batch_id) for job in jobs
+        ])
+        await self.queue.put(jobs)
+        await self._announce_positions()
+        return jobs
+
+    async def cancel(self, task_id):
+        job = await self.queue.remove(task_id)
+        if job is None:
+            return False
+        self._announced.pop(task_id, None)
+        self.store.set_state(task_id, 'cancelled')
+        await manager.broadcast({
+            'type': 'cancelled',
+            'id': task_id,
+            'status': 'cancelled'
+        })
+        await self._announce_positions()
+        return True
+
+    def defer(self, job, delay, retry=False, error=None):
+        """
+        Queue a job that couldn't run yet (or, `retry`, failed and gets another
+        attempt) again in `delay` seconds. Callable from the worker threads.
+        """
+        self.store.defer(job.task_id, job.seq, time.time() + delay, refund=not retry, error=error)
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, lambda: self.loop.create_task(self._requeue(job)))
+
+    def release_threadsafe(self, task_id):
+        """Drop this node's claim on a job that is over. Callable from the worker threads."""
+        asyncio.run_coroutine_threadsafe(self.queue.release(task_id, self.broker.node_id), self.loop)
+
+    async def resume(self, task_ids):
+        """Queue the given unfinished jobs again, e.g. the followers of a job that stopped before producing their file."""
+        rows = [row for row in map(self.store.get, task_ids) if row is not None]
+        if await self._resume(rows):
+            await self._announce_positions()
+
+    async def _requeue(self, job):
+        row = self.store.get(job.task_id)
+        if row is None or row['state'] != 'queued':
+            return  # Cancelled while waiting
+        job.seq = (await self.queue.sequence(1))[0]
+        self.store.requeue(job.task_id, job.seq)
+        await self.queue.put([job])
+        await self._announce_positions()
+
+    async def reprioritize(self, task_id, priority):
+        if not await self.queue.update_priority(task_id, priority):
+            return False
+        self.store.set_priority(task_id, priority)
+        await self._announce_positions()
+        return True
+
+    async def position(self, task_id):
+        """1-based place of a job in the queue, or None if it isn't queued."""
+        for position, job in enumerate(await self.queue.ordered(), start=1):
+            if job.task_id == task_id:
+                return position
+        return None
+
+    async def snapshot(self):
+        return {
+            "max_workers": self.max_workers,
+            # From the job store, which covers the jobs other nodes are running too
+            "running": [
+                {"id": job['id'], "client_id": job['client_id'], "priority": job['priority'],
+                 "url": job['params'].get("url"), "node": job['node']}
+                for job in self.store.running()
+            ],
+            "pending": [
+                {"id": job.task_id, "position": position, "client_id": job.client_id,
+                 "priority": job.priority, "url": job.params.get("url")}
+                for position, job in enumerate(await self.queue.ordered(), start=1)
+            ],
+        }
+
+    # --- Internals ---
+
+    async def _announce_positions(self):
+        for position, job in enumerate(await self.queue.ordered(), start=1):
+            if self._announced.get(job.task_id) == position:
+                continue
+            self._announced[job.task_id] = position
+            # The job may have been queued through another node
+            manager.register_task(job.task_id, job.client_id, job.batch_id)
+            await manager.broadcast({
+                'type': 'progress',
+                'id': job.task_id,
+                'status': 'queued',
+                'queue_position': position,
+                'percent': 0
+            })
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.take()
+            self._announced.pop(job.task_id, None)
+            node = self.broker.node_id
+            # Already picked up by another node (shared queue), or cancelled meanwhile
+            if not await self.queue.claim(job.task_id, node):
+                continue
+            if not self.store.mark_running(job.task_id, node):
+                await self.queue.release(job.task_id, node)
+                continue
+            manager.register_task(job.task_id, job.client_id, job.batch_id)
+            self.running[job.task_id] = job
+            await self._announce_positions()
+            try:
+                await self.loop.run_in_executor(self.executor, self.runner, job)
+            except Exception as e:
+                print(f"Worker error on {job.task_id}: {e}")
+                self.store.set_state(job.task_id, 'error', error=str(e))
+            finally:
+                self.running.pop(job.task_id, None)
+            # A job waiting on another one's download stays this node's until release_threadsafe
+            row = self.store.get(job.task_id)
+            if row is None or row['state'] != 'coalesced':
+                await self.queue.release(job.task_id, node)
+
+    async def _restore(self):
+        saved = self.store.unfinished()
+        if self.broker.shared:
+            # Jobs running on other live nodes are theirs; what we were running before a restart is not
+            alive = await self.broker.alive_nodes() - {self.broker.node_id}
+            saved = [row for row in saved if row['state'] == 'queued' or row['node'] not in alive]
+        restored = await self._resume(saved)
+        if restored:
+            print(f"Restored {restored} queued download(s)")
+            await self._announce_positions()
+
+    async def _watch_nodes(self):
+        """Queue the jobs of nodes that stopped sending heartbeats again, and queued jobs that got lost on the way to one."""
+        while True:
+            await asyncio.sleep(self.broker.timeout)
+            try:
+                alive = await self.broker.alive_nodes()
+                # Deferred and retried jobs are out of the queue until their retry_at on purpose, hence the grace period
+                settled = time.time() - 2 * self.broker.timeout
+                orphaned = [
+                    row for row in self.store.unfinished()
+                    if (max(row['updated'], row['retry_at'] or 0) < settled if row['state'] == 'queued' else row['node'] not in alive)
+                ]
+                recovered = await self._resume(orphaned)
+                if recovered:
+                    print(f"Recovered {recovered} job(s) from unresponsive node(s)")
+                    await self._announce_positions()
+            except Exception as e:
+                print(f"Could not check on the other nodes: {e!r}")
+
+    async def _resume(self, rows):
+        """Queue unfinished jobs from the job store again, in their original order. Returns how many were."""
+        if self.broker.shared:
+            # Queued jobs normally are in the shared queue already
+            queued = [row['id'] for row in rows if row['state'] == 'queued']
+            missing = set(await self.queue.reclaim(queued))
+            rows = [row for row in rows if row['state'] != 'queued' or row['id'] in missing]
+        jobs = []
+        for row in rows:
+            if row['attempts'] >= self.max_attempts:
+                print(f"Giving up on {row['id']} after {row['attempts']} interrupted attempts")
+                self.store.set_state(row['id'], 'error', error=f"Interrupted {row['attempts']} times, giving up")
+                continue
+            job = Job(row['id'], row['params'], row['client_id'], row['priority'], row['seq'], row['batch_id'])
+            if not self.broker.shared:
+                job.seq = (await self.queue.sequence(1))[0]
+                self.store.requeue(job.task_id, job.seq)
+            elif row['state'] != 'queued':
+                # Another node recovered it first, or it is already running again
+                if not await self.queue.recover(job.task_id, row['node']):
+                    continue
+                job.seq = (await self.queue.sequence(1))[0]
+                if not self.store.recover(job.task_id, job.seq, row['node']):
+                    continue
+            manager.register_task(job.task_id, job.client_id, job.batch_id)
+            jobs.append(job)
+        await self.queue.put(jobs)
+        return len(jobs)
@@ -1,20 +1,176 @@
-from typing import List
+import asyncio
+import itertools
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
 from fastapi import WebSocket
 
+import config
+import metrics
+from broker import broker
+
+
+class Connection:
+    """One WebSocket plus its subscriptions and outgoing queue."""
+
+    def __init__(self, websocket: WebSocket, max_queue: int):
+        self.websocket = websocket
+        self.topics = set()
+        self.max_queue = max_queue
+        # Keyed so that a newer progress tick for a task replaces the one still waiting to be sent
+        self.pending = OrderedDict()
+        self.ready = asyncio.Event()
+        self.sender: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    def wants(self, topics):
+        # Connections that never subscribed to anything get everything (legacy clients)
+        return not self.topics or bool(self.topics & topics)
+
+    def enqueue(self, key, message):
+        queued_at = time.monotonic()
+        if key in self.pending:
+            # The replacement keeps the replaced message's place in the lag measurement
+            queued_at = self.pending.pop(key)[0]
+        elif len(self.pending) >= self.max_queue:
+            self._drop_one()
+        self.pending[key] = (queued_at, message)
+        self.ready.set()
+
+    def _drop_one(self):
+        # Prefer dropping a stale progress tick over a state change
+        for key in self.pending:
+            if key[0] in ('progress', 'batch_progress'):
+                del self.pending[key]
+                break
+        else:
+            self.pending.popitem(last=False)
+        self.dropped += 1
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, max_queue: int = 100, send_timeout: float = 10.0):
+        self.active_connections: Dict[WebSocket, Connection] = {}
+        self.task_clients: Dict[str, str] = {}  # task_id -> client_id, for session subscriptions
+        self.task_batches: Dict[str, str] = {}  # task_id -> batch_id, for batch subscriptions
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self._seq = itertools.count()
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, client_id: str = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
-        await websocket.send_json({"type": "connected", "data": "Ready"})
+        connection = Connection(websocket, self.max_queue)
+        if client_id:
+            connection.topics.add(f"client:{client_id}")
+        self.active_connections[websocket] = connection
+        connection.sender = asyncio.create_task(self._sender(connection))
+        connection.enqueue(('control', next(self._seq)), {"type": "connected", "data": "Ready"})
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
+        if connection and connection.sender and connection.sender is not asyncio.current_task():
+            connection.sender.cancel()
+
+    def register_task(self, task_id: str, client_id: str, batch_id: str = None):
+        if client_id:
+            self.task_clients[task_id] = client_id
+        if batch_id:
+            self.task_batches[task_id] = batch_id
+
+    async def handle_message(self, websocket: WebSocket, text: str):
+        """
+        Apply a subscription command sent by the client:
+        {"action": "subscribe", "topics": ["task:<id>", "client:<id>", "batch:<id>"]}
+        {"action": "unsubscribe", "topics": [...]}
+        Anything else (e.g. keepalive pings) is ignored.
+        """
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return
+        try:
+            command = json.loads(text)
+        except ValueError:
+            return
+        if not isinstance(command, dict):
+            return
+        topics = set(command.get("topics") or [])
+        if command.get("task_id"):
+            topics.add(f"task:{command['task_id']}")
+        if command.get("client_id"):
+            topics.add(f"client:{command['client_id']}")
+        if command.get("batch_id"):
+            topics.add(f"batch:{command['batch_id']}")
+
+        if command.get("action") == "subscribe":
+            connection.topics |= topics
+        elif command.get("action") == "unsubscribe":
+            connection.topics -= topics
+        else:
+            return
+        connection.enqueue(('control', next(self._seq)), {"type": "subscriptions", "topics": sorted(connection.topics)})
+
+    def publish(self, message: dict):
+        """Queue a message for every interested connection, on this node and the others, without waiting on any socket."""
+        topics = self._topics(message)
+        broker.publish('message', message=message, topics=sorted(topics))
+        self._deliver(message, topics)
+
+    def deliver(self, event: dict):
+        """A message published on another node; the sender knows who runs the task, we may know who asked for it."""
+        self._deliver(event['message'], set(event['topics']) | self._topics(event['message']))
+
+    def _topics(self, message: dict):
+        task_id = message.get('id')
+        topics = set()
+        if task_id:
+            topics.add(f"task:{task_id}")
+            client_id = self.task_clients.get(task_id)
+            if client_id:
+                topics.add(f"client:{client_id}")
+            batch_id = message.get('batch_id') or self.task_batches.get(task_id)
+            if batch_id:
+                topics.add(f"batch:{batch_id}")
+        return topics
+
+    def _deliver(self, message: dict, topics: set):
+        task_id = message.get('id')
+        if message.get('type') in ('progress', 'batch_progress') and task_id:
+            key = (message['type'], task_id)
+        else:
+            key = ('event', next(self._seq))
+
+        for connection in self.active_connections.values():
+            if connection.wants(topics):
+                connection.enqueue(key, message)
+
+        if message.get('type') in ('finished', 'error', 'cancelled') or \
+                (message.get('type') == 'batch_progress' and message.get('done')):
+            self.task_clients.pop(task_id, None)
+            self.task_batches.pop(task_id, None)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+        self.publish(message)
+
+    async def _sender(self, connection: Connection):
+        try:
+            while True:
+                await connection.ready.wait()
+                connection.ready.clear()
+                while connection.pending:
+                    _, (queued_at, message) = connection.pending.popitem(last=False)
+                    await asyncio.wait_for(connection.websocket.send_json(message), self.send_timeout)
+                    metrics.websocket_send_lag.observe(time.monotonic() - queued_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Dead or hopelessly slow socket, stop tracking it
+            print(f"Dropping WebSocket client: {e!r}")
+            self.disconnect(connection.websocket)
+            try:
+                await connection.websocket.close()
+            except Exception:
+                pass
 
-manager = ConnectionManager()
+manager = ConnectionManager(config.WS_SEND_QUEUE_SIZE, config.WS_SEND_TIMEOUT)
+broker.subscribe('message', manager.deliver)
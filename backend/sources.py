@@ -0,0 +1,123 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from urllib.parse import quote, unquote
+
+import config
+
+# Target audio format -> source codec it can be stream-copied from (wav is always encoded)
+COPYABLE_CODECS = {'m4a': 'mp4a', 'opus': 'opus', 'mp3': 'mp3', 'flac': 'flac'}
+
+ENTRY_RE = re.compile(r'^(\d+)-(.+)\.([^.]+)$')
+
+
+def stream_copyable(target, acodec):
+    """Whether FFmpegExtractAudio can produce `target` from an `acodec` stream without re-encoding."""
+    codec = (acodec or '').split('.')[0].lower()
+    if codec == 'aac':
+        codec = 'mp4a'
+    return COPYABLE_CODECS.get(target) == codec
+
+
+class SourceCache:
+    """
+    Source streams downloaded by audio jobs, kept for `ttl` seconds so other
+    output formats of the same media are converted from the local copy
+    instead of being downloaded again.
+
+    Lives on disk only, so worker processes use it directly:
+    <path>/<hash of extractor:id>/<stored at>-<format id>.<ext>
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.last_prune = 0.0
+        self.lock = threading.Lock()
+
+    def _dir(self, info):
+        extractor = info.get('extractor_key') or info.get('extractor')
+        video_id = info.get('id')
+        if self.ttl <= 0 or not extractor or not video_id:
+            return None
+        return os.path.join(self.path, hashlib.sha1(f"{extractor}:{video_id}".encode()).hexdigest())
+
+    def _entries(self, directory):
+        """(stored_at, format_id, path) of every file in a media folder."""
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            match = ENTRY_RE.match(name)
+            if match:
+                yield int(match.group(1)), unquote(match.group(2)), os.path.join(directory, name)
+
+    def lookup(self, info):
+        """{format_id: path} of the fresh cached sources of a video."""
+        if not info or info.get('_type', 'video') != 'video':
+            return {}
+        directory = self._dir(info)
+        if directory is None:
+            return {}
+        now = time.time()
+        return {
+            format_id: path for stored_at, format_id, path in self._entries(directory)
+            if now - stored_at < self.ttl
+        }
+
+    def store(self, info, format_id, path):
+        """Keep a copy of the source stream `path` (format `format_id` of `info`'s video)."""
+        directory = self._dir(info)
+        if directory is None or not format_id or not os.path.exists(path):
+            return
+        os.makedirs(directory, exist_ok=True)
+        ext = os.path.splitext(path)[1].lstrip('.') or 'bin'
+        staged = os.path.join(directory, f".{uuid.uuid4().hex}.partial")
+        try:
+            # A hard link costs nothing when processing/ and the cache share a filesystem
+            try:
+                os.link(path, staged)
+            except OSError:
+                shutil.copyfile(path, staged)
+            for _, cached_format, old_path in self._entries(directory):
+                if cached_format == format_id:
+                    os.remove(old_path)
+            os.replace(staged, os.path.join(directory, f"{int(time.time())}-{quote(format_id, safe='')}.{ext}"))
+        except OSError as e:
+            print(f"Could not cache source stream {path}: {e}")
+            if os.path.exists(staged):
+                os.remove(staged)
+        if time.monotonic() - self.last_prune > 60:
+            self.prune()
+
+    def prune(self, max_age=None):
+        """Remove sources older than `max_age` (default: the TTL) and empty folders; returns how many files were removed."""
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            self.last_prune = time.monotonic()
+            if not os.path.isdir(self.path):
+                return 0
+            removed = 0
+            now = time.time()
+            for name in os.listdir(self.path):
+                directory = os.path.join(self.path, name)
+                for stored_at, _, path in self._entries(directory):
+                    if now - stored_at >= max_age:
+                        try:
+                            os.remove(path)
+                            removed += 1
+                        except OSError:
+                            pass
+                try:
+                    os.rmdir(directory)  # Only succeeds once the folder is empty
+                except OSError:
+                    pass
+            return removed
+
+
+source_cache = SourceCache(config.SOURCE_CACHE_DIR, config.SOURCE_CACHE_TTL)
@@ -0,0 +1,234 @@
+import os
+import shutil
+import threading
+import time
+
+import config
+from artifacts import artifact_index
+from library import library
+from sources import source_cache
+
+MB = 1024 * 1024
+
+
+def dir_size(path):
+    """Bytes used by the files under `path` (0 if it doesn't exist)."""
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def newest_mtime(path):
+    """Most recent modification time of `path` or anything under it."""
+    newest = os.lstat(path).st_mtime
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime)
+            except OSError:
+                pass
+    return newest
+
+
+class StorageManager:
+    """
+    Keeps downloads/, processing/ and the source cache within the quota and
+    the volume from filling up.
+
+    - Running jobs reserve the space their selected formats are expected to
+      take before downloading them (`reserve`); a job that doesn't fit waits
+      for running jobs to finish if that would make room, and fails otherwise.
+    - Downloads are evicted least recently fetched first when space runs out,
+      and after RETENTION_DAYS without being fetched, but only once a quota
+      or a retention period is configured: the free-space floor alone never
+      deletes anyone's downloads, it only turns new jobs away.
+    - The janitor (`clean`) does the above periodically and removes what
+      failed and cancelled jobs left in processing/.
+    """
+
+    def __init__(self, quota, min_free, retention_days, downloads_dir="downloads", processing_dir="processing"):
+        self.quota = quota  # bytes, 0 = none
+        self.min_free = min_free
+        self.retention = retention_days * 86400
+        # Downloads are only ever deleted to make room if the operator asked for managed storage
+        self.may_evict = bool(quota or retention_days)
+        self.downloads_dir = downloads_dir
+        self.processing_dir = processing_dir
+        self.reservations = {}  # task_id -> bytes reserved
+        self.lock = threading.RLock()
+        self.evicted = {'files': 0, 'bytes': 0}
+        self.cleaned = {'items': 0, 'bytes': 0}
+        self.last_clean = None
+
+    def usage(self):
+        downloads = library.total_size()
+        processing = dir_size(self.processing_dir)
+        sources = dir_size(source_cache.path)
+        return {
+            'downloads': downloads,
+            'processing': processing,
+            'sources': sources,
+            'total': downloads + processing + sources,
+            'free': shutil.disk_usage(self.downloads_dir).free,
+        }
+
+    def _outstanding(self, exclude=None):
+        """Space reserved by running jobs that they haven't written yet."""
+        return sum(
+            max(0, size - dir_size(os.path.join(self.processing_dir, task_id)))
+            for task_id, size in self.reservations.items() if task_id != exclude
+        )
+
+    def room(self, usage=None, exclude=None):
+        """Bytes a new download may still take, after what running jobs have reserved."""
+        usage = usage or self.usage()
+        room = usage['free'] - self.min_free
+        if self.quota:
+            room = min(room, self.quota - usage['total'])
+        return room - self._outstanding(exclude)
+
+    def reserve(self, task_id, size):
+        """
+        Reserve `size` more bytes for a running job. Returns (outcome, message):
+        'ok' when reserved (after evicting old downloads if needed), 'wait'
+        when it would fit once the other running jobs are done, 'full' otherwise.
+        """
+        with self.lock:
+            usage = self.usage()
+            room = self.room(usage)
+            # Only evict when that is enough on its own, a job that can't fit must not empty the library first
+            evictable = usage['sources'] + (usage['downloads'] if self.may_evict else 0)
+            if room < size <= room + evictable:
+                self.evict(size - room)
+                room = self.room()
+            if size <= room:
+                self.reservations[task_id] = self.reservations.get(task_id, 0) + size
+                return 'ok', None
+            message = f"Not enough disk space: needs {size / MB:.0f} MB, {max(room, 0) / MB:.0f} MB available"
+            if size <= room + evictable + self._outstanding(exclude=task_id):
+                return 'wait', message
+            return 'full', message
+
+    def release(self, task_id):
+        with self.lock:
+            self.reservations.pop(task_id, None)
+
+    def evict(self, needed, protected=()):
+        """
+        Remove cached sources, then downloads least recently fetched first
+        (if eviction is enabled, see may_evict), until `needed` bytes are freed.
+        """
+        freed = 0
+        # Cached source streams go first, they only save a re-download
+        before = dir_size(source_cache.path)
+        if needed > 0 and source_cache.prune(max_age=0):
+            freed = before - dir_size(source_cache.path)
+        if not self.may_evict:
+            return freed
+        for filename, size, last_used in library.least_recently_used():
+            if freed >= needed:
+                break
+            if filename not in protected and self._remove_download(filename, size):
+                freed += size
+                print(f"Evicted {filename} ({size / MB:.0f} MB, last used {time.ctime(last_used)}) to free space")
+        return freed
+
+    def expire(self):
+        """Remove downloads nobody fetched for RETENTION_DAYS."""
+        if not self.retention:
+            return 0
+        removed = 0
+        for filename, size, _ in library.least_recently_used(before=time.time() - self.retention):
+            if self._remove_download(filename, size):
+                removed += 1
+        if removed:
+            print(f"Removed {removed} download(s) unused for {self.retention // 86400} days")
+        return removed
+
+    def _remove_download(self, filename, size):
+        try:
+            os.remove(os.path.join(self.downloads_dir, filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Could not remove {filename}: {e}")
+            return False
+        library.remove(filename)
+        artifact_index.forget(filename)
+        self.evicted['files'] += 1
+        self.evicted['bytes'] += size
+        return True
+
+    def clean_processing(self, in_use, grace=300):
+        """Remove items in processing/ that belong to no running or queued job and weren't touched for `grace` seconds."""
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self.processing_dir):
+            if name in in_use:
+                continue
+            path = os.path.join(self.processing_dir, name)
+            try:
+                if now - newest_mtime(path) < grace:
+                    continue
+                size = dir_size(path) if os.path.isdir(path) else os.lstat(path).st_size
+            except OSError:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+            removed += 1
+            self.cleaned['items'] += 1
+            self.cleaned['bytes'] += size
+        if removed:
+            print(f"Janitor removed {removed} stale item(s) from {self.processing_dir}/")
+        return removed
+
+    def clean(self, in_use):
+        """One janitor pass: stale partials, expired sources and downloads, then the quota."""
+        with self.lock:
+            self.clean_processing(in_use)
+            source_cache.prune()
+            self.expire()
+            self.enforce()
+            self.last_clean = time.time()
+
+    def enforce(self, protected=()):
+        """Evict downloads while usage is over the quota or the free-space floor."""
+        with self.lock:
+            room = self.room()
+            if room < 0:
+                self.evict(-room, protected)
+
+    def admit(self):
+        """Whether new jobs are accepted at all: there is some room left, after evicting if need be."""
+        with self.lock:
+            room = self.room()
+            if room <= 0:
+                self.evict(1 - room)
+                room = self.room()
+            return room > 0
+
+    def stats(self):
+        with self.lock:
+            usage = self.usage()
+            return {
+                'quota': self.quota or None,
+                'min_free': self.min_free,
+                'retention_days': self.retention // 86400 or None,
+                'eviction': self.may_evict,
+                'usage': usage,
+                'room': self.room(usage),
+                'reserved': dict(self.reservations),
+                'evicted': dict(self.evicted),
+                'cleaned': dict(self.cleaned),
+                'last_clean': self.last_clean,
+            }
+
+
+storage = StorageManager(config.STORAGE_QUOTA_MB * MB, config.MIN_FREE_SPACE_MB * MB, config.RETENTION_DAYS)
@@ -0,0 +1,251 @@
+import asyncio
+import mimetypes
+import os
+import re
+import zipfile
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+import anyio
+from starlette.responses import Response
+
+import metrics
+
+CHUNK_SIZE = 256 * 1024
+
+# Types mimetypes doesn't know (or gets wrong) on slim images
+MEDIA_TYPES = {
+    "mp4": "video/mp4",
+    "m4v": "video/mp4",
+    "mkv": "video/x-matroska",
+    "webm": "video/webm",
+    "mov": "video/quicktime",
+    "mp3": "audio/mpeg",
+    "m4a": "audio/mp4",
+    "opus": "audio/ogg",
+    "ogg": "audio/ogg",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def media_type_for(filename):
+    ext = filename.rsplit(".", 1)[-1].lower()
+    return MEDIA_TYPES.get(ext) or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def file_etag(stat):
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    """
+    Parse a single `bytes=` range. Returns (start, end) inclusive, None when the
+    header should be ignored (absent, multiple ranges, other units) and raises
+    ValueError when the range can't be satisfied.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+def content_disposition(filename, inline=False):
+    kind = "inline" if inline else "attachment"
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{kind}; filename*=utf-8''{quoted}"
+    return f'{kind}; filename="{filename}"'
+
+
+def _not_modified_since(header, mtime):
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+class RangeFileResponse(Response):
+    """
+    File response with Range/If-Range, ETag/Last-Modified conditional requests
+    and zero-copy transmission when the ASGI server supports it.
+    """
+
+    def __init__(self, request, path, filename=None, inline=False):
+        self.path = path
+        stat = os.stat(path)
+        size = stat.st_size
+        filename = filename or os.path.basename(path)
+        etag = file_etag(stat)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+        self.send_body = request.method != "HEAD"
+        self.extensions = request.scope.get("extensions") or {}
+        self.start, self.end = 0, size - 1
+        status_code = 200
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": last_modified,
+            "content-disposition": content_disposition(filename, inline),
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if (if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]) or \
+                (not if_none_match and request.headers.get("if-modified-since")
+                 and _not_modified_since(request.headers["if-modified-since"], stat.st_mtime)):
+            status_code = 304
+            self.send_body = False
+            headers.pop("content-disposition")
+        else:
+            if_range = request.headers.get("if-range")
+            range_header = request.headers.get("range")
+            # A stale validator in If-Range means "send me the whole thing"
+            if if_range and if_range != etag and if_range != last_modified:
+                range_header = None
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                byte_range = None
+                status_code = 416
+                self.send_body = False
+                headers["content-range"] = f"bytes */{size}"
+                headers["content-length"] = "0"
+            if byte_range:
+                self.start, self.end = byte_range
+                status_code = 206
+                headers["content-range"] = f"bytes {self.start}-{self.end}/{size}"
+            if status_code != 416:
+                headers["content-length"] = str(self.end - self.start + 1)
+
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type_for(filename))
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1
+        if not self.send_body or count <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopy" in self.extensions:
+                # Let the server sendfile() straight from the page cache. It gets the file object, not a bare
+                # descriptor, and `f` stays open until send() returns, so the descriptor can't be reused meanwhile
+                await send({"type": "http.response.zerocopy", "file": f, "offset": self.start, "count": count})
+                metrics.served_bytes.labels("file").inc(count)
+                return
+            await anyio.to_thread.run_sync(f.seek, self.start)
+            remaining = count
+            while remaining > 0:
+                chunk = await anyio.to_thread.run_sync(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+                metrics.served_bytes.labels("file").inc(len(chunk))
+            if remaining > 0:
+                # File shrank underneath us; close the response anyway
+                await send({"type": "http.response.body", "body": b""})
+
+
+async def tail_file(f, is_complete, is_aborted, poll_interval=0.25):
+    """
+    Yield the contents of a file that is still being written, following it as
+    it grows (like `tail -f`). Ends once `is_complete()` and everything has been
+    read, or as soon as `is_aborted()`. The consumer awaiting each chunk is the
+    backpressure: nothing is read ahead of what the client has taken.
+    """
+    try:
+        while True:
+            chunk = await anyio.to_thread.run_sync(f.read, CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                metrics.served_bytes.labels("live").inc(len(chunk))
+                continue
+            if is_aborted():
+                return
+            if is_complete():
+                # One last read in case bytes landed between the read and the check
+                chunk = await anyio.to_thread.run_sync(f.read, CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+                metrics.served_bytes.labels("live").inc(len(chunk))
+                continue
+            await asyncio.sleep(poll_interval)
+    finally:
+        f.close()
+
+
+class _ZipSink:
+    """Write-only, unseekable file object for zipfile; zip_stream hands out what was written."""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(files):
+    """
+    Yield a ZIP archive of `files` ((path, name in archive) pairs) while it is
+    being built: no temp file and no seeking, so the first bytes go out at once.
+    Entries are stored, not deflated (media files don't compress), and files
+    that disappeared in the meantime are skipped.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as archive:
+        for path, name in files:
+            try:
+                info = zipfile.ZipInfo.from_file(path, name)
+                src = open(path, "rb")
+            except OSError:
+                continue
+            with src, archive.open(info, "w") as dest:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = sink.drain()
+                    yield data
+                    metrics.served_bytes.labels("zip").inc(len(data))
+    # Central directory
+    data = sink.drain()
+    yield data
+    metrics.served_bytes.labels("zip").inc(len(data))
@@ -0,0 +1,99 @@
+"""
+The shared queue against a real Redis server (or anything speaking its protocol):
+
+    REDIS_URL=redis://127.0.0.1:6379/15 python -m pytest test_broker.py
+
+Without REDIS_URL the tests do nothing. They only touch keys under a fresh prefix.
+"""
+import asyncio
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from broker import RedisBroker
+from scheduler import Job, RedisQueue
+
+REDIS_URL = os.environ.get("REDIS_URL")
+
+
+def with_nodes(count):
+    """Run the decorated coroutine with `count` RedisQueues, one per node, sharing a scratch prefix."""
+    def decorate(test):
+        def run():
+            if not REDIS_URL:
+                print(f"{test.__name__}: skipped, REDIS_URL is not set")
+                return
+
+            async def main():
+                prefix = f"ourtube-test-{uuid.uuid4().hex[:8]}"
+                brokers = [RedisBroker(REDIS_URL, f"node-{i}", 30, prefix) for i in range(count)]
+                try:
+                    await test(*[RedisQueue(broker) for broker in brokers])
+                finally:
+                    keys = [key async for key in brokers[0].redis.scan_iter(match=f"{prefix}:*")]
+                    if keys:
+                        await brokers[0].redis.delete(*keys)
+                    for broker in brokers:
+                        await broker.redis.aclose()
+
+            asyncio.run(main())
+        run.__name__ = test.__name__
+        return run
+    return decorate
+
+
+@with_nodes(2)
+async def test_claim(first, second):
+    assert await first.claim("job", "node-0")
+    assert not await second.claim("job", "node-1")
+    # Only the holder's release counts
+    assert not await second.release("job", "node-1")
+    assert await first.release("job", "node-0")
+    assert await second.claim("job", "node-1")
+
+
+@with_nodes(4)
+async def test_recover_has_one_winner(*queues):
+    await queues[0].claim("job", "dead-node")
+    won = await asyncio.gather(*[queue.recover("job", "dead-node") for queue in queues])
+    assert sorted(won) == [False, False, False, True]
+    # The recovered job can be claimed again, by one node
+    assert await queues[1].claim("job", "node-1")
+    assert not await queues[2].recover("job", "dead-node")
+
+
+@with_nodes(3)
+async def test_every_job_runs_once(*queues):
+    jobs = [Job(f"job-{i}", {}, f"client-{i % 3}", seq=i + 1) for i in range(30)]
+    await queues[0].put(jobs)
+    taken = []
+    all_taken = asyncio.Event()
+
+    async def work(queue, node):
+        while True:
+            job = await queue.take()
+            if await queue.claim(job.task_id, node):
+                taken.append(job.task_id)
+            if len(taken) >= len(jobs):
+                all_taken.set()
+
+    workers = [asyncio.create_task(work(queue, f"node-{i}")) for i, queue in enumerate(queues)]
+    try:
+        await asyncio.wait_for(all_taken.wait(), 30)
+        # Anything taken twice would have shown up by now
+        await asyncio.sleep(0.5)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    assert sorted(taken) == sorted(job.task_id for job in jobs)
+    assert await queues[0].ordered() == []
+
+
+if __name__ == "__main__":
+    test_claim()
+    test_recover_has_one_winner()
+    test_every_job_runs_once()
+    print("Broker OK")
@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+
+# Everything the job writes (data/, processing/, downloads/) goes to a scratch directory
+SCRATCH = tempfile.mkdtemp(prefix="ourtube-test-")
+os.environ.setdefault("DATA_DIR", os.path.join(SCRATCH, "data"))
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# The bench extractor resolves URLs of the local media server, as a yt-dlp plugin
+sys.path[:0] = [BACKEND_DIR, os.path.join(BACKEND_DIR, "bench", "plugins")]
+
+from bench.media_server import MediaServer, THUMBNAIL_JPEG
+import pipeline
+
+
+class RecordingContext:
+    """The JobContext calls run_download makes, answered locally; published messages are kept."""
+
+    def __init__(self):
+        self.counters = {'hook_calls': 0, 'sent': 0, 'coalesced': 0}
+        self.messages = []
+
+    def publish(self, message):
+        self.messages.append(message)
+
+    def update_state(self, **fields):
+        pass
+
+    def cache_metadata(self, url, noplaylist, info):
+        pass
+
+    def record_stage(self, stage, seconds):
+        pass
+
+    def report_http_error(self, status):
+        pass
+
+    def check_aborted(self):
+        pass
+
+    def limits(self):
+        return {'fragments': 1, 'ratelimit': None}
+
+    def reserve(self, size):
+        return 'ok', None
+
+    def claim(self, key):
+        return 'own', None
+
+
+def run_job(task_id, format_id):
+    media = MediaServer().start()
+    try:
+        spec = {
+            'task_id': task_id,
+            'url': f"{media.base_url}/bench/progressive/{task_id}?size=4096",
+            'format_id': format_id,
+            'quality': 'best',
+            'strict_mode': True,
+            'split_chapters': False,
+            'cached_info': None,
+        }
+        return pipeline.run_download(spec, RecordingContext())
+    finally:
+        media.stop()
+
+
+def test_thumbnail_job():
+    os.makedirs(os.path.join(SCRATCH, "downloads"), exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(SCRATCH)
+    try:
+        result = run_job("thumbjob", "thumbnail")
+    finally:
+        os.chdir(cwd)
+
+    assert result['status'] == 'finished'
+    assert result['filename'].endswith('.jpg')
+    assert [f['filename'] for f in result['files']] == [result['filename']]
+    with open(os.path.join(SCRATCH, "downloads", result['filename']), "rb") as f:
+        assert f.read() == THUMBNAIL_JPEG
+    # Nothing left behind in processing/
+    assert not os.path.exists(os.path.join(SCRATCH, "processing", "thumbjob"))
+
+
+if __name__ == "__main__":
+    test_thumbnail_job()
+    print("Thumbnail job OK")
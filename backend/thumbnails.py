@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+
+import httpx
+
+import config
+from library import library
+from metadata import metadata_cache
+
+# Widths a client may ask for, so the cache holds a few variants per file rather than one per pixel
+THUMBNAIL_WIDTHS = (160, 320, 640)
+# Preview sprites: this many frames spread over the media, side by side, each PREVIEW_TILE pixels
+PREVIEW_FRAMES = 10
+PREVIEW_TILE = (160, 90)
+# ffmpeg runs at once for derivatives; a library page asks for dozens of thumbnails together
+MAX_RENDERS = 2
+# Remote thumbnails bigger than this aren't fetched
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+RENDER_TIMEOUT = 60
+WEBP_QUALITY = 75
+
+DURATION_RE = re.compile(r'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)')
+
+
+def ffmpeg_binary():
+    binary = shutil.which("ffmpeg")
+    if binary is None:
+        raise RuntimeError("ffmpeg is needed to make thumbnails")
+    return binary
+
+
+def render(args, source=None):
+    """Run ffmpeg with `args` (inputs and filters) writing one WebP image; returns its bytes, or None if it made none."""
+    command = [ffmpeg_binary(), "-v", "error", *args,
+               "-frames:v", "1", "-c:v", "libwebp", "-quality", str(WEBP_QUALITY), "-f", "webp", "pipe:1"]
+    try:
+        result = subprocess.run(
+            command, input=source, stdin=None if source is not None else subprocess.DEVNULL,
+            capture_output=True, timeout=RENDER_TIMEOUT
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    return result.stdout if result.returncode == 0 and result.stdout else None
+
+
+def probe_duration(path):
+    """Duration of a media file in seconds from ffmpeg's banner, None for still images and unknown lengths."""
+    result = subprocess.run([ffmpeg_binary(), "-hide_banner", "-i", path], stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True, timeout=RENDER_TIMEOUT)
+    match = DURATION_RE.search(result.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class Thumbnails:
+    """
+    Images derived from library files: WebP thumbnails and preview sprites.
+
+    Made with ffmpeg on first request, from the thumbnail the extractor
+    reported (recorded in the library, or still in the metadata cache) or
+    else from the file itself, so drawing the library never extracts
+    anything again. The cache is content-addressed: an image is stored under
+    the hash of its bytes, which doubles as its ETag, and the index maps
+    what it was made from (file, size, mtime, variant) to that hash.
+    Files with nothing to derive from are recorded too, with an empty hash.
+    """
+
+    def __init__(self, path, cache_dir):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.cache_dir = cache_dir
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS derivatives (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS derivatives_filename ON derivatives (filename)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.renders = threading.BoundedSemaphore(MAX_RENDERS)
+        self._making = {}  # key -> lock held while that derivative is made, concurrent requests wait for it
+
+    def get(self, filename, kind="thumbnail", width=320):
+        """(path, digest) of a derivative of `filename`, made now if needed. None if there is nothing to make it from."""
+        entry = library.get(filename)
+        if entry is None:
+            return None
+        key = hashlib.sha256(json.dumps(
+            [kind, width, filename, entry['size'], entry['mtime'], entry['thumbnail']]
+        ).encode()).hexdigest()
+
+        digest = self._lookup(key)
+        if digest is None:
+            try:
+                with self._lock_for(key):
+                    digest = self._lookup(key)
+                    if digest is None:
+                        with self.renders:
+                            data = self._make(entry, kind, width)
+                        digest = self._store(key, filename, data)
+            finally:
+                # Even when making it failed, so the next request tries again
+                with self.lock:
+                    self._making.pop(key, None)
+        return (self._path(digest), digest) if digest else None
+
+    def prune(self):
+        """Forget the derivatives of files that left the library, and delete images nothing refers to any more."""
+        present = library.filenames()
+        with self.lock:
+            gone = [(row[0],) for row in self.db.execute("SELECT DISTINCT filename FROM derivatives") if row[0] not in present]
+            self.db.executemany("DELETE FROM derivatives WHERE filename = ?", gone)
+            self.db.commit()
+            referenced = {row[0] for row in self.db.execute("SELECT DISTINCT digest FROM derivatives")}
+        removed = 0
+        if os.path.isdir(self.cache_dir):
+            for folder in os.scandir(self.cache_dir):
+                for entry in os.scandir(folder.path) if folder.is_dir() else ():
+                    digest = entry.name.partition(".")[0]
+                    if digest not in referenced:
+                        os.remove(entry.path)
+                        removed += 1
+        if removed:
+            print(f"Thumbnails: removed {removed} unused image(s)")
+
+    def _lock_for(self, key):
+        with self.lock:
+            return self._making.setdefault(key, threading.Lock())
+
+    def _lookup(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT digest FROM derivatives WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[0] and not os.path.exists(self._path(row[0]))):
+            return None
+        return row[0]
+
+    def _store(self, key, filename, data):
+        digest = hashlib.sha256(data).hexdigest() if data else ""
+        if data:
+            path = self._path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temporary = f"{path}.{threading.get_ident()}.tmp"
+                with open(temporary, "wb") as f:
+                    f.write(data)
+                os.replace(temporary, path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO derivatives (key, filename, digest, created) VALUES (?, ?, ?, ?)",
+                (key, filename, digest, time.time())
+            )
+            self.db.commit()
+        return digest
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.webp")
+
+    def _make(self, entry, kind, width):
+        path = os.path.join(library.downloads_dir, entry['filename'])
+        if kind == "preview":
+            return self._sprite(path, entry['duration'] or probe_duration(path))
+        source = self._remote_thumbnail(entry)
+        if source is not None:
+            data = render(["-i", "pipe:0", "-vf", f"scale='min({width},iw)':-2"], source)
+            if data:
+                return data
+        # A frame of the video (or an image file, or an audio file's cover art)
+        duration = entry['duration'] or probe_duration(path)
+        for at in dict.fromkeys([round(duration / 10, 2) if duration else 0, 0]):
+            # No -ss at all for the start, still images don't come out of a seek
+            seek = ["-ss", str(at)] if at else []
+            data = render([*seek, "-i", path, "-vf", f"scale='min({width},iw)':-2"])
+            if data:
+                return data
+        return None
+
+    def _sprite(self, path, duration):
+        if not duration:
+            return None
+        tile_width, tile_height = PREVIEW_TILE
+        inputs, filters = [], []
+        for i in range(PREVIEW_FRAMES):
+            # Input-side seeking: every input jumps straight to its frame instead of decoding up to it
+            inputs += ["-ss", f"{duration * (i + 0.5) / PREVIEW_FRAMES:.2f}", "-i", path]
+            filters.append(
+                f"[{i}:v:0]trim=end_frame=1,scale={tile_width}:{tile_height}:force_original_aspect_ratio=decrease,"
+                f"pad={tile_width}:{tile_height}:(ow-iw)/2:(oh-ih)/2,setsar=1[f{i}]"
+            )
+        stack = "".join(f"[f{i}]" for i in range(PREVIEW_FRAMES)) + f"hstack=inputs={PREVIEW_FRAMES}[sprite]"
+        return render([*inputs, "-filter_complex", ";".join(filters + [stack]), "-map", "[sprite]"])
+
+    @staticmethod
+    def _remote_thumbnail(entry):
+        url = entry['thumbnail']
+        if not url and entry['source_url']:
+            # Downloaded before thumbnails were recorded; its extraction may still be cached
+            info = metadata_cache.get(entry['source_url'], True) or metadata_cache.get(entry['source_url'], False)
+            url = info.get('thumbnail') if info else None
+        if not url:
+            return None
+        try:
+            with httpx.stream("GET", url, timeout=10, follow_redirects=True) as response:
+                if response.status_code != 200:
+                    return None
+                data = b""
+                for chunk in response.iter_bytes():
+                    data += chunk
+                    if len(data) > MAX_SOURCE_BYTES:
+                        return None
+                return data
+        except httpx.HTTPError as e:
+            print(f"Could not fetch thumbnail {url}: {e}")
+            return None
+
+
+thumbnails = Thumbnails(config.THUMBNAILS_DB_PATH, config.THUMBNAIL_CACHE_DIR)
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import metrics
+
+# Set when this module is first imported, i.e. right as main.py starts importing the backend
+PROCESS_STARTED = time.perf_counter()
+
+
+class Warmup:
+    """
+    Startup work that the API doesn't need to answer its first requests:
+    reconciling the library, loading yt-dlp and its extractors, starting the
+    worker processes' forkserver. It runs once in a background thread after
+    startup, so listing, file and health requests are served straight away;
+    /api/ready reports how far it got, and the startup timings.
+    """
+
+    def __init__(self):
+        self.state = "pending"  # pending -> warming -> ready, or failed
+        self.stage = None  # running now
+        self.error = None
+        self.timings = {}  # phase -> seconds
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def record(self, phase, seconds):
+        self.timings[phase] = round(seconds, 3)
+        metrics.startup_seconds.labels(phase).set(seconds)
+
+    def start(self, stages):
+        """Run `stages`, (name, function) pairs, in order in the background."""
+        self.state = "warming"
+        threading.Thread(target=self._run, args=(stages,), name="warmup", daemon=True).start()
+
+    def _run(self, stages):
+        started = time.perf_counter()
+        for name, function in stages:
+            self.stage = name
+            stage_started = time.perf_counter()
+            try:
+                function()
+            except Exception as e:
+                print(f"Warm-up failed in {name}: {e!r}")
+                self.state, self.error = "failed", f"{name}: {e}"
+                return
+            finally:
+                self.stage = None
+            self.record(f"warmup_{name}", time.perf_counter() - stage_started)
+        self.record("warmup", time.perf_counter() - started)
+        self.record("ready", time.perf_counter() - PROCESS_STARTED)
+        self.state = "ready"
+        print(f"Warm-up done, ready {self.timings['ready']}s after start ({self.timings})")
+
+    def status(self):
+        return {"ready": self.ready, "state": self.state, "stage": self.stage, "error": self.error,
+                "timings": dict(self.timings)}
+
+
+warmup = Warmup()
@@ -0,0 +1,27 @@
+"""
+A download node without the HTTP API: takes jobs from the shared queue
+(BROKER_URL) and reports progress to the API nodes through the broker.
+
+    BROKER_URL=redis://redis:6379/0 python worker.py
+"""
+import asyncio
+
+import config
+from broker import broker
+from downloader import downloader_service
+from warmup import warmup
+
+
+async def main():
+    if not broker.shared:
+        raise SystemExit("worker.py needs a shared BROKER_URL (redis://...), the API node runs the downloads otherwise")
+    if config.MAX_CONCURRENT_DOWNLOADS <= 0:
+        raise SystemExit("MAX_CONCURRENT_DOWNLOADS must be at least 1 on a worker node")
+    await downloader_service.start()
+    warmup.start(downloader_service.warmup_stages())
+    print(f"Worker node {broker.node_id} running {config.MAX_CONCURRENT_DOWNLOADS} download slot(s)")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
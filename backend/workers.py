@@ -0,0 +1,227 @@
+import multiprocessing
+import os
+import re
+import signal
+import threading
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Failures that may well not happen again a bit later (see is_transient)
+TRANSIENT_ERRORS = {'Timeout', 'Stalled', 'WorkerDied', 'TimeoutError', 'ConnectionError', 'ConnectionResetError',
+                    'RemoteDisconnected', 'IncompleteRead', 'TransportError', 'SSLError', 'ContentTooShortError'}
+TRANSIENT_MESSAGE_RE = re.compile(r'HTTP Error (429|5\d\d)|timed out|Connection (reset|refused|aborted)|Remote end closed|Temporary failure')
+
+
+def error_type(e):
+    """Name of the exception behind a failure, looking through yt-dlp's DownloadError wrapper."""
+    original = getattr(e, 'exc_info', None)
+    if original and original[1] is not None:
+        e = original[1]
+    # JobFailed carries the type of what was raised in the worker process
+    return getattr(e, 'error_type', None) or type(e).__name__
+
+
+def is_transient(message, error_type):
+    """Whether a failed job is worth another attempt later: timeouts, stalls, dropped connections, 429 and 5xx responses."""
+    return error_type in TRANSIENT_ERRORS or bool(TRANSIENT_MESSAGE_RE.search(message))
+
+
+class JobFailed(Exception):
+    def __init__(self, message, error_type=None):
+        super().__init__(message)
+        self.error_type = error_type  # type name of the exception raised in the worker
+
+
+class JobAborted(JobFailed):
+    """A job stopped by the API process: `reason` is 'cancelled', 'timeout' or 'stalled' (see JobContext.abort_reason)."""
+
+    def __init__(self, reason, message):
+        super().__init__(message, reason.capitalize())
+        self.reason = reason
+
+
+class ChildContext:
+    """
+    The JobContext seen from inside a worker process: every call is forwarded
+    to the API process over a pipe and handled there by the real JobContext.
+    """
+
+    def __init__(self, conn, limits):
+        self.conn = conn
+        self.shared_limits = limits  # [fragments, ratelimit], kept current by the API process
+        self.counters = {'hook_calls': 0, 'sent': 0, 'coalesced': 0}
+        # yt-dlp calls hooks from its fragment threads, messages must not interleave on the pipe
+        self.send_lock = threading.Lock()
+
+    def _send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def publish(self, message):
+        self._send(('publish', message, dict(self.counters)))
+
+    def update_state(self, **fields):
+        self._send(('update_state', fields))
+
+    def cache_metadata(self, url, noplaylist, info):
+        self._send(('cache_metadata', url, noplaylist, info))
+
+    def record_stage(self, stage, seconds):
+        self._send(('record_stage', stage, seconds))
+
+    def report_http_error(self, status):
+        self._send(('http_error', status))
+
+    def check_aborted(self):
+        # Nothing to do in here, the API process kills the whole process group
+        pass
+
+    def limits(self):
+        fragments, ratelimit = self.shared_limits[:]
+        return {'fragments': int(fragments), 'ratelimit': ratelimit or None}
+
+    def reserve(self, size):
+        with self.send_lock:
+            self.conn.send(('reserve', size))
+            return self.conn.recv()
+
+    def claim(self, key):
+        with self.send_lock:
+            self.conn.send(('claim', key))
+            return self.conn.recv()
+
+
+def _apply_limits(max_memory_mb, max_cpu_seconds):
+    if resource is None:
+        return
+    # Inherited by ffmpeg too, each child process gets its own allowance
+    if max_memory_mb:
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if max_cpu_seconds:
+        resource.setrlimit(resource.RLIMIT_CPU, (max_cpu_seconds, max_cpu_seconds + 5))
+
+
+def _child_main(spec, conn, limits, max_memory_mb, max_cpu_seconds):
+    from pipeline import run_download
+
+    if hasattr(os, "setsid"):
+        # Own process group, so ffmpeg & co. can be killed along with us
+        os.setsid()
+    _apply_limits(max_memory_mb, max_cpu_seconds)
+    try:
+        result = run_download(spec, ChildContext(conn, limits))
+    except BaseException as e:
+        conn.send(('error', str(e) or type(e).__name__, error_type(e)))
+    else:
+        conn.send(('result', result))
+    finally:
+        conn.close()
+
+
+class ProcessJobRunner:
+    """
+    Runs each job in its own worker process so yt-dlp's extraction and
+    ffmpeg post-processing can't hold the API process's GIL or take it down
+    with them. The scheduler bounds how many run at once; this class applies
+    the per-job memory/CPU limits, relays the job's calls back to its
+    JobContext in the API process, and kills the job (ffmpeg included) as
+    soon as the JobContext says it must stop: cancelled, too long or stalled.
+    """
+
+    def __init__(self, max_memory_mb=0, max_cpu_seconds=0):
+        self.max_memory_mb = max_memory_mb
+        self.max_cpu_seconds = max_cpu_seconds
+        # forkserver: cheap forks from a clean process that has already imported yt-dlp,
+        # instead of forking the threaded API process or re-importing everything per job
+        self.mp = multiprocessing.get_context("forkserver")
+        self.mp.set_forkserver_preload(["pipeline"])
+
+    def warm_up(self):
+        """Start the forkserver now rather than on the first job; it imports yt-dlp once for all jobs to come."""
+        from multiprocessing import forkserver
+        forkserver.ensure_running()
+
+    def __call__(self, spec, ctx):
+        """Run one job to completion (blocking). Returns the job's result or raises JobFailed."""
+        parent_conn, child_conn = self.mp.Pipe()
+        # The governor's allocation for this job, shared memory so the job can read it at any time
+        limits = self.mp.Array('d', 2)
+        self._share_limits(ctx, limits)
+        process = self.mp.Process(
+            target=_child_main,
+            args=(spec, child_conn, limits, self.max_memory_mb, self.max_cpu_seconds),
+            name=f"download-{spec['task_id'][:8]}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+
+        try:
+            while True:
+                aborted = ctx.abort_reason()
+                if aborted:
+                    self._kill(process)
+                    raise JobAborted(*aborted)
+                self._share_limits(ctx, limits)
+                if not parent_conn.poll(0.5):
+                    if not process.is_alive() and not parent_conn.poll():
+                        raise self._died(process)
+                    continue
+                try:
+                    kind, *payload = parent_conn.recv()
+                except EOFError:
+                    process.join(5)
+                    raise self._died(process)
+
+                if kind == 'result':
+                    return payload[0]
+                if kind == 'error':
+                    raise JobFailed(*payload)
+                if kind == 'publish':
+                    message, counters = payload
+                    ctx.counters.update(counters)
+                    ctx.publish(message)
+                elif kind == 'update_state':
+                    ctx.update_state(**payload[0])
+                elif kind == 'cache_metadata':
+                    ctx.cache_metadata(*payload)
+                elif kind == 'record_stage':
+                    ctx.record_stage(*payload)
+                elif kind == 'http_error':
+                    ctx.report_http_error(*payload)
+                elif kind == 'claim':
+                    parent_conn.send(ctx.claim(payload[0]))
+                elif kind == 'reserve':
+                    parent_conn.send(ctx.reserve(payload[0]))
+        finally:
+            if process.is_alive():
+                process.join(2)
+            if process.is_alive():
+                self._kill(process)
+            parent_conn.close()
+
+    @staticmethod
+    def _share_limits(ctx, limits):
+        allocation = ctx.limits()
+        limits[:] = [allocation['fragments'], allocation['ratelimit'] or 0]
+
+    def _died(self, process):
+        """The JobFailed for a worker process that exited without a result."""
+        signum = -process.exitcode if process.exitcode and process.exitcode < 0 else None
+        # SIGXCPU/SIGKILL: over RLIMIT_CPU (soft/hard), or the kernel's OOM killer. It would do the same again,
+        # unlike a crash, so it isn't retried (see is_transient)
+        if signum == getattr(signal, 'SIGXCPU', None) or (signum == signal.SIGKILL and (self.max_cpu_seconds or self.max_memory_mb)):
+            return JobFailed(f"Worker process killed by {signal.Signals(signum).name}: over its resource limits", "ResourceLimit")
+        return JobFailed(f"Worker process died (exit code {process.exitcode})", "WorkerDied")
+
+    @staticmethod
+    def _kill(process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            process.kill()
+        process.join()
@@ -228,6 +228,15 @@ function App() {
               <div key={file.filename} className="bg-white/5 hover:bg-white/10 border border-transparent hover:border-white/20 p-4 rounded-xl flex items-center justify-between transition group">
                 <div className="flex items-center gap-4 overflow-hidden">
                   <div className="w-2 h-2 rounded-full bg-white/20 group-hover:bg-green-400 shadow-[0_0_8px_rgba(255,255,255,0.1)] transition-all"></div>
+                  {file.thumbnail && (
+                    <img
+                      src={`http://localhost:8000${file.thumbnail}?width=160`}
+                      alt=""
+                      loading="lazy"
+                      onError={(e) => { e.currentTarget.style.display = 'none'; }}
+                      className="w-20 aspect-video object-cover rounded-md bg-black/50 flex-shrink-0"
+                    />
+                  )}
                   <div className="flex flex-col min-w-0">
                     <a
                       href={`http://localhost:8000${file.url}`}